@@ -127,6 +127,12 @@ class SettingsForm(forms.ModelForm):
             "display_images": RadioSelect()
         }
 
+    def save(self, commit=True):
+        if commit:
+            # only save fields from the form, counters are updated elsewhere
+            self.instance.save(update_fields=self.Meta.fields)
+        return self.instance
+
 
 class UsernameChangeForm(PlaceHolderMixin, forms.ModelForm):
     """Change username"""
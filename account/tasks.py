@@ -26,29 +26,39 @@ from django.db import transaction
 from pytz import utc
 
 from inboxen.celery import app
-from inboxen.models import Inbox
-from inboxen.tasks import batch_delete_items
+from inboxen.models import Email, Inbox
+from inboxen.tasks import delete_emails
+from inboxen.utils.counters import mark_deleted
 
 log = logging.getLogger(__name__)
 
 
 @app.task(rate_limit="10/m", default_retry_delay=5 * 60)  # 5 minutes
-@transaction.atomic()
 def disown_inbox(inbox_id):
-    try:
-        inbox = Inbox.objects.get(id=inbox_id)
-    except Inbox.DoesNotExist:
-        return False
-
-    # delete emails in another task(s)
-    batch_delete_items.delay("email", kwargs={'inbox__id': inbox.pk})
-
-    # remove identifying data from inbox
-    inbox.deleted = True
-    inbox.description = ""
-    inbox.user = None
-    inbox.created = datetime.utcfromtimestamp(0).replace(tzinfo=utc)
-    inbox.save()
+    # emails are on their way out, so stop counting them. This is done in
+    # batches before the inbox is locked, to keep transactions short
+    mark_deleted(Email.objects.filter(inbox_id=inbox_id))
+
+    with transaction.atomic():
+        try:
+            inbox = Inbox.objects.select_for_update().get(id=inbox_id)
+        except Inbox.DoesNotExist:
+            return False
+
+        # catch anything that arrived since
+        mark_deleted(inbox.email_set.all())
+        inbox.total_count = inbox.unseen_count = inbox.unread_count = 0
+
+        # delete emails in another task(s)
+        delete_emails.delay({"inbox_id": inbox.pk})
+
+        # remove identifying data from inbox
+        inbox.deleted = True
+        inbox.description = ""
+        inbox.user = None
+        inbox.created = datetime.utcfromtimestamp(0).replace(tzinfo=utc)
+        inbox.save()
+        Inbox.objects.filter(id=inbox.id).update_last_activity()
 
     return True
 
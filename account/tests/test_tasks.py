@@ -24,6 +24,7 @@ from django.contrib.auth import get_user_model
 
 from account import tasks
 from inboxen import models
+from inboxen.tasks import reconcile_counters
 from inboxen.test import InboxenTestCase
 from inboxen.tests import factories
 
@@ -44,14 +45,24 @@ class DeleteTestCase(InboxenTestCase):
 
     def test_disown_inbox(self):
         inbox = factories.InboxFactory(user=self.user)
+        factories.EmailFactory.create_batch(2, inbox=inbox)
+        factories.EmailFactory(inbox__user=self.user)
+        profile = self.user.inboxenprofile
+        reconcile_counters(user_id=self.user.id)
+
         result = tasks.disown_inbox(inbox.id)
         self.assertTrue(result)
 
+        profile.refresh_from_db()
+        self.assertEqual((profile.total_count, profile.unseen_count, profile.unread_count), (1, 1, 1))
+
         new_inbox = models.Inbox.objects.get(id=inbox.id)
         self.assertEqual(new_inbox.created, datetime.utcfromtimestamp(0).replace(tzinfo=utc))
         self.assertNotEqual(new_inbox.description, inbox.description)
         self.assertTrue(new_inbox.deleted)
         self.assertEqual(new_inbox.user, None)
+        self.assertEqual(new_inbox.total_count, 0)
+        self.assertEqual(new_inbox.last_activity, new_inbox.created)
 
         result = tasks.disown_inbox(inbox.id + 12)
         self.assertFalse(result)
@@ -27,6 +27,7 @@ class InboxenConfig(AppConfig):
     def ready(self):
         from django.contrib.auth.models import update_last_login
         from django.contrib.auth.signals import user_logged_in, user_logged_out
+        from django.db.models.signals import post_delete
         from watson import search as watson_search
 
         from inboxen import checks  # noqa
@@ -34,6 +35,7 @@ class InboxenConfig(AppConfig):
 
         Inbox = self.get_model("Inbox")
         Email = self.get_model("Email")
+        Body = self.get_model("Body")
 
         # Unregister update_last_login handler
         user_logged_in.disconnect(update_last_login)
@@ -43,3 +45,4 @@ class InboxenConfig(AppConfig):
         watson_search.register(Inbox, search.InboxSearchAdapter)
 
         user_logged_out.connect(signals.logout_message)
+        post_delete.connect(signals.delete_body_from_store, sender=Body, dispatch_uid="delete_body_from_store")
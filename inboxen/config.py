@@ -143,6 +143,18 @@ CELERY_WORKER_CONCURRENCY = config["tasks"]["concurrency"]
 # Runs tasks synchronously
 CELERY_TASK_ALWAYS_EAGER = config["tasks"]["always_eager"]
 
+# Render HTML emails in the background as they arrive, see inboxen.tasks.prerender_emails
+PRERENDER_EMAILS = config["tasks"]["prerender"]
+
+# Buffer changes to email flags in the cache and write them in bulk, needs a shared cache with an atomic add
+FLAG_BUFFER = config["tasks"]["flag_buffer"] and config["cache"]["backend"] == "memcached"
+
+# How often statistics are gathered
+STATISTICS_INTERVAL = config["tasks"]["statistics_interval"]
+
+# Bytes of each email body to make searchable, 0 disables searching bodies
+SEARCH_BODY_SIZE = config["tasks"]["search_body_size"]
+
 # Path where liberation data is stored
 LIBERATION_PATH = os.path.join(BASE_DIR, config["tasks"]["liberation"]["path"])
 LIBERATION_PATH = LIBERATION_PATH.rstrip("/")
@@ -150,6 +162,36 @@ LIBERATION_PATH = LIBERATION_PATH.rstrip("/")
 # Which method should be used to accelerate liberation data downloads
 SENDFILE_BACKEND = "sendfile.backends.{}".format(config["tasks"]["liberation"]["sendfile_method"])
 
+# Where email bodies are kept, see inboxen.utils.body_store
+BODY_STORE_BACKEND = {
+    "database": "inboxen.utils.body_store.DatabaseBodyStore",
+    "filesystem": "inboxen.utils.body_store.FileSystemBodyStore",
+}[config["body_store"]["backend"]]
+
+# Path used by the filesystem body store
+BODY_STORE_PATH = os.path.join(BASE_DIR, config["body_store"]["path"])
+
+# Bodies larger than this (in bytes) are moved out of the database
+BODY_STORE_INLINE_SIZE = config["body_store"]["inline_size"]
+
+# Number of router processes, they share a single port
+ROUTER_WORKERS = config["router"]["workers"]
+
+# Write incoming mail to a spool on disk and let Celery workers save it to the database
+ROUTER_USE_SPOOL = config["router"]["use_spool"]
+
+# Where spooled mail is kept, needs to be readable and writable by both the router and Celery
+ROUTER_SPOOL_PATH = os.path.join(BASE_DIR, config["router"]["spool_path"])
+
+# Mail is deferred once this many messages are waiting in the spool
+ROUTER_SPOOL_HIGH_WATER = config["router"]["spool_high_water"]
+
+# Number of spooled messages a Celery worker saves in one transaction
+ROUTER_SPOOL_BATCH_SIZE = config["router"]["spool_batch_size"]
+
+# Keep a filter of known addresses in memory so the router can reject mail for unknown ones without a query
+ROUTER_RECIPIENT_FILTER = config["router"]["recipient_filter"]
+
 # Databases!
 DATABASES = {
     'default': {
@@ -180,5 +222,28 @@ if config["cache"]["backend"] == "file":
 else:
     CACHES["default"]["LOCATION"] = config["cache"]["location"]
 
+# Rendered HTML emails get their own cache so they can't push everything else out, unless they share a memcached
+CACHES["render"] = {
+    'BACKEND': CACHES["default"]["BACKEND"],
+    'TIMEOUT': config["cache"]["render_timeout"],
+    'KEY_PREFIX': "render",
+    'OPTIONS': {
+        'MAX_ENTRIES': config["cache"]["render_max_entries"],
+    },
+}
+
+if config["cache"]["render_location"] != "":
+    if config["cache"]["backend"] == "file":
+        CACHES["render"]["LOCATION"] = os.path.join(BASE_DIR, config["cache"]["render_location"])
+    else:
+        CACHES["render"]["LOCATION"] = config["cache"]["render_location"]
+elif config["cache"]["backend"] == "file":
+    CACHES["render"]["LOCATION"] = os.path.join(CACHES["default"]["LOCATION"], "render")
+elif config["cache"]["backend"] == "memcached":
+    # shares memory with the default cache, set render_location to keep them apart
+    CACHES["render"]["LOCATION"] = CACHES["default"]["LOCATION"]
+else:
+    CACHES["render"]["LOCATION"] = "{}_render".format(config["cache"]["location"])
+
 # populate __all__
 __all__ = [item for item in dir() if item.isupper()]
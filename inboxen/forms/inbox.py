@@ -24,6 +24,7 @@ from django.contrib import messages
 from django.utils.translation import ugettext as _
 
 from inboxen import models, tasks
+from inboxen.utils.counters import mark_deleted
 from inboxen.utils.ratelimit import inbox_ratelimit
 
 __all__ = ["InboxAddForm", "InboxEditForm"]
@@ -94,13 +95,18 @@ class InboxEditForm(forms.ModelForm):
         clear_inbox = data.pop("clear_inbox", False)
 
         if clear_inbox:
-            emails = self.instance.email_set.all()
-            emails.update(deleted=True)
-            tasks.batch_delete_items.delay("email", kwargs={'inbox__id': self.instance.id})
+            mark_deleted(self.instance.email_set.all())
+            models.Inbox.objects.filter(id=self.instance.id).update_last_activity()
+            tasks.delete_emails.delay({"inbox_id": self.instance.id, "deleted": True})
             warn_msg = _("All emails in {0}@{1} are being deleted.").format(self.instance.inbox,
                                                                             self.instance.domain.domain)
             messages.warning(self.request, warn_msg)
 
-        super(InboxEditForm, self).save()
+        # only save fields from the form, counters and flags are updated elsewhere
+        self.instance.save(update_fields=self.Meta.fields)
+
+        if "exclude_from_unified" in self.changed_data:
+            # emails have moved in or out of the Unified Inbox
+            tasks.reconcile_counters.delay(user_id=self.instance.user_id)
 
         return self.instance
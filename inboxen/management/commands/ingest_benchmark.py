@@ -0,0 +1,118 @@
+##
+#    Copyright (C) 2018 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+import mailbox
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils.crypto import get_random_string
+from salmon.mail import MailRequest
+
+from inboxen.models import Domain, Email, HeaderName, Inbox
+from inboxen.utils.deletion import delete_in_batches
+from router.app.helpers import make_email
+
+_help = """
+Measure how quickly the router can push emails into the database.
+
+Each message in the given mbox is passed to make_email, the same as the router
+would do. Each message is saved in its own transaction, as the router does,
+so that anything waiting for a commit (such as the header name cache) behaves
+as it would in production. The emails are deleted once the benchmark has
+finished, bodies and header data are left for collect_orphans.
+
+The first pass is reported separately: it has to create header names, header
+data and bodies that aren't in the database yet. Later passes only find
+existing ones, as happens when the same mail is received again. Bodies and
+header data from a previous run may still be in the database, so run
+collect_orphans between runs for a truly cold first pass.
+
+If [tasks] prerender is enabled, each message will queue a task, so you may
+want to turn it off while benchmarking.
+
+Run this before and after making changes to the ingest path to compare
+messages per second and queries per message.
+"""
+
+
+class Command(BaseCommand):
+    help = _help
+
+    def add_arguments(self, parser):
+        parser.add_argument("mailbox", help="path to mailbox")
+        parser.add_argument("--repeat", type=int, default=10, help="number of times to process the mailbox again")
+
+    def process(self, messages, inbox):
+        """Save each message in its own transaction, returns the number of
+        queries made"""
+        query_count = 0
+        for message in messages:
+            # Django only keeps the last 9000 queries and never clears them
+            # outside of a request, so count each message from an empty log
+            reset_queries()
+            with CaptureQueriesContext(connection) as queries:
+                with transaction.atomic():
+                    make_email(message, inbox)
+            query_count += len(queries)
+
+        return query_count
+
+    def handle(self, **options):
+        if not os.path.exists(options["mailbox"]):
+            raise CommandError("No such path: %s" % options["mailbox"])
+        elif options["repeat"] < 1:
+            raise CommandError("--repeat must be at least 1")
+
+        mbox = mailbox.mbox(options["mailbox"])
+        messages = [MailRequest("", "", "", msg.as_string()) for msg in mbox]
+        mbox.close()
+
+        if len(messages) == 0:
+            raise CommandError("Your mbox is empty!")
+
+        domain = Domain.objects.create(domain="%s.invalid" % get_random_string(20))
+        inbox = Inbox.objects.create(domain=domain)
+        try:
+            # start cold, without any header names cached by this process
+            HeaderName.objects.clear_cache()
+            start = time.time()
+            first_query_count = self.process(messages, inbox)
+            first_elapsed = time.time() - start
+
+            query_count = 0
+            start = time.time()
+            for i in range(options["repeat"]):
+                query_count += self.process(messages, inbox)
+            elapsed = time.time() - start
+        finally:
+            delete_in_batches(Email.objects.filter(inbox=inbox))
+            inbox.delete()
+            domain.delete()
+
+        self.stdout.write("First pass: %d messages in %.2f seconds" % (len(messages), first_elapsed))
+        self.stdout.write("First pass messages per second: %.2f" % (len(messages) / first_elapsed))
+        self.stdout.write("First pass queries per message: %.2f" % (float(first_query_count) / len(messages)))
+
+        processed = len(messages) * options["repeat"]
+        self.stdout.write("Repeat passes: %d messages in %.2f seconds" % (processed, elapsed))
+        self.stdout.write("Repeat passes messages per second: %.2f" % (processed / elapsed))
+        self.stdout.write("Repeat passes queries per message: %.2f" % (float(query_count) / processed))
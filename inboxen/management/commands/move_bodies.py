@@ -0,0 +1,85 @@
+##
+#    Copyright (C) 2018 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from functools import partial
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+
+from inboxen.models import Body
+from inboxen.utils.body_store import DatabaseBodyStore, get_body_store
+
+_help = """
+Move email bodies that are larger than [body_store] inline_size out of the
+database and into the body store.
+
+Use --inline to move everything back into the database, e.g. before switching
+back to the "database" backend.
+"""
+
+
+class Command(BaseCommand):
+    help = _help
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100, help="number of bodies to move per transaction")
+        parser.add_argument("--inline", action="store_true", help="move bodies back into the database")
+
+    def handle(self, **options):
+        store = get_body_store()
+        inline = options["inline"]
+
+        if type(store) is DatabaseBodyStore:
+            raise CommandError("The body store is not enabled, check the [body_store] section of your config.")
+
+        last_id = 0
+        moved = 0
+        while True:
+            with transaction.atomic():
+                bodies = Body.objects.filter(id__gt=last_id, in_store=inline).order_by("id").defer("data")
+                if not inline:
+                    bodies = bodies.filter(Q(size__gt=store.inline_size) | Q(size__isnull=True))
+                bodies = list(bodies.select_for_update()[:options["batch_size"]])
+
+                if len(bodies) == 0:
+                    break
+
+                for body in bodies:
+                    last_id = body.id
+                    data = body.get_data()
+
+                    if inline:
+                        body.data = data
+                        body.in_store = False
+                        transaction.on_commit(partial(store.delete, body.hashed))
+                    elif store.should_store(len(data)):
+                        store.save(body.hashed, data)
+                        body.data = b""
+                        body.in_store = True
+                    else:
+                        continue
+
+                    body.size = len(data)
+                    body.save(update_fields=["data", "in_store", "size"])
+                    moved += 1
+
+            self.stdout.write("Moved %d bodies" % moved)
+
+        self.stdout.write("Done")
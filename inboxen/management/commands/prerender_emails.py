@@ -0,0 +1,63 @@
+##
+#    Copyright (C) 2018 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from inboxen.models import Email
+from inboxen.tasks import prerender_emails
+
+_help = """
+Send off tasks to render HTML emails into the render cache, newest first.
+
+Rendered emails only last as long as [cache] render_timeout and only
+[cache] render_max_entries of them are kept, so there's no point going back
+further than that.
+"""
+
+
+class Command(BaseCommand):
+    help = _help
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100, help="number of emails to render per task")
+        parser.add_argument("--days", type=int, default=1, help="render emails received in the last N days")
+
+    def handle(self, **options):
+        since = timezone.now() - timedelta(days=options["days"])
+        emails = Email.objects.filter(received_date__gte=since, deleted=False).order_by("-id")
+
+        last_id = None
+        tasks = 0
+        while True:
+            batch = emails
+            if last_id is not None:
+                batch = batch.filter(id__lt=last_id)
+            batch = list(batch.values_list("id", flat=True)[:options["batch_size"]])
+
+            if len(batch) == 0:
+                break
+
+            prerender_emails.delay(batch)
+            last_id = batch[-1]
+            tasks += 1
+
+        self.stdout.write("Sent %d tasks" % tasks)
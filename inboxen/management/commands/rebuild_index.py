@@ -0,0 +1,158 @@
+##
+#    Copyright (C) 2018 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from multiprocessing import Pool
+import time
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import Max, Min
+from watson.models import SearchEntry
+
+from inboxen.search import DEFAULT_ENGINE, bulk_update_index, index_bodies
+
+# entries are built under this engine and only searched once they're swapped in
+REBUILD_ENGINE = "rebuild"
+
+# models to index and the objects of each that should be in the index
+INDEXED = {
+    "Inbox": lambda model: model.objects.select_related("domain"),
+    "Email": lambda model: model.objects.filter(deleted=False).select_related("summary", "inbox__domain"),
+}
+
+_help = """
+Rebuild the search index, a faster alternative to buildwatson for Inboxen.
+
+Objects are split into ranges of IDs that are indexed in parallel by
+--workers processes. Each range is indexed in one transaction, so if the
+command is interrupted running it again with the same --chunk-size will carry
+on from where it left off.
+The new index replaces the old one once every range has been indexed. Email
+bodies that aren't in the body search index yet are added as they're found.
+
+Changes made to objects that have already been indexed while this is running
+are lost when the new index replaces the old one.
+"""
+
+
+def index_range(args):
+    """Index objects of `model_name` with IDs from `start` up to but not
+    including `end`, returns the number of objects indexed"""
+    model_name, start, end = args
+    model = apps.get_model("inboxen", model_name)
+    objects = INDEXED[model_name](model).filter(id__gte=start, id__lt=end)
+
+    with transaction.atomic():
+        count = bulk_update_index(model, objects, engine_slug=REBUILD_ENGINE)
+
+    if model_name == "Email":
+        index_bodies(objects.values_list("id", flat=True))
+
+    return count
+
+
+class Command(BaseCommand):
+    help = _help
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=10000, help="number of IDs in each range")
+        parser.add_argument("--workers", type=int, default=1, help="number of processes to index with")
+        parser.add_argument("--restart", action="store_true", help="throw away a rebuild that was interrupted")
+
+    def handle(self, **options):
+        if options["restart"]:
+            SearchEntry.objects.filter(engine_slug=REBUILD_ENGINE).delete()
+
+        ranges = []
+        last_ids = {}
+        for model_name in INDEXED:
+            model_ranges, last_ids[model_name] = self.get_ranges(model_name, options["chunk_size"])
+            ranges.extend(model_ranges)
+
+        self.stdout.write("%d ranges to index" % len(ranges))
+        indexed = 0
+        start = time.time()
+        for done, count in enumerate(self.run(ranges, options["workers"]), 1):
+            indexed += count
+            rate = indexed / max(time.time() - start, 0.001)
+            self.stdout.write("Indexed %d objects, %d of %d ranges (%.1f objects/s)" %
+                              (indexed, done, len(ranges), rate))
+
+        self.swap(last_ids)
+        self.stdout.write("Done")
+
+    def get_ranges(self, model_name, chunk_size):
+        """Ranges of IDs that haven't been indexed yet and the highest ID when
+        the ranges were worked out
+
+        Ranges are aligned to `chunk_size` so that they're the same when the
+        command is run again
+        """
+        model = apps.get_model("inboxen", model_name)
+        # include objects that won't be indexed, so that their old entries are
+        # replaced too
+        ids = model.objects.aggregate(first=Min("id"), last=Max("id"))
+        if ids["first"] is None:
+            return [], 0
+
+        # a range has been indexed if it has any entries, as each one is
+        # indexed in a single transaction
+        content_type = ContentType.objects.get_for_model(model)
+        done = SearchEntry.objects.filter(engine_slug=REBUILD_ENGINE, content_type=content_type)
+        done = set(object_id // chunk_size for object_id in done.values_list("object_id_int", flat=True).iterator())
+
+        ranges = []
+        for chunk in range(ids["first"] // chunk_size, ids["last"] // chunk_size + 1):
+            if chunk not in done:
+                ranges.append((model_name, chunk * chunk_size, (chunk + 1) * chunk_size))
+
+        return ranges, ids["last"]
+
+    def run(self, ranges, workers):
+        """Index `ranges`, yields the number of objects indexed as each range
+        finishes"""
+        if workers <= 1:
+            for args in ranges:
+                yield index_range(args)
+            return
+
+        # forked processes must not share a connection
+        connections.close_all()
+        pool = Pool(workers)
+        try:
+            for count in pool.imap_unordered(index_range, ranges):
+                yield count
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @transaction.atomic()
+    def swap(self, last_ids):
+        """Replace the old index with the new one
+
+        Only entries up to the highest ID that was indexed are replaced,
+        anything newer will have been indexed as usual
+        """
+        for model_name, last_id in last_ids.items():
+            content_type = ContentType.objects.get_for_model(apps.get_model("inboxen", model_name))
+            entries = SearchEntry.objects.filter(content_type=content_type)
+            entries.filter(engine_slug=DEFAULT_ENGINE, object_id_int__lte=last_id).delete()
+            entries.filter(engine_slug=REBUILD_ENGINE).update(engine_slug=DEFAULT_ENGINE)
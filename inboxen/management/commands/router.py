@@ -17,12 +17,39 @@
 #    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+import errno
+import glob
 import os
+import re
+import socket
 
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 
 from subprocess import check_output, CalledProcessError
 
+from router.app.receivers import WORKER_ENV, read_stats, stats_path
+
+PID_FILE_RE = re.compile(r"^router(-(?P<worker>\d+))?\.pid$")
+
+
+def read_pid(path):
+    try:
+        with open(path) as pid_file:
+            return int(pid_file.readline())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        # EPERM means it exists, but belongs to someone else
+        return exc.errno == errno.EPERM
+
+    return True
+
 
 class Command(BaseCommand):
     can_import_settings = True
@@ -32,10 +59,14 @@ class Command(BaseCommand):
         super(Command, self).__init__(*args, **kwargs)
 
         self.salmon_bin = os.getenv('SALMON_BIN', 'salmon')
-
-        # these need to be ordered from smtp in to database out
-        self.salmon_options = [
-            {'pid': 'run/router.pid', 'boot': 'config.boot'},
+        self.router_dir = "router"
+        self.workers = settings.ROUTER_WORKERS
+
+    @property
+    def salmon_options(self):
+        return [
+            {'worker': i, 'pid': 'run/router-%d.pid' % i, 'boot': 'config.boot'}
+            for i in range(1, self.workers + 1)
         ]
 
     def add_arguments(self, parser):
@@ -43,8 +74,19 @@ class Command(BaseCommand):
         daemon_parser.add_argument("--start", action='store_const', dest="cmd", const=self.salmon_start)
         daemon_parser.add_argument("--stop", action='store_const', dest="cmd", const=self.salmon_stop)
         daemon_parser.add_argument("--status", action='store_const', dest="cmd", const=self.salmon_status)
+        parser.add_argument("--workers", type=int, help="number of router processes to start")
 
     def handle(self, **options):
+        if options.get("workers") is not None:
+            self.workers = options["workers"]
+
+        if self.workers < 1:
+            raise CommandError("You need at least one worker.")
+        elif self.workers > 1 and settings.SALMON_SERVER["type"] == "lmtp":
+            raise CommandError("Workers can't share a UNIX socket, use SMTP if you need more than one worker.")
+        elif self.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+            raise CommandError("Your platform does not support SO_REUSEPORT, you can only have one worker.")
+
         try:
             output = options["cmd"]()
         except OSError:
@@ -52,20 +94,60 @@ class Command(BaseCommand):
 
         self.stdout.write("".join(output))
 
+    def running_handlers(self):
+        """Find pid files of all workers, including ones that are no longer
+        configured
+        """
+        handlers = []
+        for path in sorted(glob.glob(os.path.join(self.router_dir, "run", "router*.pid"))):
+            match = PID_FILE_RE.match(os.path.basename(path))
+            if match is None:
+                continue
+
+            worker = match.group("worker")
+            handlers.append({
+                'worker': int(worker) if worker else None,
+                'pid': os.path.relpath(path, self.router_dir),
+            })
+
+        return handlers
+
     def salmon_start(self):
-        name = "Starting Salmon handler: %s\n"
+        """Start workers that aren't running
+
+        Workers that have crashed are restarted, so this can be run
+        periodically to keep the router healthy.
+        """
         output = []
         for handler in self.salmon_options:
+            pid = read_pid(os.path.join(self.router_dir, handler['pid']))
+            if pid is not None and pid_alive(pid):
+                output.append("Salmon handler %s (worker %d) already running with PID %d\n" %
+                              (handler['boot'][7:], handler['worker'], pid))
+                continue
+
+            cmd = [
+                self.salmon_bin,
+                'start',
+                '--pid',
+                handler['pid'],
+                '--boot',
+                handler['boot'],
+            ]
+
+            if pid is None:
+                name = "Starting Salmon handler: %s (worker %d)\n"
+            else:
+                # stale pid file from a worker that has crashed
+                cmd.append('--force')
+                name = "Restarting crashed Salmon handler: %s (worker %d)\n"
+
+            env = dict(os.environ)
+            env[WORKER_ENV] = str(handler['worker'])
+
             try:
-                check_output([
-                    self.salmon_bin,
-                    'start',
-                    '--pid',
-                    handler['pid'],
-                    '--boot',
-                    handler['boot'],
-                ], cwd='router')
-                output.append(name % handler['boot'][7:])
+                check_output(cmd, cwd=self.router_dir, env=env)
+                output.append(name % (handler['boot'][7:], handler['worker']))
             except CalledProcessError as error:
                 output.append("Exit code %d: %s" % (error.returncode, error.output))
 
@@ -73,25 +155,42 @@ class Command(BaseCommand):
 
     def salmon_stop(self):
         output = []
-        for handler in self.salmon_options:
+        for handler in self.running_handlers():
             try:
                 output.append(check_output([
                     self.salmon_bin,
                     'stop',
                     '--pid',
                     handler['pid'],
-                ], cwd='router'))
+                ], cwd=self.router_dir))
             except CalledProcessError as error:
                 output.append("Exit code %d: %s" % (error.returncode, error.output))
 
         return output
 
     def salmon_status(self):
+        """Report pid and message counters for each worker"""
         output = []
+        handlers = {handler['worker']: handler for handler in self.running_handlers()}
         for handler in self.salmon_options:
-            try:
-                output.append(check_output([self.salmon_bin, 'status', '--pid', handler['pid']], cwd='router'))
-            except CalledProcessError as error:
-                output.append("Exit code %d: %s" % (error.returncode, error.output))
+            handlers.setdefault(handler['worker'], handler)
+
+        for worker in sorted(handlers, key=lambda w: -1 if w is None else w):
+            handler = handlers[worker]
+            name = "Worker %d" % worker if worker is not None else "Router"
+            pid = read_pid(os.path.join(self.router_dir, handler['pid']))
+
+            if pid is None:
+                output.append("%s: not running\n" % name)
+                continue
+            elif not pid_alive(pid):
+                output.append("%s: crashed, PID %d not found\n" % (name, pid))
+                continue
+
+            status = "%s: running with PID %d" % (name, pid)
+            stats = read_stats(os.path.join(self.router_dir, stats_path(worker))) if worker is not None else None
+            if stats is not None and stats.get("pid") == pid:
+                status += ", %(accepted)d accepted, %(rejected)d rejected, %(deferred)d deferred" % stats
+            output.append(status + "\n")
 
         return output
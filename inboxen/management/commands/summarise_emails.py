@@ -0,0 +1,90 @@
+##
+#    Copyright (C) 2018 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from inboxen.models import Email, EmailSummary, Header, PartList
+from inboxen.utils.email import make_summary
+
+_help = """
+Create summaries for emails that don't have one. New emails are summarised
+as they arrive, so this only needs to be run once.
+"""
+
+
+class LeafPart(object):
+    """Gives a PartList the same interface as router.app.helpers.ParsedPart"""
+    def __init__(self, part):
+        self.part = part
+        self.content_type = part.content_type
+        self.charset = part.charset
+        self.filename = part.filename
+        self.size = part.body.size
+
+    def get_data(self):
+        return self.part.body.get_data()
+
+
+class Command(BaseCommand):
+    help = _help
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100, help="number of emails to summarise per transaction")
+
+    def handle(self, **options):
+        last_id = 0
+        done = 0
+        while True:
+            with transaction.atomic():
+                emails = Email.objects.filter(id__gt=last_id, summary__isnull=True).order_by("id")
+                emails = list(emails.values_list("id", flat=True)[:options["batch_size"]])
+
+                if len(emails) == 0:
+                    break
+
+                last_id = emails[-1]
+                summaries = self.summarise(emails)
+                EmailSummary.objects.bulk_create(summaries)
+                done += len(summaries)
+
+            self.stdout.write("Summarised %d emails" % done)
+
+        self.stdout.write("Done")
+
+    def summarise(self, email_ids):
+        parts = list(PartList.objects.filter(email_id__in=email_ids).select_related("body").defer("body__data"))
+        headers = Header.objects.filter(part_id__in=[part.id for part in parts])
+        headers = headers.get_many("Content-Type", "Content-Disposition", "Subject", "From", group_by="part_id")
+
+        roots = {}
+        leaves = {}
+        for part in parts:
+            part.set_content_headers(headers.get(part.id, {}))
+            if part.parent_id is None:
+                roots[part.email_id] = headers.get(part.id, {})
+            if part.is_leaf_node():
+                leaves.setdefault(part.email_id, []).append(LeafPart(part))
+
+        summaries = []
+        for email_id in email_ids:
+            summary = make_summary(roots.get(email_id, {}), leaves.get(email_id, []))
+            summaries.append(EmailSummary(email_id=email_id, **summary))
+
+        return summaries
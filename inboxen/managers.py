@@ -18,11 +18,12 @@
 ##
 
 from collections import OrderedDict
+from functools import partial
 import hashlib
 
 from django.conf import settings
 from django.db import IntegrityError, models, transaction
-from django.db.models import Q, Max
+from django.db.models import Count, OuterRef, Q, Subquery
 from django.db.models.functions import Coalesce
 from django.db.models.query import QuerySet
 from django.utils import timezone
@@ -31,9 +32,66 @@ from django.utils.encoding import smart_bytes
 from django.utils.translation import ugettext as _
 
 from inboxen.utils import is_reserved
+from inboxen.utils.body_store import get_body_store, lock_body
+from inboxen.utils.lru import LRUCache
 
 
-class HashedQuerySet(QuerySet):
+# process-local mapping of header names to HeaderName IDs
+header_name_cache = LRUCache(settings.HEADER_NAME_CACHE_SIZE)
+
+
+class BulkGetOrCreateQuerySet(QuerySet):
+    def get_or_create_many(self, field, defaults):
+        """Fetch or create rows for many values of a unique `field` in as few
+        queries as possible
+
+        `defaults` should be a dictionary of `field` values mapped to a
+        dictionary of column values to be used if that row needs to be created.
+        Returns a dictionary of `field` values mapped to primary keys.
+        """
+        if len(defaults) == 0:
+            return {}
+
+        ids = dict(self.filter(**{"{}__in".format(field): list(defaults.keys())}).values_list(field, "pk"))
+        missing = [self.model(**dict(values, **{field: key})) for key, values in defaults.items() if key not in ids]
+
+        if len(missing) > 0:
+            try:
+                with transaction.atomic():
+                    self.prepare_new(missing)
+                    self.bulk_create(missing)
+                ids.update((getattr(obj, field), obj.pk) for obj in missing)
+            except IntegrityError:
+                # someone else inserted one of our rows, fallback to doing
+                # things one row at a time
+                for key in [getattr(obj, field) for obj in missing]:
+                    ids[key] = self._get_or_create_one(field, key, defaults[key])[0].pk
+
+        return ids
+
+    def _get_or_create_one(self, field, key, defaults):
+        """Like get_or_create, but calls prepare_new before inserting"""
+        try:
+            return self.get(**{field: key}), False
+        except self.model.DoesNotExist:
+            pass
+
+        obj = self.model(**dict(defaults, **{field: key}))
+        try:
+            with transaction.atomic():
+                self.prepare_new([obj])
+                obj.save(force_insert=True)
+            return obj, True
+        except IntegrityError:
+            return self.get(**{field: key}), False
+
+    def prepare_new(self, objs):
+        """Called with unsaved objects just before they are inserted, inside
+        the transaction that inserts them"""
+        pass
+
+
+class HashedQuerySet(BulkGetOrCreateQuerySet):
     def hash_it(self, data):
         hashed = hashlib.new(settings.COLUMN_HASHER)
         hashed.update(smart_bytes(data))
@@ -74,11 +132,14 @@ class InboxQuerySet(QuerySet):
                 # inbox is reserved, try again
                 continue
 
+            now = timezone.now()
+            kwargs.setdefault("last_activity", now)
+
             try:
                 with transaction.atomic():
                     return super(InboxQuerySet, self).create(
                         inbox=inbox,
-                        created=timezone.now(),
+                        created=now,
                         domain=domain,
                         **kwargs
                     )
@@ -110,10 +171,33 @@ class InboxQuerySet(QuerySet):
         qs = self.filter(user=user)
         return qs.exclude(deleted=True)
 
-    def add_last_activity(self):
-        """Annotates `last_activity` onto each Inbox and then orders by that column"""
-        qs = self.annotate(last_activity=Coalesce(Max("email__received_date"), "created")).order_by("-last_activity")
-        return qs
+    def update_last_activity(self):
+        """Recalculate `last_activity` from the emails in each Inbox
+
+        Only needed after emails have been deleted, the router keeps
+        `last_activity` up to date as emails arrive.
+        """
+        from inboxen.models import Email
+
+        latest = Email.objects.filter(inbox=OuterRef("pk"), deleted=False).order_by("-received_date")
+        latest = Subquery(latest.values("received_date")[:1])
+        return self.update(last_activity=Coalesce(latest, "created"))
+
+    def recount(self):
+        """Recalculate email counters for each Inbox
+
+        Counters are kept up to date as emails arrive, are seen and are
+        deleted, this repairs any drift. See inboxen.utils.counters
+        """
+        from inboxen.models import Email
+
+        emails = Email.objects.filter(inbox=OuterRef("pk"), deleted=False).order_by().values("inbox")
+
+        def counter(**filters):
+            count = emails.filter(**filters).annotate(count=Count("id")).values("count")
+            return Coalesce(Subquery(count, output_field=models.IntegerField()), 0)
+
+        return self.update(total_count=counter(), unseen_count=counter(seen=False), unread_count=counter(read=False))
 
 
 ##
@@ -140,36 +224,107 @@ class HeaderQuerySet(HashedQuerySet):
         if hashed is None:
             hashed = self.hash_it(data)
 
-        name = HeaderName.objects.only('id').get_or_create(name=name)[0]
+        name_id = HeaderName.objects.get_ids([name], create=True)[name]
         data, created = HeaderData.objects.only('id').get_or_create(hashed=hashed, defaults={'data': data})
 
-        return (super(HeaderQuerySet, self).create(name=name, data=data, ordinal=ordinal, **kwargs), created)
+        return (super(HeaderQuerySet, self).create(name_id=name_id, data=data, ordinal=ordinal, **kwargs), created)
 
     def get_many(self, *args, **kwargs):
-        group_by = kwargs.pop("group_by", None)
-        query = models.Q()
+        """Returns an OrderedDict of header names and data for headers named in
+        `args`, or all headers if `args` is empty
+
+        If `group_by` is given, the OrderedDict is keyed by the value of that
+        field and the values are OrderedDicts of names and data.
+        """
+        from inboxen.models import HeaderName
 
-        for item in args:
-            query = query | models.Q(name__name=item)
+        group_by = kwargs.pop("group_by", None)
 
-        values = self.filter(query)
+        if len(args) > 0:
+            # filter on name_id and avoid a join on HeaderName
+            names = {name_id: name for name, name_id in HeaderName.objects.get_ids(args).items()}
+            values = self.filter(name_id__in=list(names.keys()))
+            name_field = "name_id"
+        else:
+            names = None
+            values = self.all()
+            name_field = "name__name"
 
         if group_by is None:
-            values = values.values_list("name__name", "data__data")
+            values = values.values_list(name_field, "data__data")
+            if names is not None:
+                values = [(names[value[0]], value[1]) for value in values]
             return OrderedDict(values)
 
-        values = values.values_list(group_by, "name__name", "data__data")
+        values = values.values_list(group_by, name_field, "data__data")
 
         headers = OrderedDict()
         for value in values:
+            name = value[1] if names is None else names[value[1]]
             part = headers.get(value[0], OrderedDict())
-            part[value[1]] = value[2]
+            part[name] = value[2]
             headers[value[0]] = part
 
         return headers
 
 
+class HeaderNameQuerySet(BulkGetOrCreateQuerySet):
+    def get_ids(self, names, create=False):
+        """Returns a dictionary of header names mapped to HeaderName IDs
+
+        Names are looked up in a process-local cache first and the database is
+        only queried for names that are missing. If `create` is False, names
+        that aren't in the database are left out of the returned dictionary.
+
+        IDs are only cached once the current transaction has been committed, so
+        a rollback can't leave IDs of rows that don't exist in the cache.
+        """
+        ids = header_name_cache.get_many(names)
+        missing = [name for name in names if name not in ids]
+
+        if len(missing) > 0:
+            if create:
+                fetched = self.get_or_create_many("name", {name: {} for name in missing})
+            else:
+                fetched = dict(self.filter(name__in=missing).values_list("name", "pk"))
+
+            transaction.on_commit(partial(header_name_cache.set_many, fetched))
+            ids.update(fetched)
+
+        return ids
+
+    def preload_cache(self):
+        """Fill the process-local cache with the oldest header names, which
+        tend to be the most common ones
+        """
+        names = self.order_by("pk").values_list("name", "pk")[:header_name_cache.size]
+        transaction.on_commit(partial(header_name_cache.set_many, dict(names)))
+
+    def clear_cache(self):
+        header_name_cache.clear()
+
+
+class HeaderDataQuerySet(HashedQuerySet):
+    pass
+
+
 class BodyQuerySet(HashedQuerySet):
+    def prepare_new(self, objs):
+        """Bodies that are too large to be kept inline are written to the body
+        store, see inboxen.utils.body_store
+
+        Only bodies that are about to be created are written, so data isn't
+        written again for every copy of a body that's received.
+        """
+        store = get_body_store()
+        for obj in objs:
+            obj.size = len(obj.data or b"")
+            if store.should_store(obj.size):
+                lock_body(obj.hashed)
+                store.save(obj.hashed, smart_bytes(obj.data))
+                obj.data = b""
+                obj.in_store = True
+
     def get_or_create(self, data=None, hashed=None, **kwargs):
         if hashed is None:
             hashed = self.hash_it(data)
@@ -177,4 +332,4 @@ class BodyQuerySet(HashedQuerySet):
         if "defaults" in kwargs:
             kwargs.pop("defaults")
 
-        return super(BodyQuerySet, self).get_or_create(hashed=hashed, defaults={'data': data}, **kwargs)
+        return self._get_or_create_one("hashed", hashed, dict(kwargs, data=data))
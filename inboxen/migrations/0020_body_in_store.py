@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inboxen', '0019_auto_20180522_2025'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='body',
+            name='in_store',
+            field=models.BooleanField(default=False),
+        ),
+    ]
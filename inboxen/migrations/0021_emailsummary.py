@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inboxen', '0020_body_in_store'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailSummary',
+            fields=[
+                ('email', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='inboxen.Email')),
+                ('subject', models.TextField(default='')),
+                ('sender', models.TextField(default='')),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('attachment_count', models.PositiveIntegerField(default=0)),
+                ('preview', models.CharField(default='', max_length=200)),
+            ],
+        ),
+    ]
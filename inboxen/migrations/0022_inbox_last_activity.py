@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inboxen', '0021_emailsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inbox',
+            name='last_activity',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunSQL(
+            """UPDATE inboxen_inbox SET last_activity = COALESCE(
+                (SELECT MAX(received_date) FROM inboxen_email WHERE inboxen_email.inbox_id = inboxen_inbox.id),
+                inboxen_inbox.created
+            )""",
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name='inbox',
+            name='last_activity',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='inbox',
+            index=models.Index(fields=['user', '-pinned', 'disabled', '-last_activity'], name='inboxen_inbox_home_idx'),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inboxen', '0022_inbox_last_activity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inbox',
+            name='total_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='inbox',
+            name='unread_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='inbox',
+            name='unseen_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='total_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='unread_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='unseen_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunSQL(
+            """UPDATE inboxen_inbox SET
+                total_count = counts.total,
+                unseen_count = counts.unseen,
+                unread_count = counts.unread
+            FROM (
+                SELECT inbox_id, COUNT(*) AS total,
+                    COUNT(*) FILTER (WHERE NOT seen) AS unseen,
+                    COUNT(*) FILTER (WHERE NOT read) AS unread
+                FROM inboxen_email WHERE NOT deleted GROUP BY inbox_id
+            ) AS counts
+            WHERE counts.inbox_id = inboxen_inbox.id""",
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            """UPDATE inboxen_userprofile SET
+                total_count = counts.total,
+                unseen_count = counts.unseen,
+                unread_count = counts.unread
+            FROM (
+                SELECT user_id, SUM(total_count) AS total,
+                    SUM(unseen_count) AS unseen,
+                    SUM(unread_count) AS unread
+                FROM inboxen_inbox WHERE NOT deleted AND NOT exclude_from_unified AND user_id IS NOT NULL
+                GROUP BY user_id
+            ) AS counts
+            WHERE counts.user_id = inboxen_userprofile.user_id""",
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inboxen', '0023_inbox_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrphanCandidate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.PositiveSmallIntegerField(choices=[(0, 'Body'), (1, 'HeaderData')])),
+                ('object_id', models.IntegerField()),
+                ('queued', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inboxen', '0024_orphancandidate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnindexedEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email_id', models.IntegerField()),
+                ('queued', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
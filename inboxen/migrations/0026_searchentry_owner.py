@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('watson', '0001_initial'),
+        ('inboxen', '0025_unindexedemail'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "ALTER TABLE watson_searchentry ADD COLUMN owner_id integer NULL",
+            "ALTER TABLE watson_searchentry DROP COLUMN owner_id",
+        ),
+        migrations.RunSQL(
+            """UPDATE watson_searchentry SET owner_id = inboxen_inbox.user_id
+            FROM inboxen_email JOIN inboxen_inbox ON inboxen_inbox.id = inboxen_email.inbox_id
+            WHERE watson_searchentry.object_id_int = inboxen_email.id
+                AND watson_searchentry.content_type_id = (
+                    SELECT id FROM django_content_type WHERE app_label = 'inboxen' AND model = 'email'
+                )""",
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            """UPDATE watson_searchentry SET owner_id = inboxen_inbox.user_id
+            FROM inboxen_inbox
+            WHERE watson_searchentry.object_id_int = inboxen_inbox.id
+                AND watson_searchentry.content_type_id = (
+                    SELECT id FROM django_content_type WHERE app_label = 'inboxen' AND model = 'inbox'
+                )""",
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX watson_searchentry_owner_id ON watson_searchentry (owner_id)",
+            "DROP INDEX watson_searchentry_owner_id",
+        ),
+        # watson writes search entries in several ways, so a trigger is the
+        # only way to be sure every entry gets an owner
+        migrations.RunSQL(
+            """CREATE FUNCTION inboxen_searchentry_owner() RETURNS trigger AS $$
+            BEGIN
+                IF NEW.content_type_id = (
+                    SELECT id FROM django_content_type WHERE app_label = 'inboxen' AND model = 'email'
+                ) THEN
+                    NEW.owner_id := (
+                        SELECT inboxen_inbox.user_id FROM inboxen_email
+                        JOIN inboxen_inbox ON inboxen_inbox.id = inboxen_email.inbox_id
+                        WHERE inboxen_email.id = NEW.object_id_int
+                    );
+                ELSIF NEW.content_type_id = (
+                    SELECT id FROM django_content_type WHERE app_label = 'inboxen' AND model = 'inbox'
+                ) THEN
+                    NEW.owner_id := (SELECT user_id FROM inboxen_inbox WHERE id = NEW.object_id_int);
+                END IF;
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql""",
+            "DROP FUNCTION inboxen_searchentry_owner()",
+        ),
+        migrations.RunSQL(
+            """CREATE TRIGGER inboxen_searchentry_owner BEFORE INSERT OR UPDATE
+            ON watson_searchentry FOR EACH ROW EXECUTE PROCEDURE inboxen_searchentry_owner()""",
+            "DROP TRIGGER inboxen_searchentry_owner ON watson_searchentry",
+        ),
+    ]
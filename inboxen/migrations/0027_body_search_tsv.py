@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inboxen', '0026_searchentry_owner'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='body',
+            name='search_tsv',
+            field=django.contrib.postgres.search.SearchVectorField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='body',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_tsv'], name='inboxen_body_search_tsv_idx'),
+        ),
+    ]
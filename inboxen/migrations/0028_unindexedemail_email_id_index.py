@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inboxen', '0027_body_search_tsv'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='unindexedemail',
+            name='email_id',
+            field=models.IntegerField(db_index=True),
+        ),
+    ]
@@ -17,25 +17,65 @@
 #    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+from io import BytesIO
 import os.path
 import re
 
 from annoying.fields import AutoOneToOneField, JSONField
 from bitfield import BitField
 from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
+from django.db.models.functions import Substr
+from django.utils import timezone
 from django.utils.encoding import smart_str
 from django.utils.functional import cached_property
 from django.utils.translation import ugettext as _
 from mptt.models import MPTTModel, TreeForeignKey
 import six
 
-from inboxen.managers import BodyQuerySet, DomainQuerySet, EmailQuerySet, HeaderQuerySet, InboxQuerySet
+from inboxen.managers import (BodyQuerySet, DomainQuerySet, EmailQuerySet, HeaderDataQuerySet, HeaderNameQuerySet,
+                              HeaderQuerySet, InboxQuerySet)
 from inboxen import validators
+from inboxen.utils.body_store import get_body_store
+from inboxen.utils.email import PREVIEW_LENGTH
 
 HEADER_PARAMS = re.compile(r'([a-zA-Z0-9]+)=["\']?([^"\';=]+)["\']?[;]?')
 
 
+def parse_content_headers(part_headers, is_leaf):
+    """Split Content-Type and Content-Disposition headers out into useful
+    bits, e.g. filename, charset, etc.
+
+    `part_headers` is a dictionary of header names and values
+    """
+    data = {}
+    part_headers = dict(part_headers)
+
+    # split off the parameters from the actual content type
+    content_header = part_headers.pop("Content-Type", u"").split(";", 1)
+    data['content_type'] = content_header[0]
+    content_params = content_header[1] if len(content_header) > 1 else u""
+
+    if not is_leaf:
+        # only leaf nodes will have things like charsets and filenames
+        return data
+
+    dispos = part_headers.pop("Content-Disposition", u"")
+
+    params = dict(HEADER_PARAMS.findall(content_params))
+    params.update(dict(HEADER_PARAMS.findall(dispos)))
+
+    # find filename, could be anywhere, could be nothing
+    data["filename"] = params.get("filename") or params.get("name") or u""
+
+    # grab charset
+    data["charset"] = params.get("charset", u"utf-8")
+
+    return data
+
+
 @six.python_2_unicode_compatible
 class UserProfile(models.Model):
     """User profile
@@ -58,6 +98,10 @@ class UserProfile(models.Model):
                                         help_text=_("Prefer a particular domain when adding a new Inbox"))
     prefer_html_email = models.BooleanField(default=True, verbose_name=_("Prefer HTML emails"))
     unified_has_new_messages = models.BooleanField(default=False)
+    # emails in the Unified Inbox, see inboxen.utils.counters
+    total_count = models.IntegerField(default=0)
+    unseen_count = models.IntegerField(default=0)
+    unread_count = models.IntegerField(default=0)
     display_images = models.PositiveSmallIntegerField(
         choices=IMAGE_OPTIONS, default=ASK,
         verbose_name=_("Display options for HTML emails"),
@@ -152,11 +196,19 @@ class Inbox(models.Model):
     * "new" should be set when an email is added to the inbox and unset when
       the inbox is viewed
     * "disabled" is a bit like "deleted", but incoming mail will be deffered, not rejected
+
+    `total_count`, `unseen_count` and `unread_count` count emails that haven't
+    been deleted, see inboxen.utils.counters
     """
     inbox = models.CharField(max_length=64, validators=[validators.ProhibitNullCharactersValidator()])
     domain = models.ForeignKey(Domain, on_delete=models.PROTECT)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.SET_NULL)
     created = models.DateTimeField('Created')
+    # when the last email was received, or when the Inbox was created
+    last_activity = models.DateTimeField(default=timezone.now)
+    total_count = models.IntegerField(default=0)
+    unseen_count = models.IntegerField(default=0)
+    unread_count = models.IntegerField(default=0)
     flags = BitField(flags=("deleted", "new", "exclude_from_unified", "disabled", "pinned"), default=0)
     description = models.CharField(max_length=256, null=True, blank=True,
                                    validators=[validators.ProhibitNullCharactersValidator()])
@@ -188,6 +240,10 @@ class Inbox(models.Model):
     class Meta:
         verbose_name_plural = "Inboxes"
         unique_together = (('inbox', 'domain'),)
+        indexes = [
+            # the order inboxes are displayed on the user's home page
+            models.Index(fields=["user", "-pinned", "disabled", "-last_activity"], name="inboxen_inbox_home_idx"),
+        ]
 
 ##
 # Email models
@@ -233,9 +289,24 @@ class Email(models.Model):
         """Fetches the MIME tree of the email and returns the root part.
 
         All subsequent calls to `part.parent` or `part.get_children()` will not
-        cause additional database queries
+        cause additional database queries. The Content-Type and
+        Content-Disposition headers of every part are fetched in a single
+        query, and body data is only fetched when it's used.
         """
-        root_parts = self.parts.all().get_cached_trees()
+        parts = self.parts.select_related("body").defer("body__data")
+        root_parts = parts.get_cached_trees()
+
+        all_parts = []
+        to_walk = list(root_parts)
+        while to_walk:
+            part = to_walk.pop()
+            all_parts.append(part)
+            to_walk.extend(part.get_children())
+
+        headers = Header.objects.filter(part_id__in=[part.id for part in all_parts])
+        headers = headers.get_many("Content-Type", "Content-Disposition", group_by="part_id")
+        for part in all_parts:
+            part.set_content_headers(headers.get(part.id, {}))
 
         assert len(root_parts) <= 1, "Expected to find a single part, found %s" % len(root_parts)
 
@@ -245,6 +316,26 @@ class Email(models.Model):
             return None
 
 
+@six.python_2_unicode_compatible
+class EmailSummary(models.Model):
+    """Details of an Email needed to display it in a list
+
+    Saves having to fetch headers for every email on a page. Created by
+    make_email, older emails can be summarised with `./manage.py
+    summarise_emails`
+    """
+    email = models.OneToOneField(Email, primary_key=True, related_name="summary", on_delete=models.CASCADE)
+    subject = models.TextField(default="")
+    sender = models.TextField(default="")
+    # total size of all bodies, in bytes
+    size = models.PositiveIntegerField(default=0)
+    attachment_count = models.PositiveIntegerField(default=0)
+    preview = models.CharField(max_length=PREVIEW_LENGTH, default="")
+
+    def __str__(self):
+        return u"{0}".format(self.email_id)
+
+
 @six.python_2_unicode_compatible
 class Body(models.Model):
     """Body model
@@ -258,14 +349,73 @@ class Body(models.Model):
                               validators=[validators.ProhibitNullCharactersValidator()])  # <algo>:<hash>
     data = models.BinaryField(default="")
     size = models.PositiveIntegerField(null=True)
+    # if True, `data` is empty and the real data is in the body store
+    in_store = models.BooleanField(default=False)
+    # text of plain text and HTML bodies, see inboxen.search.index_bodies
+    search_tsv = SearchVectorField(null=True)
+
+    # default size of chunks read by Body.chunks
+    CHUNK_SIZE = 256 * 1024
 
     objects = BodyQuerySet.as_manager()
 
+    class Meta:
+        indexes = [
+            GinIndex(fields=["search_tsv"], name="inboxen_body_search_tsv_idx"),
+        ]
+
     def save(self, *args, **kwargs):
         if self.size is None:
             self.size = len(self.data)
         return super(Body, self).save(*args, **kwargs)
 
+    def open(self):
+        """Returns a file-like object for reading this body's data"""
+        if self.in_store:
+            return get_body_store().open(self.hashed)
+        else:
+            return BytesIO(six.binary_type(self.data or b""))
+
+    def get_data(self):
+        """Returns this body's data as bytes, wherever it is kept"""
+        if self.in_store:
+            with self.open() as body_file:
+                return body_file.read()
+        else:
+            return six.binary_type(self.data or b"")
+
+    def chunks(self, start=0, end=None, chunk_size=None):
+        """Yields data from `start` up to (but not including) `end` in pieces
+        of at most `chunk_size` bytes
+
+        Only one chunk is held in memory at a time. For bodies kept in the
+        database each chunk is a separate query, so `data` can be deferred.
+        """
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        if end is None:
+            end = self.size
+
+        if self.in_store:
+            with self.open() as body_file:
+                body_file.seek(start)
+                while start < end:
+                    chunk = body_file.read(min(chunk_size, end - start))
+                    if not chunk:
+                        break
+                    start += len(chunk)
+                    yield chunk
+        else:
+            qs = Body.objects.filter(pk=self.pk)
+            while start < end:
+                length = min(chunk_size, end - start)
+                # SUBSTRING is 1-indexed
+                chunk = qs.annotate(chunk=Substr("data", start + 1, length, output_field=models.BinaryField()))
+                chunk = six.binary_type(chunk.values_list("chunk", flat=True).get() or b"")
+                if not chunk:
+                    break
+                start += len(chunk)
+                yield chunk
+
     def __str__(self):
         return self.hashed
 
@@ -294,30 +444,13 @@ class PartList(MPTTModel):
 
         Properties content_type, filename, and charset use this cached property.
         """
-        data = {}
-        part_headers = self.header_set.get_many("Content-Type", "Content-Disposition")
-
-        # split off the parameters from the actual content type
-        content_header = part_headers.pop("Content-Type", u"").split(";", 1)
-        data['content_type'] = content_header[0]
-        content_params = content_header[1] if len(content_header) > 1 else u""
-
-        if not self.is_leaf_node():
-            # only leaf nodes will have things like charsets and filenames
-            return data
-
-        dispos = part_headers.pop("Content-Disposition", u"")
+        return parse_content_headers(self.header_set.get_many("Content-Type", "Content-Disposition"),
+                                     self.is_leaf_node())
 
-        params = dict(HEADER_PARAMS.findall(content_params))
-        params.update(dict(HEADER_PARAMS.findall(dispos)))
-
-        # find filename, could be anywhere, could be nothing
-        data["filename"] = params.get("filename") or params.get("name") or u""
-
-        # grab charset
-        data["charset"] = params.get("charset", u"utf-8")
-
-        return data
+    def set_content_headers(self, part_headers):
+        """Fill the content header cache with headers that have already been
+        fetched, see Email.get_parts"""
+        self.__dict__["_content_headers_cache"] = parse_content_headers(part_headers, self.is_leaf_node())
 
     @property
     def content_type(self):
@@ -340,6 +473,8 @@ class HeaderName(models.Model):
     """
     name = models.CharField(max_length=78, unique=True, validators=[validators.ProhibitNullCharactersValidator()])
 
+    objects = HeaderNameQuerySet.as_manager()
+
     def __str__(self):
         return self.name
 
@@ -354,6 +489,8 @@ class HeaderData(models.Model):
                               validators=[validators.ProhibitNullCharactersValidator()])  # <algo>:<hash>
     data = models.TextField(validators=[validators.ProhibitNullCharactersValidator()])
 
+    objects = HeaderDataQuerySet.as_manager()
+
     def __str__(self):
         return self.hashed
 
@@ -376,3 +513,41 @@ class Header(models.Model):
 
     def __str__(self):
         return u"{0}".format(self.name.name)
+
+
+@six.python_2_unicode_compatible
+class OrphanCandidate(models.Model):
+    """A Body or HeaderData that may no longer be used by any email
+
+    Queued when emails are deleted (see inboxen.utils.deletion) and checked
+    by inboxen.tasks.collect_orphans, so only rows that might have become
+    orphans need to be looked at. inboxen.tasks.clean_orphan_models sweeps
+    whole tables to catch anything that was deleted some other way.
+    """
+    BODY = 0
+    HEADER_DATA = 1
+    KIND_CHOICES = (
+        (BODY, "Body"),
+        (HEADER_DATA, "HeaderData"),
+    )
+
+    kind = models.PositiveSmallIntegerField(choices=KIND_CHOICES)
+    object_id = models.IntegerField()
+    queued = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return u"{0} {1}".format(self.get_kind_display(), self.object_id)
+
+
+@six.python_2_unicode_compatible
+class UnindexedEmail(models.Model):
+    """An Email that has arrived but isn't in the search index yet
+
+    Queued by the router rather than indexing mail as it's delivered, so that
+    inboxen.tasks.index_emails can index many emails at once.
+    """
+    email_id = models.IntegerField(db_index=True)
+    queued = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return six.text_type(self.email_id)
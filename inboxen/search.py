@@ -17,11 +17,30 @@
 #    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+from django.conf import settings
+from django.contrib.postgres.search import SearchVector
+from django.db.models import TextField, Value
 from six.moves import urllib
 from watson import search
+from watson.backends import PostgresSearchBackend
 import six
 
-from inboxen.utils.email import unicode_damnit
+from inboxen.utils.email import extract_text, unicode_damnit
+
+# watson's engine, only entries with this slug are searched
+DEFAULT_ENGINE = "default"
+
+# leaf parts with these content types are searchable, "" is a non-MIME email
+TEXT_CONTENT_TYPES = ["", "text/plain", "text/html"]
+
+# bodies of the email an entry belongs to that match a query, with {select}
+# filled in as needed
+BODY_MATCH_SQL = """
+    SELECT {select} FROM inboxen_partlist
+    JOIN inboxen_body ON inboxen_body.id = inboxen_partlist.body_id
+    WHERE inboxen_partlist.email_id = watson_searchentry.object_id_int
+        AND inboxen_body.search_tsv @@ to_tsquery('{search_config}', %s)
+"""
 
 
 def create_search_cache_key(user_id, search_term, before, after):
@@ -31,10 +50,153 @@ def create_search_cache_key(user_id, search_term, before, after):
     return key
 
 
+def bulk_update_index(model, objects, engine_slug=DEFAULT_ENGINE):
+    """Replace the search entries of `objects`, which must be instances of
+    `model`, returns the number of entries created
+
+    Watson updates the index one object at a time with a query or two each,
+    this does the same job with one DELETE and a bulk INSERT. Adapters
+    should be able to work from objects fetched with select_related, and can
+    fetch anything else for all objects at once in a `prefetch` method.
+
+    `engine_slug` is only needed to build an index that isn't in use yet, see
+    the rebuild_index command.
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from watson.models import SearchEntry
+
+    adapter = search.get_adapter(model)
+    content_type = ContentType.objects.get_for_model(model)
+    title_length = SearchEntry._meta.get_field("title").max_length
+
+    objects = list(objects)
+    if hasattr(adapter, "prefetch"):
+        adapter.prefetch(objects)
+
+    entries = SearchEntry.objects.filter(engine_slug=engine_slug, content_type=content_type)
+    entries.filter(object_id_int__in=[obj.pk for obj in objects]).delete()
+
+    entries = [SearchEntry(
+        engine_slug=engine_slug,
+        content_type=content_type,
+        object_id=six.text_type(obj.pk),
+        object_id_int=obj.pk,
+        title=adapter.get_title(obj)[:title_length],
+        description=adapter.get_description(obj),
+        content=adapter.get_content(obj),
+        url=adapter.get_url(obj),
+        meta_encoded=adapter.serialize_meta(obj),
+    ) for obj in objects]
+    SearchEntry.objects.bulk_create(entries)
+
+    return len(entries)
+
+
+def index_bodies(email_ids):
+    """Add the text of plain text and HTML bodies of emails to the body search
+    index, returns the number of bodies indexed
+
+    Bodies are shared between emails, so ones that have already been indexed
+    are skipped. Only the first SEARCH_BODY_SIZE bytes of each are read.
+    """
+    from inboxen.models import Body, Header, PartList
+
+    if settings.SEARCH_BODY_SIZE <= 0:
+        return 0
+
+    parts = PartList.objects.filter(email_id__in=email_ids, body__search_tsv__isnull=True)
+    parts = [part for part in parts.select_related("body").defer("body__data") if part.is_leaf_node()]
+    headers = Header.objects.filter(part_id__in=[part.id for part in parts])
+    headers = headers.get_many("Content-Type", "Content-Disposition", group_by="part_id")
+
+    bodies = {}
+    for part in parts:
+        part.set_content_headers(headers.get(part.id, {}))
+        if part.content_type in TEXT_CONTENT_TYPES and not part.filename:
+            bodies[part.body_id] = part
+
+    search_config = PostgresSearchBackend.search_config
+    for body_id, part in bodies.items():
+        data = b"".join(part.body.chunks(0, settings.SEARCH_BODY_SIZE))
+        text = Value(extract_text(data, part.content_type, part.charset), output_field=TextField())
+        # same weight watson gives to content
+        Body.objects.filter(id=body_id).update(search_tsv=SearchVector(text, config=search_config, weight="D"))
+
+    return len(bodies)
+
+
+class BodySearchBackend(PostgresSearchBackend):
+    """Matches and ranks emails on their bodies as well as their search
+    entries, see index_bodies
+
+    Use this with a queryset that has already been narrowed down to one user,
+    so that only their bodies are looked at
+    """
+    def _email_type_id(self):
+        from django.contrib.contenttypes.models import ContentType
+        from inboxen.models import Email
+
+        return ContentType.objects.get_for_model(Email).id
+
+    def do_search(self, engine_slug, queryset, search_text):
+        query = self.escape_postgres_query(search_text)
+        body_sql = BODY_MATCH_SQL.format(select="1", search_config=self.search_config)
+        where = "(watson_searchentry.search_tsv @@ to_tsquery('{}', %s) OR " \
+                "(watson_searchentry.content_type_id = %s AND EXISTS ({})))".format(self.search_config, body_sql)
+
+        return queryset.extra(where=[where], params=[query, self._email_type_id(), query])
+
+    def do_search_ranking(self, engine_slug, queryset, search_text):
+        query = self.escape_postgres_query(search_text)
+        body_rank = "MAX(ts_rank_cd(inboxen_body.search_tsv, to_tsquery('{}', %s)))".format(self.search_config)
+        body_sql = BODY_MATCH_SQL.format(select=body_rank, search_config=self.search_config)
+        rank = "ts_rank_cd(watson_searchentry.search_tsv, to_tsquery('{}', %s)) + " \
+               "CASE WHEN watson_searchentry.content_type_id = %s THEN COALESCE(({}), 0) ELSE 0 END".format(
+                   self.search_config, body_sql)
+
+        return queryset.extra(
+            select={"watson_rank": rank},
+            select_params=[query, self._email_type_id(), query, query],
+            order_by=["-watson_rank"],
+        )
+
+
 class EmailSearchAdapter(search.SearchAdapter):
+    def prefetch(self, objs):
+        """Give emails that haven't been summarised a summary with just their
+        subject and sender, using one query for all of them
+
+        The summaries aren't saved, see the summarise_emails command for that
+        """
+        from inboxen.models import EmailSummary, Header
+
+        missing = {}
+        for obj in objs:
+            try:
+                obj.summary
+            except EmailSummary.DoesNotExist:
+                missing[obj.id] = obj
+
+        if len(missing) == 0:
+            return
+
+        headers = Header.objects.filter(part__parent__isnull=True, part__email_id__in=list(missing.keys()))
+        headers = headers.get_many("Subject", "From", group_by="part__email_id")
+        for email_id, obj in missing.items():
+            email_headers = headers.get(email_id, {})
+            obj.summary = EmailSummary(
+                subject=unicode_damnit(email_headers.get("Subject", u"")),
+                sender=unicode_damnit(email_headers.get("From", u"")),
+            )
+
     def get_title(self, obj):
         """Fetch subject for obj"""
-        from inboxen.models import HeaderData
+        from inboxen.models import EmailSummary, HeaderData
+
+        try:
+            return obj.summary.subject
+        except EmailSummary.DoesNotExist:
+            pass
 
         try:
             subject = HeaderData.objects.filter(
@@ -48,8 +210,13 @@ class EmailSearchAdapter(search.SearchAdapter):
             return u""
 
     def get_description(self, obj):
-        """"""
-        from inboxen.models import HeaderData
+        """Fetch sender for obj"""
+        from inboxen.models import EmailSummary, HeaderData
+
+        try:
+            return obj.summary.sender
+        except EmailSummary.DoesNotExist:
+            pass
 
         try:
             from_header = HeaderData.objects.filter(
@@ -38,6 +38,9 @@ COLUMN_HASHER = "sha1"
 # passed directly to get_random_string when creating an Inbox
 INBOX_CHOICES = string.ascii_lowercase
 
+# maximum number of header names each process keeps in memory
+HEADER_NAME_CACHE_SIZE = 1000
+
 ##
 # To override the following settings, create a separate settings module.
 # Import this module, override what you need to and set the environment
@@ -75,14 +78,41 @@ CELERY_BEAT_SCHEDULE = {
     },
     'cleanup': {
         'task': 'inboxen.tasks.clean_orphan_models',
-        'schedule': datetime.timedelta(days=1),
+        'schedule': datetime.timedelta(days=7),
+    },
+    'orphans': {
+        'task': 'inboxen.tasks.collect_orphans',
+        'schedule': datetime.timedelta(minutes=1),
     },
     'sessions': {
         'task': 'inboxen.tasks.clean_expired_session',
         'schedule': datetime.timedelta(days=1),
     },
+    'counters': {
+        'task': 'inboxen.tasks.reconcile_counters',
+        'schedule': datetime.timedelta(days=1),
+    },
+    'index': {
+        'task': 'inboxen.tasks.index_emails',
+        'schedule': datetime.timedelta(seconds=5),
+    },
 }
 
+if STATISTICS_INTERVAL == "hourly":  # noqa: F405
+    CELERY_BEAT_SCHEDULE['statistics']['schedule'] = datetime.timedelta(hours=1)
+
+if FLAG_BUFFER:  # noqa: F405
+    CELERY_BEAT_SCHEDULE['flags'] = {
+        'task': 'inboxen.tasks.flush_flags',
+        'schedule': datetime.timedelta(seconds=10),
+    }
+
+if ROUTER_USE_SPOOL:  # noqa: F405
+    CELERY_BEAT_SCHEDULE['router-spool'] = {
+        'task': 'router.tasks.drain_spool',
+        'schedule': datetime.timedelta(seconds=10),
+    }
+
 ##
 # Django options
 ##
@@ -19,8 +19,29 @@
 
 from django.conf import settings
 from django.contrib import messages
+from django.db import transaction
+
+from inboxen.utils.body_store import get_body_store, lock_body
 
 
 def logout_message(sender, request, **kwargs):
     msg = getattr(request, "_logout_message", settings.LOGOUT_MSG)
     messages.add_message(request, messages.INFO, msg)
+
+
+def delete_body_from_store(sender, instance, **kwargs):
+    """Remove data from the body store once its Body has gone"""
+    if not instance.in_store:
+        return
+
+    hashed = instance.hashed
+
+    def delete():
+        # the same body might have been received again in the meantime, the
+        # lock waits for anyone who is still saving it
+        with transaction.atomic():
+            lock_body(hashed, exclusive=True)
+            if not sender.objects.filter(hashed=hashed).exists():
+                get_body_store().delete(hashed)
+
+    transaction.on_commit(delete)
@@ -5,28 +5,29 @@
 
 (function($) {
     'use strict';
-    var timer;
+    // wait between checks, doubling each time up to the maximum
+    var minDelay = 500;
+    var maxDelay = 8000;
 
-    function areWeReadyYet($refreshNote, $searchInfo, timer) {
+    function areWeReadyYet($refreshNote, $searchInfo, delay) {
         var http = new XMLHttpRequest();
         http.open("HEAD", $refreshNote.data("url"), true);
         http.onload = function (e) {
             if (http.readyState > 2) {
                 if (http.status == 202) {
-                    // not done
+                    // not done, ask again later
                     $refreshNote.html("");
+                    var nextDelay = Math.min(delay * 2, maxDelay);
+                    setTimeout(function(){areWeReadyYet($refreshNote, $searchInfo, nextDelay);}, nextDelay);
                 } else if (http.status == 201) {
                     // done!
-                    clearInterval(timer);
                     $refreshNote.html("Loading results…");
                     location.reload(true);
                 } else if (http.status == 400) {
-                    clearInterval(timer);
                     $searchInfo.html("The search timed out. Please try again.");
                     $searchInfo.addClass("alert alert-warning");
                     console.error("Server says there is no such search");
                 } else {
-                    clearInterval(timer);
                     $searchInfo.html("Something went wrong while searching. Please try again later.");
                     $searchInfo.addClass("alert alert-warning");
                     console.error("Unexpected response code");
@@ -47,6 +48,5 @@
         return;
     }
     $refreshNote.html("");
-    // poll the server every 7000 ms
-    timer = setInterval(function(){areWeReadyYet($refreshNote, $searchInfo, timer);}, 7000);
+    setTimeout(function(){areWeReadyYet($refreshNote, $searchInfo, minDelay);}, minDelay);
 })(jQuery);
@@ -21,42 +21,110 @@ from datetime import timedelta
 from importlib import import_module
 import gc
 import logging
+import math
+import numbers
+import time
 
 from cursor_pagination import CursorPaginator
 from django.apps import apps
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.cache import cache
-from django.db import IntegrityError, transaction
-from django.db.models import Avg, Case, Count, F, Max, Min, StdDev, Sum, When
-from django.db.models.functions import Coalesce
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import (Avg, BigIntegerField, Case, Count, F, IntegerField, Max, Min, OuterRef, Q, StdDev,
+                              Subquery, Sum, When)
+from django.db.models.functions import Cast, Coalesce
 from django.utils import timezone
+from lxml import etree
 from watson import search as watson_search
 
 from inboxen import models
 from inboxen.celery import app
-from inboxen.search import create_search_cache_key
-from inboxen.utils.tasks import task_group_skew
+from inboxen.search import bulk_update_index, create_search_cache_key, index_bodies
+from inboxen.utils.counters import update_counters
+from inboxen.utils.deletion import DELETE_BATCH_SIZE, delete_in_batches
+from inboxen.utils.email import render_html_part
+from inboxen.utils.flag_buffer import pop_buffered_flags
+from inboxen.utils.stats import clear_stats_cache
 
 
 log = logging.getLogger(__name__)
 
 SEARCH_TIMEOUT = 60 * 30
 SEARCH_PAGE_SIZE = 25
+# milliseconds, leaves time for a header only search before SearchView gives up waiting
+SEARCH_BODY_TIMEOUT = 600
+INDEX_BATCH_SIZE = 500
 
+ORPHAN_BATCH_SIZE = 5000
+# seconds to wait before collect_orphans carries on with a long queue
+ORPHAN_COUNTDOWN = 5
 
-@app.task(ignore_result=True)
-@transaction.atomic()
-def statistics():
-    """Gather statistics about users and their inboxes"""
-    try:
-        last_stat = models.Statistic.objects.latest("date")
-    except models.Statistic.DoesNotExist:
-        last_stat = None
 
-    # the keys of these dictionaries have awful names for historical reasons
-    # don't change them unless you want to do a data migration
-    one_day_ago = timezone.now() - timedelta(days=1)
+def _describe(prefix, count, total, total_sq, minimum, maximum):
+    """Summary statistics for `count` values, standard deviation is worked out
+    from the sum of squares"""
+    keys = ["avg", "max", "min", "stddev", "sum"]
+    if count == 0:
+        return {"{}__{}".format(prefix, key): 0 for key in keys}
+
+    avg = total / float(count)
+    # population standard deviation, same as StdDev
+    variance = max(total_sq / float(count) - avg ** 2, 0)
+    values = [avg, maximum, minimum, math.sqrt(variance), total]
+
+    return {"{}__{}".format(prefix, key): value for key, value in zip(keys, values)}
+
+
+def _rollup_statistics(one_day_ago):
+    """Calculate statistics from the counters kept on each Inbox, without
+    touching the email table"""
+    users = get_user_model().objects.aggregate(
+        count=Count("id"),
+        new=Count(Case(When(date_joined__gte=one_day_ago, then=1))),
+        oldest_user_joined=Min("date_joined"),
+    )
+
+    # one row per user with inboxes
+    inbox_counts = models.Inbox.objects.filter(user__isnull=False).order_by().values("user_id")
+    inbox_counts = inbox_counts.annotate(count=Count("id")).values_list("count", flat=True)
+    total = total_sq = maximum = with_inboxes = 0
+    minimum = None
+    for count in inbox_counts.iterator():
+        total += count
+        total_sq += count ** 2
+        maximum = max(maximum, count)
+        minimum = count if minimum is None else min(minimum, count)
+        with_inboxes += 1
+
+    if with_inboxes < users["count"] or minimum is None:
+        # some users have no inboxes at all
+        minimum = 0
+
+    users["with_inboxes"] = with_inboxes
+    inboxes = _describe("inbox_count", users["count"], total, total_sq, minimum, maximum)
+
+    email_count = Cast("total_count", BigIntegerField())
+    counts = models.Inbox.objects.exclude(deleted=True).aggregate(
+        count=Count("id"),
+        total=Coalesce(Sum(email_count), 0),
+        total_sq=Coalesce(Sum(email_count * email_count), 0),
+        minimum=Coalesce(Min("total_count"), 0),
+        maximum=Coalesce(Max("total_count"), 0),
+        with_emails=Count(Case(When(total_count__gt=0, then=1))),
+        unread=Coalesce(Sum(Cast("unread_count", BigIntegerField())), 0),
+    )
+
+    inboxes["with_emails"] = counts["with_emails"]
+    emails = _describe("email_count", counts["count"], counts["total"], counts["total_sq"], counts["minimum"],
+                       counts["maximum"])
+    emails["emails_read"] = counts["total"] - counts["unread"]
+
+    return users, inboxes, emails
+
+
+def _scan_statistics(one_day_ago):
+    """Calculate statistics by counting everything, see statistics"""
     user_aggregate = {
         "count": Count("id", distinct=True),
         "new": Coalesce(Count(
@@ -94,18 +162,66 @@ def statistics():
     users = get_user_model().objects.aggregate(**user_aggregate)
     inboxes = get_user_model().objects.annotate(inbox_count=Count("inbox__id")).aggregate(**inbox_aggregate)
 
-    domain_count = models.Domain.objects.available(None).count()
-    inboxes_possible = len(settings.INBOX_CHOICES) ** settings.INBOX_LENGTH
-
-    inboxes["total_possible"] = inboxes_possible * domain_count
-
     # collect email state
-    inbox_qs = models.Inbox.objects.exclude(deleted=True).annotate(email_count=Count("email__id"))
+    emails_qs = models.Email.objects.filter(deleted=False)
+    inbox_qs = models.Inbox.objects.exclude(deleted=True)
+    inbox_qs = inbox_qs.annotate(email_count=Count(Case(When(email__deleted=False, then=F("email__id")))))
     emails = inbox_qs.aggregate(**email_aggregate)
 
     inboxes["with_emails"] = inbox_qs.exclude(email_count=0).count()
+    emails["emails_read"] = emails_qs.filter(read=True, inbox__deleted=False).count()
+
+    return users, inboxes, emails
+
+
+def _statistics_match(first, second):
+    if isinstance(first, numbers.Number) and isinstance(second, numbers.Number):
+        return abs(first - second) <= 1e-6 * max(1, abs(first), abs(second))
+    return first == second
+
+
+@app.task(ignore_result=True)
+def statistics(verify=False):
+    """Gather statistics about users and their inboxes
+
+    Email figures are rolled up from the counters kept on each Inbox (see
+    inboxen.utils.counters) rather than counted. If `verify` is True,
+    everything is counted from scratch as well, any differences are logged
+    and the counted figures are saved.
+    """
+    _save_statistics(verify)
+
+    # only once the new Statistic has been committed, otherwise the stats page
+    # could cache the old one again
+    clear_stats_cache()
+
+
+@transaction.atomic()
+def _save_statistics(verify):
+    try:
+        last_stat = models.Statistic.objects.latest("date")
+    except models.Statistic.DoesNotExist:
+        last_stat = None
+
+    # the keys of these dictionaries have awful names for historical reasons
+    # don't change them unless you want to do a data migration
+    one_day_ago = timezone.now() - timedelta(days=1)
+    users, inboxes, emails = _rollup_statistics(one_day_ago)
+
+    if verify:
+        counted = _scan_statistics(one_day_ago)
+        for name, rolled_up, counted_stats in zip(["users", "inboxes", "emails"], [users, inboxes, emails], counted):
+            for key, value in counted_stats.items():
+                if not _statistics_match(value, rolled_up.get(key)):
+                    log.warning("Statistic %s.%s was %r from counters but %r when counted", name, key,
+                                rolled_up.get(key), value)
+        users, inboxes, emails = counted
+
+    domain_count = models.Domain.objects.available(None).count()
+    inboxes_possible = len(settings.INBOX_CHOICES) ** settings.INBOX_LENGTH
+
+    inboxes["total_possible"] = inboxes_possible * domain_count
     inboxes["disowned"] = models.Inbox.objects.filter(user__isnull=True).count()
-    emails["emails_read"] = models.Email.objects.filter(read=True).count()
 
     if last_stat:
         email_diff = (emails["email_count__sum"] or 0) - (last_stat.emails["email_count__sum"] or 0)
@@ -136,66 +252,115 @@ def clean_expired_session():
 
 
 @app.task(ignore_result=True)
-@transaction.atomic()
 def inbox_new_flag(user_id, inbox_id=None):
-    emails = models.Email.objects.order_by("-received_date")
-    emails = emails.filter(inbox__user__id=user_id, inbox__exclude_from_unified=False)
-    if inbox_id is not None:
-        emails = emails.filter(inbox__id=inbox_id)
-    emails = list(emails.values_list("id", flat=True)[:100])  # number of emails on page
-    emails = models.Email.objects.filter(id__in=emails, seen=False)
-
-    if emails.count() > 0:
-        # if some emails haven't been seen yet, we have nothing else to do
-        return
-    elif inbox_id is None:
-        profile = models.UserProfile.objects.get_or_create(user_id=user_id)[0]
-        profile.unified_has_new_messages = False
-        profile.save(update_fields=["unified_has_new_messages"])
+    """Unset the "new" flag of an Inbox (or the Unified Inbox if `inbox_id` is
+    None) once there are no unseen emails left in it"""
+    if inbox_id is None:
+        profile = models.UserProfile.objects.filter(user_id=user_id, unseen_count__lte=0)
+        profile.update(unified_has_new_messages=False)
     else:
-        with watson_search.skip_index_update():
-            inbox = models.Inbox.objects.get(user__id=user_id, id=inbox_id)
-            inbox.new = False
-            inbox.save(update_fields=["new"])
+        inbox = models.Inbox.objects.filter(user_id=user_id, id=inbox_id, unseen_count__lte=0)
+        inbox.update(new=False)
 
 
 @app.task(ignore_result=True)
 def deal_with_flags(email_id_list, user_id, inbox_id=None):
-    """Set seen flags on a list of email IDs and then send off tasks to update
+    """Set seen flags on a list of email IDs
+
+    Kept for tasks that were queued before flags were buffered, use
+    inboxen.utils.flag_buffer.buffer_flags instead
+    """
+    write_flags(user_id, email_id_list, [])
+
+
+@app.task(ignore_result=True)
+def write_flags(user_id, seen_ids, read_ids):
+    """Set seen and read flags on emails, update counters and then update
     "new" flags on affected Inbox objects
+
+    Only emails that need changing are written to
     """
+    # avoid joining on Inbox, otherwise those rows would be locked too
+    emails = models.Email.objects.filter(inbox__in=models.Inbox.objects.filter(user_id=user_id), deleted=False)
+    read_ids = set(read_ids)
     with transaction.atomic():
+        changed = emails.filter(Q(id__in=seen_ids, seen=False) | (Q(id__in=read_ids) & (Q(seen=False) | Q(read=False))))
+        changed = changed.select_for_update().values_list("id", "inbox_id", "seen", "read")
+
+        counts = {}
+        now_read = []
+        now_seen = []
+        for email_id, inbox_id, seen, read in changed:
+            total, unseen, unread = counts.get(inbox_id, (0, 0, 0))
+            if email_id in read_ids:
+                now_read.append(email_id)
+                unread += int(not read)
+            else:
+                now_seen.append(email_id)
+            unseen += int(not seen)
+            counts[inbox_id] = (total, unseen, unread)
+
         with watson_search.skip_index_update():
-            # update seen flags
-            models.Email.objects.filter(id__in=email_id_list).update(seen=True)
+            models.Email.objects.filter(id__in=now_read).update(read=True, seen=True)
+            models.Email.objects.filter(id__in=now_seen).update(seen=True)
 
-    if inbox_id is None:
-        # grab affected inboxes
-        inbox_list = models.Inbox.objects.filter(user__id=user_id, email__id__in=email_id_list)
-        inbox_list = inbox_list.distinct()
+        update_counters(counts, sign=-1)
 
-        for inbox in inbox_list:
-            inbox_new_flag.delay(user_id, inbox.id)
-    else:
-        # we only need to update
-        inbox_new_flag.delay(user_id)
+    inbox_list = [inbox_id for inbox_id, count in counts.items() if count[1] > 0]
+    if len(inbox_list) == 0:
+        # nothing was unseen, so "new" flags won't have changed
+        return
 
+    for inbox_id in inbox_list:
+        inbox_new_flag(user_id, inbox_id)
+    inbox_new_flag(user_id)
 
-@app.task(rate_limit="100/s")
-def search(user_id, search_term, before=None, after=None):
-    """Offload the expensive part of search to avoid blocking the web interface"""
-    if not search_term:
-        return {
-            "results": [],
-            "has_next": False
-        }
 
-    if before and after:
-        raise ValueError("You can't do this.")
+@app.task(ignore_result=True)
+def flush_flags():
+    """Write flag changes buffered by inboxen.utils.flag_buffer"""
+    for user_id, flags in pop_buffered_flags().items():
+        write_flags(user_id, list(flags["seen"]), list(flags["read"]))
 
+
+@app.task(ignore_result=True)
+def reconcile_counters(user_id=None):
+    """Recount emails for Inbox and Unified Inbox counters
+
+    Counters are updated as emails change, this repairs any drift
+    """
+    inboxes = models.Inbox.objects.all()
+    profiles = models.UserProfile.objects.all()
+    if user_id is not None:
+        inboxes = inboxes.filter(user_id=user_id)
+        profiles = profiles.filter(user_id=user_id)
+
+    with transaction.atomic():
+        inboxes.recount()
+
+        unified = models.Inbox.objects.filter(user_id=OuterRef("user_id"), deleted=False, exclude_from_unified=False)
+        unified = unified.order_by().values("user_id")
+
+        def counter(field):
+            count = unified.annotate(count=Sum(field)).values("count")
+            return Coalesce(Subquery(count, output_field=IntegerField()), 0)
+
+        profiles.update(
+            total_count=counter("total_count"),
+            unseen_count=counter("unseen_count"),
+            unread_count=counter("unread_count"),
+        )
+
+    log.info("Reconciled email counters")
+
+
+def _search_page(user_id, search_term, before, after, backend_name=None):
     email_subquery = models.Email.objects.viewable(user_id)
     inbox_subquery = models.Inbox.objects.viewable(user_id)
-    search_qs = watson_search.search(search_term, models=(email_subquery, inbox_subquery))
+    search_qs = watson_search.search(search_term, models=(email_subquery, inbox_subquery), backend_name=backend_name)
+    # owner_id is kept up to date by a trigger, see migration 0026. Filtering on
+    # it means only this user's entries need to be ranked
+    search_qs = search_qs.extra(where=["watson_searchentry.owner_id = %s"], params=[user_id])
 
     page_kwargs = {
         "after": after,
@@ -219,12 +384,108 @@ def search(user_id, search_term, before=None, after=None):
         results["last"] = paginator.cursor(page[-1])
         results["first"] = paginator.cursor(page[0])
 
+    return results
+
+
+@app.task(ignore_result=True, rate_limit="100/s")
+def search(user_id, search_term, before=None, after=None):
+    """Offload the expensive part of search to avoid blocking the web interface
+
+    Results are only delivered via the cache, see SearchView. Email bodies are
+    searched too, unless that takes longer than SEARCH_BODY_TIMEOUT, in which
+    case only subjects, senders and inboxes are searched
+    """
+    if not search_term:
+        return {
+            "results": [],
+            "has_next": False
+        }
+
+    if before and after:
+        raise ValueError("You can't do this.")
+
     key = create_search_cache_key(user_id, search_term, before, after)
+    results = None
+    try:
+        if settings.SEARCH_BODY_SIZE > 0:
+            try:
+                with transaction.atomic():
+                    with connection.cursor() as cursor:
+                        cursor.execute("SET LOCAL statement_timeout = %s", [SEARCH_BODY_TIMEOUT])
+                    results = _search_page(user_id, search_term, before, after,
+                                           backend_name="inboxen.search.BodySearchBackend")
+            except OperationalError:
+                log.warning("Searching bodies took too long for user %s", user_id)
+
+        if results is None:
+            results = _search_page(user_id, search_term, before, after)
+    except Exception:
+        # remove the pending marker so the search can be tried again
+        cache.delete(key)
+        raise
+
     cache.set(key, results, SEARCH_TIMEOUT)
 
     return results
 
 
+@app.task(ignore_result=True)
+def index_emails(batch_size=INDEX_BATCH_SIZE):
+    """Add emails queued by the router to the search index
+
+    Carries on in a new task if there are more than `batch_size` emails
+    waiting, other workers skip over emails that are already being indexed.
+    """
+    start = time.time()
+    with transaction.atomic():
+        queued = models.UnindexedEmail.objects.select_for_update(skip_locked=True).order_by("id")
+        queued = list(queued.values_list("id", "email_id")[:batch_size])
+        if len(queued) == 0:
+            return
+
+        # lock emails so they can't be deleted before their entries are committed
+        emails = models.Email.objects.filter(id__in=[email_id for _, email_id in queued], deleted=False)
+        email_ids = list(emails.select_for_update().values_list("id", flat=True))
+        emails = models.Email.objects.filter(id__in=email_ids).select_related("summary", "inbox__domain")
+        indexed = bulk_update_index(models.Email, emails)
+
+        models.UnindexedEmail.objects.filter(id__in=[queued_id for queued_id, _ in queued]).delete()
+
+    # bodies are shared, so there's no need to lock them
+    bodies = index_bodies(email_ids)
+
+    elapsed = time.time() - start
+    log.info("Indexed %s of %s queued emails and %s bodies in %.2fs", indexed, len(queued), bodies, elapsed)
+
+    if len(queued) == batch_size:
+        index_emails.delay(batch_size=batch_size)
+
+
+@app.task(ignore_result=True)
+def prerender_emails(email_id_list):
+    """Render the text/html parts of some emails into the render cache
+
+    Only the default options are rendered, images are not displayed
+    """
+    parts = models.PartList.objects.filter(email_id__in=email_id_list).select_related("email", "body")
+    # the body is only needed if it's not already in the cache
+    parts = list(parts.defer("body__data"))
+
+    # fetch content headers for every part at once, as Email.get_parts does
+    headers = models.Header.objects.filter(part_id__in=[part.id for part in parts])
+    headers = headers.get_many("Content-Type", "Content-Disposition", group_by="part_id")
+
+    for part in parts:
+        part.set_content_headers(headers.get(part.id, {}))
+        if not part.is_leaf_node() or part.content_type != "text/html":
+            continue
+
+        try:
+            render_html_part(part, False, part.email.eid)
+        except (etree.LxmlError, ValueError) as exc:
+            log.debug("Failed to prerender %s: %s", part.email.eid, exc)
+
+
 @app.task(ignore_result=True)
 def force_garbage_collection():
     """Call the garbage collector.
@@ -236,6 +497,22 @@ def force_garbage_collection():
     log.info("GC collected {0} objects.".format(collected))
 
 
+@app.task(ignore_result=True)
+def delete_emails(kwargs, batch_size=DELETE_BATCH_SIZE):
+    """Delete emails that match `kwargs` in batches, along with their parts,
+    headers and search entries
+
+    Emails should have already been marked as deleted
+    """
+    emails = models.Email.objects.filter(**kwargs)
+
+    def progress(total):
+        log.info("Deleted %s emails matching %s", total, kwargs)
+
+    total = delete_in_batches(emails, batch_size=batch_size, progress=progress)
+    log.info("Finished deleting %s emails matching %s", total, kwargs)
+
+
 @app.task(rate_limit=500)
 @transaction.atomic()
 def delete_inboxen_item(model, item_pk):
@@ -248,18 +525,45 @@ def delete_inboxen_item(model, item_pk):
         pass
 
 
-@app.task(rate_limit="1/m")
-@transaction.atomic()
-def batch_delete_items(model, args=None, kwargs=None, batch_number=500):
+def _delete_unless_in_use(items):
+    """Delete `items` and return how many were deleted, skipping any that are
+    still protected by a foreign key
+
+    Must be called outside of a transaction, or in one where constraints are
+    checked immediately, so that errors are raised where they can be caught
+    """
+    label = items.model._meta.label
+    try:
+        with transaction.atomic():
+            return items.delete()[1].get(label, 0)
+    except IntegrityError:
+        # something has started using one of these objects, go one by one
+        deleted = 0
+        for pk in items.values_list("pk", flat=True):
+            try:
+                with transaction.atomic():
+                    deleted += items.filter(pk=pk).delete()[1].get(label, 0)
+            except IntegrityError:
+                pass
+        return deleted
+
+
+@app.task(ignore_result=True)
+def batch_delete_items(model, args=None, kwargs=None, batch_number=500, after=None, countdown=0):
     """If something goes wrong and you've got a lot of orphaned entries in the
     database, then this is the task you want.
 
-    Be aware: this task pulls a list of PKs from the database which may cause
-    increased memory use in the short term.
+    Objects are deleted in windows of `batch_number` rows in order of primary
+    key. Once a window has been deleted, the task sends itself off again with
+    `after` set to the last primary key it saw, so memory use stays the same
+    no matter how many objects match and an interrupted run can be picked up
+    again.
 
     * model is a string
     * args and kwargs should be obvious
-    * batch_number is the number of delete tasks that get sent off in one go
+    * batch_number is the number of objects deleted by each task
+    * after is the primary key to carry on from
+    * countdown is the number of seconds to wait between windows
     """
     _model = apps.get_app_config("inboxen").get_model(model)
 
@@ -270,18 +574,84 @@ def batch_delete_items(model, args=None, kwargs=None, batch_number=500):
     elif kwargs is None:
         kwargs = {}
 
-    items = _model.objects.only('pk').filter(*args, **kwargs)
-    items = [(model, item.pk) for item in items.iterator()]
-    if len(items) == 0:
+    start = time.time()
+
+    items = _model.objects.filter(*args, **kwargs)
+    if after is not None:
+        items = items.filter(pk__gt=after)
+    items = items.order_by("pk").values_list("pk", flat=True)[:batch_number]
+    pk_list = list(items.iterator())
+    if len(pk_list) == 0:
         return
 
-    items = delete_inboxen_item.chunks(items, batch_number).group()
-    task_group_skew(items, step=batch_number/10.0)
-    items.apply_async()
+    # filters are applied again in case something has changed since
+    items = _model.objects.filter(*args, **kwargs).filter(pk__in=pk_list)
+    if _model is models.Body:
+        # signal handlers don't need the data itself
+        items = items.defer("data")
+
+    deleted = _delete_unless_in_use(items)
+
+    elapsed = time.time() - start
+    log.info("Deleted %s %s objects up to pk %s in %.2fs (%.1f rows/s)", deleted, model, pk_list[-1], elapsed,
+             deleted / max(elapsed, 0.001))
+
+    if len(pk_list) == batch_number:
+        batch_delete_items.apply_async(
+            args=[model],
+            kwargs={"args": args, "kwargs": kwargs, "batch_number": batch_number, "after": pk_list[-1],
+                    "countdown": countdown},
+            countdown=countdown,
+        )
+
+
+@app.task(ignore_result=True)
+def collect_orphans(batch_size=ORPHAN_BATCH_SIZE):
+    """Delete queued Body and HeaderData objects that are no longer used
+
+    Only rows queued by inboxen.utils.deletion are checked, so the cost
+    depends on how much mail is deleted rather than how much is kept
+    """
+    orphans = {
+        # signal handlers don't need the data itself
+        models.OrphanCandidate.BODY: models.Body.objects.filter(partlist__isnull=True).defer("data"),
+        models.OrphanCandidate.HEADER_DATA: models.HeaderData.objects.filter(header__isnull=True),
+    }
+
+    start = time.time()
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            # see _delete_unless_in_use
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+
+        queued = models.OrphanCandidate.objects.select_for_update(skip_locked=True).order_by("id")
+        queued = list(queued.values_list("id", "kind", "object_id")[:batch_size])
+        if len(queued) == 0:
+            return
+
+        deleted = 0
+        for kind, items in orphans.items():
+            object_ids = set(object_id for _, queued_kind, object_id in queued if queued_kind == kind)
+            if len(object_ids) > 0:
+                deleted += _delete_unless_in_use(items.filter(id__in=object_ids))
+
+        models.OrphanCandidate.objects.filter(id__in=[queued_id for queued_id, _, _ in queued]).delete()
+
+    elapsed = time.time() - start
+    log.info("Checked %s orphan candidates, deleted %s in %.2fs", len(queued), deleted, elapsed)
+
+    if len(queued) == batch_size:
+        # there's more in the queue, but give other tasks a chance first
+        collect_orphans.apply_async(kwargs={"batch_size": batch_size}, countdown=ORPHAN_COUNTDOWN)
 
 
 @app.task(rate_limit="1/h")
 def clean_orphan_models():
+    """Sweep whole tables for objects that are no longer used
+
+    collect_orphans deals with emails deleted in the usual way, this catches
+    everything else
+    """
     # Body
     batch_delete_items.delay("body", kwargs={"partlist__isnull": True})
 
@@ -181,6 +181,12 @@ class SecureClient(test.Client):
 class InboxenTestCase(test.TestCase):
     client_class = SecureClient
 
+    def _pre_setup(self):
+        super(InboxenTestCase, self)._pre_setup()
+        # header name IDs cached by a previous test will have been rolled back
+        from inboxen.models import HeaderName
+        HeaderName.objects.clear_cache()
+
     def assertCountEqual(self, actual, expected, msg=None):
         if six.PY3:
             return super(InboxenTestCase, self).assertCountEqual(actual, expected, msg)
@@ -12,7 +12,11 @@ ASSETS_AUTO_BUILD = True
 CACHES = {
     "default": {
         "BACKEND": "django.core.cache.backends.locmem.LocMemCache"
-    }
+    },
+    "render": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "render",
+    },
 }
 
 # default to current user
@@ -31,3 +35,6 @@ DATABASES = {
 
 CELERY_TASK_ALWAYS_EAGER = True
 CELERY_TASK_EAGER_PROPAGATES = True
+
+# LocMemCache is shared by tests and eager tasks, so buffering works here
+FLAG_BUFFER = True
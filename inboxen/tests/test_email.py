@@ -19,14 +19,20 @@
 ##
 from __future__ import unicode_literals
 
+import shutil
+import tempfile
+
 from django.contrib.staticfiles.storage import staticfiles_storage
 from django.core import urlresolvers
+from django.core.cache import caches
 from salmon import mail
+from sendfile import _get_sendfile
 import six
 
 import mock
 
 from inboxen import models
+from inboxen.managers import header_name_cache
 from inboxen.tests import factories
 from inboxen.tests.example_emails import (
     BADLY_ENCODED_BODY,
@@ -44,8 +50,9 @@ from inboxen.tests.example_emails import (
     METALESS_BODY,
     UNSUPPORTED_CSS_BODY,
 )
-from inboxen.test import InboxenTestCase, MockRequest
+from inboxen.test import InboxenTestCase, MockRequest, override_settings
 from inboxen.utils import email as email_utils
+from inboxen.utils.body_store import get_body_store
 from router.app.helpers import make_email
 
 
@@ -406,6 +413,27 @@ class RealExamplesTestCase(InboxenTestCase):
         self.assertEqual(len(response.context["email"]["bodies"]), 1)
         self.assertEqual(response.context["email"]["bodies"][0], "<pre>Hi,\n\nHow are you?\n\nThanks,\nTest\n</pre>")
 
+    def test_get_parts_query_count(self):
+        for example in [EXAMPLE_ALT, EXAMPLE_DIGEST, EXAMPLE_SIGNED_FORWARDED_DIGEST, EXAMPLE_PREMIME_EMAIL]:
+            email = make_email(mail.MailRequest("", "", "", example), self.inbox)
+            # HeaderName IDs are only cached once the transaction is committed
+            header_name_cache.clear()
+
+            # parts, header name IDs and then headers, no matter how many parts
+            with self.assertNumQueries(3):
+                root_part = email.get_parts()
+
+            with self.assertNumQueries(0):
+                to_walk = [root_part]
+                while to_walk:
+                    part = to_walk.pop()
+                    to_walk.extend(part.get_children())
+                    # header cache should be filled and body data deferred
+                    self.assertIsNotNone(part.content_type)
+                    if part.is_leaf_node():
+                        self.assertIsNotNone(part.charset)
+                    self.assertIn("data", part.body.get_deferred_fields())
+
 
 class AttachmentTestCase(InboxenTestCase):
     def setUp(self):
@@ -452,8 +480,91 @@ class AttachmentTestCase(InboxenTestCase):
         else:
             self.assertEqual(response["Content-Disposition"], "attachment; filename=\"Växjö.jpg\"".encode("utf-8"))
 
+    def test_etag(self):
+        url = urlresolvers.reverse("email-attachment", kwargs={"attachmentid": self.part.id})
+        data = models.Body.objects.get(id=self.part.body_id).get_data()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], "\"{}\"".format(self.part.body.hashed))
+        self.assertEqual(b"".join(response.streaming_content), data)
+
+        with mock.patch.object(models.Body, "chunks") as chunks_mock:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], "\"{}\"".format(self.part.body.hashed))
+        self.assertFalse(chunks_mock.called)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH="\"sha1:something-else\"")
+        self.assertEqual(response.status_code, 200)
+
+    def test_range(self):
+        url = urlresolvers.reverse("email-attachment", kwargs={"attachmentid": self.part.id})
+        data = models.Body.objects.get(id=self.part.body_id).get_data()
+        size = len(data)
+
+        response = self.client.get(url, HTTP_RANGE="bytes=0-4")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), data[:5])
+        self.assertEqual(response["Content-Range"], "bytes 0-4/{}".format(size))
+        self.assertEqual(response["Content-Length"], "5")
+
+        response = self.client.get(url, HTTP_RANGE="bytes=10-")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), data[10:])
+
+        response = self.client.get(url, HTTP_RANGE="bytes=-10")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), data[-10:])
+        self.assertEqual(response["Content-Range"], "bytes {}-{}/{}".format(size - 10, size - 1, size))
+
+        response = self.client.get(url, HTTP_RANGE="bytes={}-".format(size))
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */{}".format(size))
+
+        # multiple ranges aren't supported, so the whole body is sent
+        response = self.client.get(url, HTTP_RANGE="bytes=0-4,10-14")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), data)
+
+        # If-Range doesn't match, so the whole body is sent
+        response = self.client.get(url, HTTP_RANGE="bytes=0-4", HTTP_IF_RANGE="\"sha1:something-else\"")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), data)
+
+    def test_body_in_store(self):
+        store_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, store_path, ignore_errors=True)
+        data = b"this attachment is kept on disk"
+
+        with override_settings(BODY_STORE_BACKEND="inboxen.utils.body_store.FileSystemBodyStore",
+                               BODY_STORE_PATH=store_path, BODY_STORE_INLINE_SIZE=10):
+            self.part.body = models.Body.objects.get_or_create(data=data)[0]
+            self.part.save()
+            self.assertTrue(self.part.body.in_store)
+
+            url = urlresolvers.reverse("email-attachment", kwargs={"attachmentid": self.part.id})
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            self.assertEqual(b"".join(response.streaming_content), data)
+            self.assertEqual(response["Content-Length"], str(len(data)))
+            self.assertEqual(response["Content-Disposition"], "attachment")
+
+            # django-sendfile caches the backend
+            _get_sendfile.clear()
+            self.addCleanup(_get_sendfile.clear)
+            with override_settings(SENDFILE_BACKEND="sendfile.backends.xsendfile"):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response["X-Sendfile"], get_body_store().path(self.part.body.hashed))
+            self.assertEqual(response["Content-Disposition"], "attachment")
+
 
 class UtilityTestCase(InboxenTestCase):
+    def setUp(self):
+        super(UtilityTestCase, self).setUp()
+        caches[email_utils.RENDER_CACHE].clear()
+
     def test_is_unicode(self):
         string = "Hey there!"
         self.assertTrue(isinstance(email_utils.unicode_damnit(string), six.text_type))
@@ -504,7 +615,7 @@ class UtilityTestCase(InboxenTestCase):
         part = mock.Mock()
         part.content_type = "text/html"
         part.charset = "utf-8"
-        part.body.data = BADLY_ENCODED_BODY
+        part.body.get_data.return_value = BADLY_ENCODED_BODY
 
         with mock.patch("inboxen.utils.email.messages") as msg_mock:
             returned_body = email_utils.render_body(None, email, [part])
@@ -516,11 +627,70 @@ class UtilityTestCase(InboxenTestCase):
         part = mock.Mock()
         part.content_type = "text/html"
         part.charset = "utf-8"
-        part.body.data = BAD_HTTP_EQUIV_BODY
+        part.body.get_data.return_value = BAD_HTTP_EQUIV_BODY
 
         returned_body = email_utils.render_body(None, email, [part])
         self.assertIsInstance(returned_body, six.text_type)
 
+    def test_render_cache(self):
+        email = {"display_images": False, "eid": "abc"}
+        part = mock.Mock()
+        part.content_type = "text/html"
+        part.charset = "ascii"
+        part.body.hashed = "sha1:abc"
+        part.body.get_data.return_value = UNSUPPORTED_CSS_BODY
+
+        with mock.patch("inboxen.utils.email.messages") as msg_mock:
+            first_body = email_utils.render_body(None, email, [part])
+            self.assertEqual(msg_mock.info.call_count, 1)
+        self.assertEqual(part.body.get_data.call_count, 1)
+
+        # the second render comes from the cache, but still warns about the CSS
+        with mock.patch("inboxen.utils.email.messages") as msg_mock:
+            second_body = email_utils.render_body(None, email, [part])
+            self.assertEqual(msg_mock.info.call_count, 1)
+        self.assertEqual(part.body.get_data.call_count, 1)
+        self.assertEqual(first_body, second_body)
+
+        # options that change the output aren't shared
+        email["display_images"] = True
+        with mock.patch("inboxen.utils.email.messages"):
+            email_utils.render_body(None, email, [part])
+        self.assertEqual(part.body.get_data.call_count, 2)
+
+    def test_render_cache_images(self):
+        email = {"display_images": False, "eid": "abc"}
+        part = mock.Mock()
+        part.content_type = "text/html"
+        part.charset = "utf-8"
+        part.body.hashed = "sha1:def"
+        part.body.get_data.return_value = b"<html><body><img src=\"https://example.com/a.png\"></body></html>"
+
+        email_utils.render_body(None, email, [part])
+        self.assertTrue(email["has_images"])
+
+        del email["has_images"]
+        email_utils.render_body(None, email, [part])
+        self.assertEqual(part.body.get_data.call_count, 1)
+        self.assertTrue(email["has_images"])
+
+    def test_render_cache_key(self):
+        key = email_utils.render_cache_key("sha1:abc", "utf-8", False)
+        self.assertEqual(key, email_utils.render_cache_key("sha1:abc", "utf-8", False))
+        self.assertNotEqual(key, email_utils.render_cache_key("sha1:abc", "utf-8", True))
+        self.assertNotEqual(key, email_utils.render_cache_key("sha1:abc", "ascii", False))
+        self.assertNotEqual(key, email_utils.render_cache_key("sha1:def", "utf-8", False))
+
+        with mock.patch("inboxen.utils.email.staticfiles_storage.url", return_value="/static/placeholder.123.svg"):
+            self.assertNotEqual(key, email_utils.render_cache_key("sha1:abc", "utf-8", False))
+
+    def test_make_preview(self):
+        self.assertEqual(email_utils.make_preview(b"Hi\n\n  there", "text/plain", "ascii"), "Hi there")
+        self.assertEqual(email_utils.make_preview(b"<p>Hi</p> <p>there</p>", "text/html", "ascii"), "Hi there")
+        self.assertEqual(email_utils.make_preview(b"", "text/html", "ascii"), "")
+        self.assertEqual(len(email_utils.make_preview(b"a" * 1000, "text/plain", "ascii")),
+                         email_utils.PREVIEW_LENGTH)
+
     def test_invalid_charset(self):
         text = "Växjö".encode("utf-8")
         self.assertEqual(email_utils.unicode_damnit(text, "utf-8"), u"Växjö")
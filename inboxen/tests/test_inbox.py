@@ -23,10 +23,11 @@ import warnings
 
 from django.conf import settings
 from django.core import urlresolvers
+from django.utils.http import urlquote
 from watson.models import SearchEntry
 
 from inboxen import forms as inboxen_forms
-from inboxen import models
+from inboxen import models, tasks
 from inboxen.test import MockRequest, InboxenTestCase, override_settings
 from inboxen.tests import factories
 from inboxen.utils.ratelimit import inbox_ratelimit
@@ -77,6 +78,11 @@ class InboxTestAbstract(object):
             }
             self.client.get(urlresolvers.reverse("email-view", kwargs=kwargs))
 
+        # flags are buffered until the next flush
+        count = models.Email.objects.filter(read=True).count()
+        self.assertEqual(count, 0)
+
+        tasks.flush_flags()
         count = models.Email.objects.filter(read=True).count()
         self.assertEqual(count, 2)
 
@@ -95,12 +101,26 @@ class InboxTestAbstract(object):
         self.assertEqual(SearchEntry.objects.filter(content_type__model="email").count(), count_2nd)
 
     def test_post_single_delete(self):
-        search_count = SearchEntry.objects.filter(content_type__model="email").count()
+        profile = self.user.inboxenprofile
+        tasks.reconcile_counters(user_id=self.user.id)
+        profile.refresh_from_db()
         email = self.emails[0]
+        inbox = models.Inbox.objects.get(id=email.inbox_id)
+        inbox_counts = (inbox.total_count, inbox.unseen_count, inbox.unread_count)
+        profile_counts = (profile.total_count, profile.unseen_count, profile.unread_count)
+
+        search_count = SearchEntry.objects.filter(content_type__model="email").count()
         response = self.client.post(self.get_url(), {"delete-single": email.eid})
         self.assertEqual(response.status_code, 302)
         self.assertEqual(SearchEntry.objects.filter(content_type__model="email").count(), search_count - 1)
 
+        inbox.refresh_from_db()
+        self.assertEqual((inbox.total_count, inbox.unseen_count, inbox.unread_count),
+                         tuple(count - 1 for count in inbox_counts))
+        profile.refresh_from_db()
+        self.assertEqual((profile.total_count, profile.unseen_count, profile.unread_count),
+                         tuple(count - 1 for count in profile_counts))
+
         # second time around, it's already deleted but we don't want an error
         response = self.client.post(self.get_url(), {"delete-single": email.eid})
         self.assertEqual(response.status_code, 302)
@@ -128,7 +148,7 @@ class InboxTestAbstract(object):
             email.save()
 
         response = self.client.get(self.get_url())
-        objs = response.context["page_obj"].object_list[:5]
+        objs = response.context["page_obj"][:5]
 
         self.assertEqual(
             [obj.important for obj in objs],
@@ -138,8 +158,36 @@ class InboxTestAbstract(object):
     def test_pagin(self):
         # there should be 150 emails in the test fixtures
         # and pages are paginated by 100 items
-        response = self.client.get(self.get_url() + "2/")
+        response = self.client.get(self.get_url())
+        self.assertEqual(response.status_code, 200)
+        first_page = response.context["page_obj"]
+        self.assertEqual(len(first_page), 100)
+        self.assertTrue(first_page.has_next)
+        self.assertFalse(first_page.has_previous)
+
+        response = self.client.get(self.get_url(), {"after": first_page.next_cursor})
+        self.assertEqual(response.status_code, 200)
+        second_page = response.context["page_obj"]
+        self.assertEqual(len(second_page), 50)
+        self.assertFalse(second_page.has_next)
+        self.assertTrue(second_page.has_previous)
+        self.assertEqual(set(email.id for email in first_page) & set(email.id for email in second_page), set())
+
+        response = self.client.get(self.get_url(), {"before": second_page.previous_cursor})
         self.assertEqual(response.status_code, 200)
+        self.assertEqual([email.id for email in response.context["page_obj"]], [email.id for email in first_page])
+
+        response = self.client.get(self.get_url(), {"after": "not a cursor"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_pagin_old_urls(self):
+        response = self.client.get(self.get_url() + "1/")
+        self.assertRedirects(response, self.get_url(), fetch_redirect_response=False)
+
+        first_page = self.client.get(self.get_url()).context["page_obj"]
+        response = self.client.get(self.get_url() + "2/")
+        self.assertRedirects(response, "{}?after={}".format(self.get_url(), urlquote(first_page.next_cursor, safe="")),
+                             fetch_redirect_response=False)
 
         response = self.client.get(self.get_url() + "3/")
         self.assertEqual(response.status_code, 404)
@@ -165,6 +213,47 @@ class SingleInboxTestCase(InboxTestAbstract, InboxenTestCase):
             factories.HeaderFactory(part=part, name="From")
             factories.HeaderFactory(part=part, name="Subject")
 
+    def test_post_delete_last_activity(self):
+        emails = sorted(self.emails, key=lambda email: email.received_date, reverse=True)
+
+        params = dict([(email.eid, "email") for email in emails[:10]])
+        params["delete"] = ""
+        response = self.client.post(self.get_url(), params)
+        self.assertEqual(response.status_code, 302)
+
+        self.inbox.refresh_from_db()
+        self.assertEqual(self.inbox.last_activity, emails[10].received_date)
+
+    def test_post_delete_counters(self):
+        profile = self.user.inboxenprofile
+        tasks.reconcile_counters(user_id=self.user.id)
+
+        params = dict([(email.eid, "email") for email in self.emails[:10]])
+        params["delete"] = ""
+        response = self.client.post(self.get_url(), params)
+        self.assertEqual(response.status_code, 302)
+
+        self.inbox.refresh_from_db()
+        self.assertEqual((self.inbox.total_count, self.inbox.unseen_count, self.inbox.unread_count), (140, 140, 140))
+        profile.refresh_from_db()
+        self.assertEqual((profile.total_count, profile.unseen_count, profile.unread_count), (141, 141, 141))
+
+    def test_summary(self):
+        email = self.emails[0]
+        email.important = True
+        email.save()
+        models.EmailSummary.objects.create(email=email, subject="Summarised", sender="me@example.com")
+
+        response = self.client.get(self.get_url())
+        objs = response.context["page_obj"]
+        self.assertEqual(objs[0].id, email.id)
+        self.assertEqual(objs[0].subject, "Summarised")
+        self.assertEqual(objs[0].sender, "me@example.com")
+
+        # emails without a summary fall back to headers
+        header = models.Header.objects.get(part__email=objs[1], name__name="Subject")
+        self.assertEqual(objs[1].subject, header.data.data)
+
     def get_url(self):
         return urlresolvers.reverse("single-inbox",
                                     kwargs={"inbox": self.inbox.inbox, "domain": self.inbox.domain.domain})
@@ -362,6 +451,17 @@ class InboxEditTestCase(InboxenTestCase):
 
         self.assertTrue(models.Inbox.objects.filter(description="nothing at all").exists())
 
+    def test_clear_inbox(self):
+        emails = factories.EmailFactory.create_batch(3, inbox=self.inbox)
+        models.Inbox.objects.filter(id=self.inbox.id).update(last_activity=emails[0].received_date)
+
+        response = self.client.post(self.get_url(), {"description": "", "clear_inbox": "on"})
+        self.assertEqual(response.status_code, 302)
+
+        self.inbox.refresh_from_db()
+        self.assertEqual(self.inbox.last_activity, self.inbox.created)
+        self.assertEqual(models.Email.objects.filter(inbox=self.inbox).count(), 0)
+
     def test_not_found(self):
         url = urlresolvers.reverse("inbox-edit", kwargs={"inbox": "test", "domain": "example.com"})
         response = self.client.get(url)
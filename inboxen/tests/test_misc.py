@@ -20,7 +20,11 @@
 from datetime import datetime
 from email.message import Message
 from subprocess import CalledProcessError
+import json
+import os
+import shutil
 import sys
+import tempfile
 
 from django.conf import settings as dj_settings
 from django.contrib.auth import get_user_model
@@ -42,8 +46,11 @@ from inboxen.middleware import ExtendSessionMiddleware, MakeXSSFilterChromeSafeM
 from inboxen.test import MockRequest, override_settings, InboxenTestCase, SecureClient
 from inboxen.tests import factories
 from inboxen.utils import is_reserved, ip, ratelimit
+from inboxen.utils.bloom import BloomFilter
+from inboxen.utils.lru import LRUCache
 from inboxen.validators import ProhibitNullCharactersValidator
 from inboxen.views.error import ErrorView
+from router.app.receivers import WORKER_ENV
 
 
 def reload_urlconf():
@@ -386,17 +393,31 @@ class RouterCommandTest(InboxenTestCase):
         mgmt_command.handle(cmd=lambda: "test")
         self.assertEqual(mgmt_command.stdout.getvalue(), "test")
 
+    def setUp(self):
+        super(RouterCommandTest, self).setUp()
+        self.router_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.router_dir, "run"))
+
+    def tearDown(self):
+        shutil.rmtree(self.router_dir, ignore_errors=True)
+
+    def write_file(self, name, data):
+        with open(os.path.join(self.router_dir, "run", name), "w") as f:
+            f.write(data)
+
     @mock.patch("inboxen.management.commands.router.check_output")
     def test_process_error(self, check_mock):
         check_mock.side_effect = CalledProcessError(-1, "salmon", "test")
         mgmt_command = router.Command()
+        mgmt_command.router_dir = self.router_dir
 
         output = mgmt_command.salmon_start()
         self.assertEqual(output, ["Exit code -1: test"])
 
         output = mgmt_command.salmon_status()
-        self.assertEqual(output, ["Exit code -1: test"])
+        self.assertEqual(output, ["Worker 1: not running\n"])
 
+        self.write_file("router-1.pid", str(os.getpid()))
         output = mgmt_command.salmon_stop()
         self.assertEqual(output, ["Exit code -1: test"])
 
@@ -404,9 +425,60 @@ class RouterCommandTest(InboxenTestCase):
     def test_start_message(self, check_mock):
         check_mock.return_value = "test"
         mgmt_command = router.Command()
+        mgmt_command.router_dir = self.router_dir
 
         output = mgmt_command.salmon_start()
-        self.assertEqual(output, ["Starting Salmon handler: boot\n"])
+        self.assertEqual(output, ["Starting Salmon handler: boot (worker 1)\n"])
+        self.assertEqual(check_mock.call_args[1]["env"][WORKER_ENV], "1")
+
+    @mock.patch("inboxen.management.commands.router.check_output")
+    def test_workers(self, check_mock):
+        check_mock.return_value = "test"
+        mgmt_command = router.Command()
+        mgmt_command.router_dir = self.router_dir
+        mgmt_command.workers = 3
+
+        # worker 1 is running, worker 2 has crashed
+        self.write_file("router-1.pid", str(os.getpid()))
+        self.write_file("router-2.pid", "999999999")
+        self.write_file("router-1.stats", json.dumps({"pid": os.getpid(), "accepted": 4, "rejected": 2, "deferred": 1}))
+
+        output = mgmt_command.salmon_status()
+        self.assertEqual(output, [
+            "Worker 1: running with PID %d, 4 accepted, 2 rejected, 1 deferred\n" % os.getpid(),
+            "Worker 2: crashed, PID 999999999 not found\n",
+            "Worker 3: not running\n",
+        ])
+
+        output = mgmt_command.salmon_start()
+        self.assertEqual(output, [
+            "Salmon handler boot (worker 1) already running with PID %d\n" % os.getpid(),
+            "Restarting crashed Salmon handler: boot (worker 2)\n",
+            "Starting Salmon handler: boot (worker 3)\n",
+        ])
+        self.assertEqual(check_mock.call_count, 2)
+        self.assertIn("--force", check_mock.call_args_list[0][0][0])
+        self.assertNotIn("--force", check_mock.call_args_list[1][0][0])
+
+        # stop finds workers that are no longer configured
+        mgmt_command.workers = 1
+        check_mock.reset_mock()
+        mgmt_command.salmon_stop()
+        pid_files = [call[0][0][3] for call in check_mock.call_args_list]
+        self.assertEqual(pid_files, ["run/router-1.pid", "run/router-2.pid"])
+
+    def test_workers_option(self):
+        mgmt_command = router.Command()
+        mgmt_command.stdout = StringIO()
+
+        with self.assertRaises(CommandError):
+            mgmt_command.handle(cmd=lambda: "test", workers=0)
+
+        with self.settings(SALMON_SERVER={"type": "lmtp", "path": "/fake/path"}), self.assertRaises(CommandError):
+            mgmt_command.handle(cmd=lambda: "test", workers=2)
+
+        mgmt_command.handle(cmd=lambda: "test", workers=2)
+        self.assertEqual(mgmt_command.workers, 2)
 
 
 class ErrorViewTestCase(InboxenTestCase):
@@ -678,3 +750,54 @@ class RateLimitTestCase(InboxenTestCase):
 
         self.assertEqual(len(cache._cache), 1)
         self.assertEqual(cache.get(self.make_key(request, now_mock())), self.limit_count + 1)
+
+
+class LRUCacheTestCase(InboxenTestCase):
+    def test_eviction(self):
+        lru = LRUCache(3)
+        lru.set_many({"a": 1, "b": 2, "c": 3})
+        self.assertEqual(len(lru), 3)
+
+        # "a" is now the most recently used
+        self.assertEqual(lru.get("a"), 1)
+
+        lru.set("d", 4)
+        self.assertEqual(len(lru), 3)
+        self.assertNotIn("b", lru)
+        self.assertEqual(lru.get_many(["a", "b", "c", "d"]), {"a": 1, "c": 3, "d": 4})
+
+    def test_get_default(self):
+        lru = LRUCache(1)
+        self.assertEqual(lru.get("a"), None)
+        self.assertEqual(lru.get("a", 12), 12)
+
+    def test_delete_and_clear(self):
+        lru = LRUCache(2)
+        lru.set_many({"a": 1, "b": 2})
+        lru.delete("a")
+        lru.delete("z")
+        self.assertEqual(lru.get_many(["a", "b"]), {"b": 2})
+
+        lru.clear()
+        self.assertEqual(len(lru), 0)
+
+
+class BloomFilterTestCase(InboxenTestCase):
+    def test_membership(self):
+        bloom = BloomFilter(100)
+        self.assertNotIn(u"hello@example.com", bloom)
+
+        self.assertTrue(bloom.add(u"hello@example.com"))
+        self.assertFalse(bloom.add(u"hello@example.com"))
+        self.assertIn(u"hello@example.com", bloom)
+        self.assertIn(b"hello@example.com", bloom)
+        self.assertEqual(bloom.count, 1)
+
+    def test_full(self):
+        bloom = BloomFilter(10)
+        for i in range(10):
+            bloom.add(u"inbox%d@example.com" % i)
+        self.assertFalse(bloom.is_full())
+
+        bloom.add(u"another@example.com")
+        self.assertTrue(bloom.is_full())
@@ -19,15 +19,28 @@
 
 import datetime
 import itertools
+import os
+import shutil
+import tempfile
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+from six import StringIO
+from watson.models import SearchEntry
 import mock
 
-from inboxen import models
+from inboxen import managers, models
+from inboxen.management.commands import rebuild_index
 from inboxen.tests import factories
 from inboxen.test import override_settings, InboxenTestCase
+from inboxen.utils.body_store import get_body_store
 
 
 User = get_user_model()
@@ -183,10 +196,11 @@ class ModelTestCase(InboxenTestCase):
         count = models.Email.objects.viewable(user).count()
         self.assertEqual(count, 4)
 
-    def test_add_last_activity(self):
+    def test_update_last_activity(self):
         now = timezone.now()
 
         email = factories.EmailFactory(received_date=now)
+        factories.EmailFactory(inbox=email.inbox, received_date=now + datetime.timedelta(1), deleted=True)
         email.inbox.created = now - datetime.timedelta(2)
         email.inbox.save()
 
@@ -194,7 +208,9 @@ class ModelTestCase(InboxenTestCase):
         inbox.created = now - datetime.timedelta(1)
         inbox.save()
 
-        inboxes = list(models.Inbox.objects.all().add_last_activity())
+        models.Inbox.objects.all().update_last_activity()
+
+        inboxes = list(models.Inbox.objects.all().order_by("-last_activity"))
         self.assertEqual(inboxes[0].last_activity, now)
         self.assertEqual(inboxes[1].last_activity, now - datetime.timedelta(1))
 
@@ -234,6 +250,255 @@ class ModelTestCase(InboxenTestCase):
         self.assertTrue(body1[1])
         self.assertFalse(body2[1])
 
+    def test_body_chunks(self):
+        data = b"abcdefghijklmnopqrstuvwxyz"
+        body = models.Body.objects.get_or_create(data=data)[0]
+        body = models.Body.objects.defer("data").get(id=body.id)
+
+        with self.assertNumQueries(9):
+            chunks = list(body.chunks(chunk_size=3))
+        self.assertEqual(len(chunks), 9)
+        self.assertEqual(b"".join(chunks), data)
+
+        self.assertEqual(b"".join(body.chunks(5, 12, chunk_size=4)), data[5:12])
+        self.assertEqual(list(body.chunks(5, 5)), [])
+
+    def test_get_or_create_many(self):
+        existing = models.HeaderName.objects.create(name="From")
+
+        with self.assertNumQueries(4):
+            # select, savepoint, insert, release savepoint
+            ids = models.HeaderName.objects.get_or_create_many("name", {"From": {}, "To": {}, "Subject": {}})
+
+        self.assertEqual(ids["From"], existing.id)
+        self.assertEqual(models.HeaderName.objects.count(), 3)
+        self.assertEqual(ids, dict(models.HeaderName.objects.values_list("name", "id")))
+
+        with self.assertNumQueries(1):
+            models.HeaderName.objects.get_or_create_many("name", {"From": {}, "To": {}})
+
+        self.assertEqual(models.HeaderName.objects.get_or_create_many("name", {}), {})
+
+    def test_header_name_get_ids(self):
+        from_name = models.HeaderName.objects.create(name="From")
+
+        # in a test everything is in a transaction that never commits, so make
+        # on_commit callbacks run straight away
+        with mock.patch("inboxen.managers.transaction.on_commit", lambda func: func()):
+            with self.assertNumQueries(1):
+                ids = models.HeaderName.objects.get_ids(["From", "Subject"])
+            self.assertEqual(ids, {"From": from_name.id})
+
+            with self.assertNumQueries(1):
+                # only Subject is missing from the cache
+                ids = models.HeaderName.objects.get_ids(["From", "Subject"])
+            self.assertEqual(ids, {"From": from_name.id})
+
+            ids = models.HeaderName.objects.get_ids(["From", "Subject"], create=True)
+            self.assertEqual(ids, dict(models.HeaderName.objects.values_list("name", "id")))
+
+            with self.assertNumQueries(0):
+                models.HeaderName.objects.get_ids(["From", "Subject"])
+
+        models.HeaderName.objects.clear_cache()
+        with self.assertNumQueries(1):
+            models.HeaderName.objects.get_ids(["From", "Subject"])
+
+    def test_header_name_cache_not_filled_before_commit(self):
+        models.HeaderName.objects.create(name="From")
+        models.HeaderName.objects.preload_cache()
+        models.HeaderName.objects.get_ids(["From"])
+
+        self.assertEqual(len(managers.header_name_cache), 0)
+
+    def test_get_many_skips_join(self):
+        email = factories.EmailFactory()
+        part = factories.PartListFactory(email=email)
+        factories.HeaderFactory(part=part, name="From", data="me@example.com")
+        factories.HeaderFactory(part=part, name="Subject", data="Hello")
+        factories.HeaderFactory(part=part, name="To", data="you@example.com")
+
+        with mock.patch("inboxen.managers.transaction.on_commit", lambda func: func()):
+            models.HeaderName.objects.get_ids(["From", "Subject", "Nope"])
+
+        with CaptureQueriesContext(connection) as queries:
+            headers = models.Header.objects.filter(part=part).get_many("From", "Subject", "Nope")
+
+        self.assertEqual(dict(headers), {"From": "me@example.com", "Subject": "Hello"})
+        self.assertEqual(len(queries), 2)  # one for Nope, one for headers
+        self.assertNotIn("inboxen_headername", queries[-1]["sql"])
+
+        headers = models.Header.objects.filter(part__email=email).get_many("From", group_by="part__email_id")
+        self.assertEqual(headers, {email.id: {"From": "me@example.com"}})
+
+        models.HeaderName.objects.clear_cache()
+
+    def test_get_or_create_many_race(self):
+        hashed = models.Body.objects.hash_it(b"Hello")
+        existing = models.Body.objects.create(data=b"Hello", hashed=hashed)
+
+        real_filter = models.BodyQuerySet.filter
+        filter_calls = []
+
+        def racy_filter(qs, *args, **kwargs):
+            # pretend another process inserted our row after we looked for it
+            filter_calls.append((args, kwargs))
+            if len(filter_calls) == 1:
+                return qs.none()
+            return real_filter(qs, *args, **kwargs)
+
+        with mock.patch.object(models.BodyQuerySet, "filter", racy_filter):
+            ids = models.Body.objects.get_or_create_many("hashed", {hashed: {"data": b"Hello", "size": 5}})
+
+        self.assertEqual(ids, {hashed: existing.id})
+        self.assertEqual(models.Body.objects.count(), 1)
+
+    def test_summarise_emails(self):
+        email = factories.EmailFactory()
+        root = factories.PartListFactory(email=email, body=factories.BodyFactory(data=b""))
+        factories.HeaderFactory(part=root, name="Subject", data="Hello")
+        factories.HeaderFactory(part=root, name="From", data="me@example.com")
+        factories.HeaderFactory(part=root, name="Content-Type", data="multipart/mixed")
+
+        html_part = factories.PartListFactory(email=email, parent=root,
+                                              body=factories.BodyFactory(data=b"<p>Hi <b>there</b>\n\n!</p>"))
+        factories.HeaderFactory(part=html_part, name="Content-Type", data="text/html; charset=\"utf-8\"")
+
+        attachment = factories.PartListFactory(email=email, parent=root, body=factories.BodyFactory(data=b"123"))
+        factories.HeaderFactory(part=attachment, name="Content-Type", data="application/octet-stream")
+        factories.HeaderFactory(part=attachment, name="Content-Disposition", data="attachment; filename=\"a.bin\"")
+
+        other_email = factories.EmailFactory()
+        models.EmailSummary.objects.create(email=other_email, subject="Already done")
+
+        call_command("summarise_emails", batch_size=1, stdout=StringIO())
+
+        summary = models.EmailSummary.objects.get(email=email)
+        self.assertEqual(summary.subject, "Hello")
+        self.assertEqual(summary.sender, "me@example.com")
+        self.assertEqual(summary.size, len(b"<p>Hi <b>there</b>\n\n!</p>") + 3)
+        self.assertEqual(summary.attachment_count, 1)
+        self.assertEqual(summary.preview, "Hi there !")
+
+        self.assertEqual(models.EmailSummary.objects.get(email=other_email).subject, "Already done")
+
+    def test_rebuild_index(self):
+        inbox = factories.InboxFactory(description="bizz")
+        emails = factories.EmailFactory.create_batch(3, inbox=inbox)
+        models.EmailSummary.objects.create(email=emails[0], subject="Summarised", sender="me@example.com")
+        root = factories.PartListFactory(email=emails[1], body=factories.BodyFactory(data=b""))
+        factories.HeaderFactory(part=root, name="Subject", data="Not summarised")
+        deleted = factories.EmailFactory(inbox=inbox, deleted=True)
+
+        SearchEntry.objects.update(title="stale")
+        SearchEntry.objects.filter(object_id_int=emails[2].id).delete()
+        email_type = ContentType.objects.get_for_model(models.Email)
+
+        # pretend a previous run was interrupted after indexing emails[0]
+        SearchEntry.objects.create(engine_slug=rebuild_index.REBUILD_ENGINE, content_type=email_type,
+                                   object_id=str(emails[0].id), object_id_int=emails[0].id, title="Interrupted")
+
+        call_command("rebuild_index", chunk_size=1, stdout=StringIO())
+        self.assertEqual(SearchEntry.objects.filter(engine_slug=rebuild_index.REBUILD_ENGINE).count(), 0)
+
+        entries = SearchEntry.objects.filter(content_type=email_type).order_by("object_id_int")
+        self.assertEqual(
+            list(entries.values_list("object_id_int", "title")),
+            [(emails[0].id, "Interrupted"), (emails[1].id, "Not summarised"), (emails[2].id, "")],
+        )
+        self.assertEqual(SearchEntry.objects.exclude(content_type=email_type).get().title, "bizz")
+        self.assertFalse(SearchEntry.objects.filter(content_type=email_type, object_id_int=deleted.id).exists())
+
+        call_command("rebuild_index", restart=True, stdout=StringIO())
+        entry = SearchEntry.objects.get(content_type=email_type, object_id_int=emails[0].id)
+        self.assertEqual((entry.title, entry.description), ("Summarised", "me@example.com"))
+
+
+class BodyStoreTestCase(InboxenTestCase):
+    def setUp(self):
+        super(BodyStoreTestCase, self).setUp()
+        self.store_path = tempfile.mkdtemp()
+        self.override = override_settings(
+            BODY_STORE_BACKEND="inboxen.utils.body_store.FileSystemBodyStore",
+            BODY_STORE_PATH=self.store_path,
+            BODY_STORE_INLINE_SIZE=10,
+        )
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.store_path, ignore_errors=True)
+        super(BodyStoreTestCase, self).tearDown()
+
+    def test_small_body_inline(self):
+        body = models.Body.objects.get_or_create(data=b"small")[0]
+        self.assertFalse(body.in_store)
+        self.assertEqual(body.get_data(), b"small")
+        self.assertEqual(os.listdir(self.store_path), [])
+
+    @mock.patch("inboxen.signals.transaction.on_commit", lambda func: func())
+    def test_large_body_in_store(self):
+        data = b"this is too big for the database"
+        body = models.Body.objects.get_or_create(data=data)[0]
+        body = models.Body.objects.get(id=body.id)
+
+        algo, digest = body.hashed.split(":")
+        path = os.path.join(self.store_path, algo, digest[:2], digest[2:4], digest)
+
+        self.assertTrue(body.in_store)
+        self.assertEqual(body.size, len(data))
+        self.assertEqual(bytes(body.data), b"")
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(body.get_data(), data)
+        with body.open() as body_file:
+            self.assertEqual(body_file.read(), data)
+        self.assertEqual(b"".join(body.chunks(5, 10, chunk_size=2)), data[5:10])
+
+        body.delete()
+        self.assertFalse(os.path.exists(path))
+
+    def test_existing_body_not_stored(self):
+        data = b"this is too big for the database"
+        with override_settings(BODY_STORE_BACKEND="inboxen.utils.body_store.DatabaseBodyStore"):
+            body = models.Body.objects.get_or_create(data=data)[0]
+
+        self.assertEqual(models.Body.objects.get_or_create_many("hashed", {body.hashed: {"data": data}}),
+                         {body.hashed: body.id})
+        self.assertEqual(models.Body.objects.get_or_create(data=data), (body, False))
+        self.assertEqual(os.listdir(self.store_path), [])
+
+    def test_store_disabled(self):
+        body = models.Body.objects.get_or_create(data=b"this is too big for the database")[0]
+        self.assertTrue(body.in_store)
+
+        with override_settings(BODY_STORE_BACKEND="inboxen.utils.body_store.DatabaseBodyStore"):
+            with self.assertRaises(ImproperlyConfigured):
+                body.get_data()
+
+    @mock.patch("inboxen.management.commands.move_bodies.transaction.on_commit", lambda func: func())
+    def test_move_bodies(self):
+        with override_settings(BODY_STORE_BACKEND="inboxen.utils.body_store.DatabaseBodyStore"):
+            small = models.Body.objects.get_or_create(data=b"small")[0]
+            large = models.Body.objects.get_or_create(data=b"this is too big for the database")[0]
+            self.assertFalse(large.in_store)
+
+            with self.assertRaises(CommandError):
+                call_command("move_bodies", stdout=StringIO())
+
+        call_command("move_bodies", batch_size=1, stdout=StringIO())
+        small.refresh_from_db()
+        large.refresh_from_db()
+        self.assertFalse(small.in_store)
+        self.assertTrue(large.in_store)
+        self.assertEqual(bytes(large.data), b"")
+        self.assertEqual(large.get_data(), b"this is too big for the database")
+
+        call_command("move_bodies", inline=True, stdout=StringIO())
+        large.refresh_from_db()
+        self.assertFalse(large.in_store)
+        self.assertEqual(bytes(large.data), b"this is too big for the database")
+        self.assertFalse(os.path.exists(get_body_store().path(large.hashed)))
+
 
 class ModelFlagsTestCase(InboxenTestCase):
     def test_email_flags_order(self):
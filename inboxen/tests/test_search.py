@@ -20,7 +20,6 @@
 
 import mock
 
-from celery import exceptions
 from django.core import urlresolvers, cache
 from six.moves import urllib
 from watson.models import SearchEntry
@@ -71,17 +70,18 @@ class SearchViewTestCase(InboxenTestCase):
     @mock.patch("inboxen.views.user.search.tasks.search.apply_async")
     def test_get_task_run(self, task_mock, qs_mock):
         qs_mock.return_value = []
-        task_mock.return_value.id = "abc"
-        task_mock.return_value.get.side_effect = exceptions.TimeoutError
 
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, 200)
 
         self.assertEqual(qs_mock.call_count, 0)
         self.assertEqual(task_mock.call_count, 1)
-        self.assertEqual(task_mock.return_value.get.call_count, 1)
+        self.assertEqual(task_mock.return_value.get.call_count, 0)
 
-        self.assertEqual(task_mock.call_args, ((), {"args": [self.user.id, u"cheddär"], "kwargs": {"before": None}}))
+        task_id = task_mock.call_args[1]["task_id"]
+        self.assertEqual(task_mock.call_args, ((), {"args": [self.user.id, u"cheddär"], "kwargs": {"before": None},
+                                                    "task_id": task_id}))
+        self.assertEqual(cache.cache.get(self.key), {"task": task_id})
         self.assertCountEqual(response.context["search_results"], {})
         self.assertEqual(response.context["waiting"], True)
 
@@ -90,9 +90,6 @@ class SearchViewTestCase(InboxenTestCase):
     def test_get_cached_result(self, task_mock):
         factories.EmailFactory(inbox__user=self.user)
 
-        task_mock.return_value.id = "abc"
-        task_mock.return_value.get.side_effect = exceptions.TimeoutError
-
         cache.cache.set(self.key, {
             "results": list(SearchEntry.objects.values_list("id", flat=True)),
             "has_next": True,
@@ -135,18 +132,17 @@ class SearchViewTestCase(InboxenTestCase):
     @mock.patch("inboxen.views.user.search.tasks.search.apply_async")
     def test_get_with_after_param(self, task_mock, qs_mock):
         qs_mock.return_value = []
-        task_mock.return_value.id = "abc"
-        task_mock.return_value.get.side_effect = exceptions.TimeoutError
 
         response = self.client.get(self.url + "?after=blahblah")
         self.assertEqual(response.status_code, 200)
 
         self.assertEqual(qs_mock.call_count, 0)
         self.assertEqual(task_mock.call_count, 1)
-        self.assertEqual(task_mock.return_value.get.call_count, 1)
+        self.assertEqual(task_mock.return_value.get.call_count, 0)
 
         self.assertEqual(task_mock.call_args, ((), {"args": [self.user.id, u"cheddär"],
-                                                    "kwargs": {"after": "blahblah"}}))
+                                                    "kwargs": {"after": "blahblah"},
+                                                    "task_id": task_mock.call_args[1]["task_id"]}))
         self.assertCountEqual(response.context["search_results"], {})
 
     @override_settings(CELERY_TASK_ALWAYS_EAGER=False)
@@ -154,18 +150,17 @@ class SearchViewTestCase(InboxenTestCase):
     @mock.patch("inboxen.views.user.search.tasks.search.apply_async")
     def test_get_with_before_param(self, task_mock, qs_mock):
         qs_mock.return_value = []
-        task_mock.return_value.id = "abc"
-        task_mock.return_value.get.side_effect = exceptions.TimeoutError
 
         response = self.client.get(self.url + "?before=blahblah")
         self.assertEqual(response.status_code, 200)
 
         self.assertEqual(qs_mock.call_count, 0)
         self.assertEqual(task_mock.call_count, 1)
-        self.assertEqual(task_mock.return_value.get.call_count, 1)
+        self.assertEqual(task_mock.return_value.get.call_count, 0)
 
         self.assertEqual(task_mock.call_args, ((), {"args": [self.user.id, u"cheddär"],
-                                                    "kwargs": {"before": "blahblah"}}))
+                                                    "kwargs": {"before": "blahblah"},
+                                                    "task_id": task_mock.call_args[1]["task_id"]}))
         self.assertCountEqual(response.context["search_results"], {})
 
     @override_settings(CELERY_TASK_ALWAYS_EAGER=False)
@@ -173,33 +168,39 @@ class SearchViewTestCase(InboxenTestCase):
     @mock.patch("inboxen.views.user.search.tasks.search.apply_async")
     def test_get_with_before_and_after_param(self, task_mock, qs_mock):
         qs_mock.return_value = []
-        task_mock.return_value.id = "abc"
-        task_mock.return_value.get.side_effect = exceptions.TimeoutError
 
         response = self.client.get(self.url + "?after=blahblah&before=bluhbluh")
         self.assertEqual(response.status_code, 200)
 
         self.assertEqual(qs_mock.call_count, 0)
         self.assertEqual(task_mock.call_count, 1)
-        self.assertEqual(task_mock.return_value.get.call_count, 1)
+        self.assertEqual(task_mock.return_value.get.call_count, 0)
 
         # before param should be ignored, task will raise an error otherwise
         self.assertEqual(task_mock.call_args, ((), {"args": [self.user.id, u"cheddär"],
-                                                    "kwargs": {"after": "blahblah"}}))
+                                                    "kwargs": {"after": "blahblah"},
+                                                    "task_id": task_mock.call_args[1]["task_id"]}))
         self.assertCountEqual(response.context["search_results"], {})
 
     @override_settings(CELERY_TASK_ALWAYS_EAGER=False)
-    @mock.patch("inboxen.views.user.search.AsyncResult")
-    def test_task_running(self, result_mock):
+    @mock.patch("inboxen.views.user.search.tasks.search.apply_async")
+    def test_task_running(self, task_mock):
         cache.cache.set(self.key, {"task": "blahblahblah"})
-        result_mock.return_value.get.side_effect = exceptions.TimeoutError
 
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.context["waiting"], True)
 
-        self.assertEqual(result_mock.call_count, 1)
-        self.assertEqual(result_mock.call_args, (("blahblahblah",), {}))
+        self.assertEqual(task_mock.call_count, 0)
+
+    def test_task_eager(self):
+        factories.InboxFactory(user=self.user, description="cheddär")
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["waiting"], False)
+        self.assertEqual(len(response.context["search_results"]["results"]), 1)
+        self.assertNotIn("task", cache.cache.get(self.key))
 
     def test_no_query(self):
         url = urlresolvers.reverse("user-search")
@@ -236,25 +237,8 @@ class SearchApiViewTestCase(InboxenTestCase):
         response = self.client.head(self.url)
         self.assertEqual(response.status_code, 201)
 
-    @override_settings(CELERY_TASK_ALWAYS_EAGER=False)
-    @mock.patch("inboxen.views.user.search.AsyncResult")
-    def test_search_running_but_finishes_within_timeout(self, result_mock):
-        cache.cache.set(self.key, {"task": "blahblahblah"})
-
-        response = self.client.head(self.url)
-        self.assertEqual(response.status_code, 201)
-
-        self.assertEqual(result_mock.call_count, 1)
-        self.assertEqual(result_mock.call_args, (("blahblahblah",), {}))
-
-    @override_settings(CELERY_TASK_ALWAYS_EAGER=False)
-    @mock.patch("inboxen.views.user.search.AsyncResult")
-    def test_search_running_and_timeout(self, result_mock):
-        result_mock.return_value.get.side_effect = exceptions.TimeoutError
+    def test_search_running(self):
         cache.cache.set(self.key, {"task": "blahblahblah"})
 
         response = self.client.head(self.url)
         self.assertEqual(response.status_code, 202)
-
-        self.assertEqual(result_mock.call_count, 1)
-        self.assertEqual(result_mock.call_args, (("blahblahblah",), {}))
@@ -17,12 +17,14 @@
 #    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+import gzip
 import json
 
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
+import six
 
-from inboxen import models
+from inboxen import models, tasks
 from inboxen.test import InboxenTestCase
 
 
@@ -84,6 +86,53 @@ class StatsViewTestCase(InboxenTestCase):
             )
         )
 
+    def test_recent_cached(self):
+        emails = {"email_count__sum": 0, "running_total": 0}
+        models.Statistic.objects.create(users={"count": 12}, inboxes={}, emails=emails)
+        response = self.client.get(reverse("stats_recent"))
+        self.assertEqual(json.loads(response.content)["users"], [12])
+
+        # not invalidated until the statistics task runs
+        models.Statistic.objects.create(users={"count": 13}, inboxes={}, emails=emails)
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("stats_recent"))
+        self.assertEqual(json.loads(response.content)["users"], [12])
+
+        tasks.statistics.delay()
+        response = self.client.get(reverse("stats_recent"))
+        self.assertEqual(len(json.loads(response.content)["users"]), 3)
+
+    def test_recent_conditional(self):
+        models.Statistic.objects.create(users={}, inboxes={}, emails={"email_count__sum": 0, "running_total": 0})
+        response = self.client.get(reverse("stats_recent"))
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        last_modified = response["Last-Modified"]
+
+        response = self.client.get(reverse("stats_recent"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        response = self.client.get(reverse("stats_recent"), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        tasks.statistics.delay()
+        response = self.client.get(reverse("stats_recent"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_recent_gzip(self):
+        models.Statistic.objects.create(users={"count": 12}, inboxes={}, emails={})
+        plain = self.client.get(reverse("stats_recent"))
+        self.assertNotIn("Content-Encoding", plain)
+
+        response = self.client.get(reverse("stats_recent"), HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        self.assertNotEqual(response["ETag"], plain["ETag"])
+        self.assertEqual(gzip.GzipFile(fileobj=six.BytesIO(response.content)).read(), plain.content)
+
     def test_csp(self):
         # test a normal view
         response = self.client.get(reverse("index"))
@@ -19,14 +19,22 @@
 
 from datetime import timedelta
 
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.sessions.models import Session
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from watson.models import SearchEntry
 import mock
+import six
 
-from inboxen import models, tasks
+from inboxen import models, search as search_utils, tasks
 from inboxen.tests import factories
-from inboxen.test import InboxenTestCase
+from inboxen.tests.example_emails import BODY
+from inboxen.test import InboxenTestCase, override_settings
+from inboxen.utils import counters, email as email_utils, flag_buffer
 
 
 class StatsTestCase(InboxenTestCase):
@@ -71,6 +79,9 @@ class StatsTestCase(InboxenTestCase):
         # user 3
         factories.UserFactory()
 
+        # factories don't update counters
+        tasks.reconcile_counters()
+
         tasks.statistics.delay()
         stats = models.Statistic.objects.get()
 
@@ -82,11 +93,39 @@ class StatsTestCase(InboxenTestCase):
         self.assertEqual(stats.inboxes["inbox_count__max"], 2)
         self.assertEqual(stats.inboxes["inbox_count__min"], 0)
         self.assertEqual(stats.inboxes["inbox_count__avg"], 4.0/3)
+        self.assertAlmostEqual(stats.inboxes["inbox_count__stddev"], (8.0/9) ** 0.5)
+        self.assertEqual(stats.inboxes["with_emails"], 4)
 
         self.assertEqual(stats.emails["email_count__sum"], 8)
         self.assertEqual(stats.emails["email_count__max"], 2)
         self.assertEqual(stats.emails["email_count__min"], 2)
         self.assertEqual(stats.emails["email_count__avg"], 2)
+        self.assertEqual(stats.emails["email_count__stddev"], 0)
+        self.assertEqual(stats.emails["emails_read"], 0)
+
+    def test_verify(self):
+        user = factories.UserFactory()
+        factories.EmailFactory.create_batch(3, inbox__user=user, read=True)
+
+        # counters haven't been updated, so they disagree with the database
+        with mock.patch("inboxen.tasks.log") as log_mock:
+            tasks.statistics.delay()
+        self.assertEqual(log_mock.warning.call_count, 0)
+        stats = models.Statistic.objects.latest("date")
+        self.assertEqual(stats.emails["email_count__sum"], 0)
+
+        with mock.patch("inboxen.tasks.log") as log_mock:
+            tasks.statistics.delay(verify=True)
+        self.assertNotEqual(log_mock.warning.call_count, 0)
+        stats = models.Statistic.objects.latest("date")
+        self.assertEqual(stats.emails["email_count__sum"], 3)
+        self.assertEqual(stats.emails["emails_read"], 3)
+
+        # once reconciled, they match
+        tasks.reconcile_counters()
+        with mock.patch("inboxen.tasks.log") as log_mock:
+            tasks.statistics.delay(verify=True)
+        self.assertEqual(log_mock.warning.call_count, 0)
 
     def test_running_total(self):
         tasks.statistics.delay()
@@ -98,6 +137,7 @@ class StatsTestCase(InboxenTestCase):
 
         factories.InboxFactory()
         factories.EmailFactory.create_batch(2)
+        tasks.reconcile_counters()
 
         # first count
         tasks.statistics.delay()
@@ -107,6 +147,7 @@ class StatsTestCase(InboxenTestCase):
 
         # running total should not have gone down
         models.Email.objects.first().delete()
+        tasks.reconcile_counters()
         tasks.statistics.delay()
         stats = models.Statistic.objects.latest("date")
         self.assertEqual(stats.emails["email_count__sum"], 1)
@@ -114,6 +155,7 @@ class StatsTestCase(InboxenTestCase):
 
         # running total should now increase
         factories.EmailFactory()
+        tasks.reconcile_counters()
         tasks.statistics.delay()
         stats = models.Statistic.objects.latest("date")
         self.assertEqual(stats.emails["email_count__sum"], 2)
@@ -134,10 +176,9 @@ class CleanSessionsTestCase(InboxenTestCase):
 
 class FlagTestCase(InboxenTestCase):
     """Test flag tasks"""
-    # only testing that it doesn't raise an exception atm
-    # TODO: actually test
     def setUp(self):
         super(FlagTestCase, self).setUp()
+        cache.clear()
         self.user = factories.UserFactory()
         self.inboxes = [
             factories.InboxFactory(user=self.user),
@@ -146,15 +187,179 @@ class FlagTestCase(InboxenTestCase):
         self.emails = factories.EmailFactory.create_batch(10, inbox=self.inboxes[0])
         self.emails.extend(factories.EmailFactory.create_batch(10, inbox=self.inboxes[1]))
 
+        self.profile = self.user.inboxenprofile
+        self.profile.unified_has_new_messages = True
+        self.profile.save(update_fields=["unified_has_new_messages"])
+        tasks.reconcile_counters(user_id=self.user.id)
+
     def test_flags_from_unified(self):
         tasks.deal_with_flags.delay([email.id for email in self.emails], user_id=self.user.id)
+        self.assertEqual(models.Email.objects.filter(seen=False).count(), 0)
+
+    def test_write_flags(self):
+        other_email = factories.EmailFactory()
+
+        tasks.write_flags(self.user.id, [email.id for email in self.emails[10:]] + [other_email.id],
+                          [self.emails[0].id])
+
+        self.assertEqual(models.Email.objects.filter(read=True).get(), self.emails[0])
+        self.assertEqual(models.Email.objects.filter(seen=True).count(), 11)
+        # other users' emails are left alone
+        other_email.refresh_from_db()
+        self.assertFalse(other_email.seen)
+
+        # everything in the second inbox has been seen
+        self.inboxes[1].refresh_from_db()
+        self.assertFalse(self.inboxes[1].new)
+        self.assertEqual((self.inboxes[1].total_count, self.inboxes[1].unseen_count, self.inboxes[1].unread_count),
+                         (10, 0, 10))
+        self.inboxes[0].refresh_from_db()
+        self.assertEqual((self.inboxes[0].total_count, self.inboxes[0].unseen_count, self.inboxes[0].unread_count),
+                         (10, 9, 9))
+
+        # but not everything in the Unified Inbox
+        self.profile.refresh_from_db()
+        self.assertTrue(self.profile.unified_has_new_messages)
+        self.assertEqual((self.profile.total_count, self.profile.unseen_count, self.profile.unread_count),
+                         (20, 9, 19))
+
+        # nothing has changed, so "new" flags are left alone
+        with mock.patch("inboxen.tasks.inbox_new_flag") as new_flag_mock:
+            tasks.write_flags(self.user.id, [email.id for email in self.emails[10:]], [self.emails[0].id])
+        self.assertEqual(new_flag_mock.call_count, 0)
+
+    def test_mark_deleted(self):
+        self.emails[0].seen = True
+        self.emails[0].save()
+        self.emails[1].deleted = True
+        self.emails[1].save()
+        tasks.reconcile_counters(user_id=self.user.id)
+
+        # joins on Inbox, already deleted emails aren't counted again
+        emails = models.Email.objects.filter(inbox__user=self.user, id__in=[email.id for email in self.emails[:9]])
+        with mock.patch("inboxen.utils.counters.update_counters", wraps=counters.update_counters) as update_mock:
+            counts = counters.mark_deleted(emails, batch_size=3)
+        self.assertEqual(update_mock.call_count, 3)
+        self.assertEqual(counts, {self.inboxes[0].id: (8, 7, 8)})
+        self.assertEqual(models.Email.objects.filter(deleted=True).count(), 9)
+
+        self.inboxes[0].refresh_from_db()
+        self.assertEqual((self.inboxes[0].total_count, self.inboxes[0].unseen_count, self.inboxes[0].unread_count),
+                         (1, 1, 1))
+        self.profile.refresh_from_db()
+        self.assertEqual((self.profile.total_count, self.profile.unseen_count, self.profile.unread_count),
+                         (11, 11, 11))
+
+    def test_reconcile_counters(self):
+        self.emails[0].deleted = True
+        self.emails[0].save()
+        self.emails[1].seen = True
+        self.emails[1].read = True
+        self.emails[1].save()
+        self.inboxes[1].exclude_from_unified = True
+        self.inboxes[1].save()
+        models.Inbox.objects.update(total_count=100, unseen_count=-3, unread_count=7)
+
+        tasks.reconcile_counters()
+
+        self.inboxes[0].refresh_from_db()
+        self.assertEqual((self.inboxes[0].total_count, self.inboxes[0].unseen_count, self.inboxes[0].unread_count),
+                         (9, 8, 8))
+        self.inboxes[1].refresh_from_db()
+        self.assertEqual((self.inboxes[1].total_count, self.inboxes[1].unseen_count, self.inboxes[1].unread_count),
+                         (10, 10, 10))
+        self.profile.refresh_from_db()
+        self.assertEqual((self.profile.total_count, self.profile.unseen_count, self.profile.unread_count),
+                         (9, 8, 8))
+
+    def test_buffer(self):
+        flag_buffer.buffer_flags(self.user.id, seen=[self.emails[0].id])
+        flag_buffer.buffer_flags(self.user.id, seen=[self.emails[1].id], read=[self.emails[2].id])
+        self.assertEqual(models.Email.objects.filter(seen=True).count(), 0)
+
+        # buffered changes can be seen before they're written
+        emails = list(models.Email.objects.filter(id__in=[email.id for email in self.emails[:3]]).order_by("id"))
+        flag_buffer.apply_buffered_flags(self.user.id, emails)
+        self.assertEqual([(email.seen, email.read) for email in emails], [(True, False), (True, False), (True, True)])
+
+        tasks.flush_flags()
+        self.assertEqual(models.Email.objects.filter(seen=True).count(), 3)
+        self.assertEqual(models.Email.objects.filter(read=True).get(), self.emails[2])
+        self.assertEqual(flag_buffer.pop_buffered_flags(), {})
+
+    def test_buffer_locked(self):
+        # changes are written straight away rather than waiting for the lock
+        key = flag_buffer.create_flag_cache_key(self.user.id) + flag_buffer.FLAG_LOCK_SUFFIX
+        cache.add(key, True)
+        try:
+            flag_buffer.buffer_flags(self.user.id, seen=[self.emails[0].id])
+            self.assertEqual(models.Email.objects.filter(seen=True).get(), self.emails[0])
+            self.assertEqual(flag_buffer.get_buffered_flags(self.user.id), {"seen": set(), "read": set()})
+
+            # flushing leaves locked users alone
+            cache.delete(key)
+            flag_buffer.buffer_flags(self.user.id, seen=[self.emails[1].id])
+            cache.add(key, True)
+            self.assertEqual(flag_buffer.pop_buffered_flags(), {})
+        finally:
+            cache.delete(key)
+
+        self.assertEqual(flag_buffer.pop_buffered_flags(),
+                         {self.user.id: {"seen": {self.emails[1].id}, "read": set()}})
+
+    def test_buffer_disabled(self):
+        with override_settings(FLAG_BUFFER=False):
+            flag_buffer.buffer_flags(self.user.id, seen=[self.emails[0].id])
+        self.assertEqual(models.Email.objects.filter(seen=True).get(), self.emails[0])
+        self.assertEqual(flag_buffer.pop_buffered_flags(), {})
+
+
+class PrerenderTestCase(InboxenTestCase):
+    def setUp(self):
+        super(PrerenderTestCase, self).setUp()
+        caches[email_utils.RENDER_CACHE].clear()
 
-    def test_flags_from_single_inbox(self):
-        tasks.deal_with_flags.delay(
-            [email.id for email in self.emails],
-            user_id=self.user.id,
-            inbox_id=self.inboxes[0].id,
-        )
+        self.email = factories.EmailFactory(received_date=timezone.now())
+        self.body = factories.BodyFactory(data=BODY)
+        part = factories.PartListFactory(email=self.email, body=self.body)
+        factories.HeaderFactory(part=part, name="Content-Type", data="text/html; charset=\"utf-8\"")
+
+    def test_prerender(self):
+        key = email_utils.render_cache_key(self.body.hashed, "utf-8", False)
+        self.assertEqual(caches[email_utils.RENDER_CACHE].get(key), None)
+
+        tasks.prerender_emails([self.email.id])
+
+        rendered = caches[email_utils.RENDER_CACHE].get(key)
+        self.assertEqual(rendered["body"], email_utils._render_html(BODY, "utf-8", False)["body"])
+
+    def test_prerender_query_count(self):
+        with CaptureQueriesContext(connection) as queries:
+            tasks.prerender_emails([self.email.id])
+        query_count = len(queries)
+
+        caches[email_utils.RENDER_CACHE].clear()
+        for i in range(5):
+            part = factories.PartListFactory(email=self.email, body=factories.BodyFactory(data=six.b("part %d" % i)))
+            factories.HeaderFactory(part=part, name="Content-Type", data="text/plain")
+
+        # content headers are fetched for all parts at once
+        with self.assertNumQueries(query_count):
+            tasks.prerender_emails([self.email.id])
+
+    def test_prerender_command(self):
+        old_email = factories.EmailFactory(received_date=timezone.now() - timedelta(days=2))
+
+        with mock.patch("inboxen.management.commands.prerender_emails.prerender_emails") as task_mock:
+            call_command("prerender_emails", stdout=six.StringIO())
+        self.assertEqual(task_mock.delay.call_count, 1)
+        self.assertEqual(task_mock.delay.call_args[0][0], [self.email.id])
+
+        with mock.patch("inboxen.management.commands.prerender_emails.prerender_emails") as task_mock:
+            call_command("prerender_emails", days=3, batch_size=1, stdout=six.StringIO())
+        self.assertEqual(task_mock.delay.call_count, 2)
+        self.assertEqual(task_mock.delay.call_args_list[0][0][0], [old_email.id])
+        self.assertEqual(task_mock.delay.call_args_list[1][0][0], [self.email.id])
 
 
 class SearchTestCase(InboxenTestCase):
@@ -234,6 +439,87 @@ class SearchTestCase(InboxenTestCase):
         with self.assertRaises(ValueError):
             tasks.search(self.user.id, "bizz", after=result_2nd["first"], before=result["last"])
 
+    def test_search_owner(self):
+        inbox = factories.InboxFactory(user=self.user, description="bizz")
+        email = factories.EmailFactory(inbox=inbox)
+        other_inbox = factories.InboxFactory(description="bizz")
+
+        def get_owner(obj):
+            content_type = ContentType.objects.get_for_model(obj)
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT owner_id FROM watson_searchentry WHERE content_type_id = %s AND "
+                               "object_id_int = %s", [content_type.id, obj.id])
+                return cursor.fetchone()[0]
+
+        self.assertEqual(get_owner(inbox), self.user.id)
+        self.assertEqual(get_owner(email), self.user.id)
+        self.assertEqual(get_owner(other_inbox), other_inbox.user_id)
+
+        entry = SearchEntry.objects.get(object_id_int=inbox.id, content_type__model="inbox")
+        result = tasks.search(self.user.id, "bizz")
+        self.assertEqual(result["results"], [entry.id])
+
+        other_inbox.user = None
+        other_inbox.save()
+        self.assertEqual(get_owner(other_inbox), None)
+
+    def test_search_bodies(self):
+        inbox = factories.InboxFactory(user=self.user)
+        email = factories.EmailFactory(inbox=inbox)
+        root = factories.PartListFactory(email=email, body=factories.BodyFactory(data=b"<p>pineapple <b>ripe</b></p>"))
+        factories.HeaderFactory(part=root, name="Content-Type", data="text/html; charset=utf-8")
+
+        attached = factories.EmailFactory(inbox=inbox)
+        root = factories.PartListFactory(email=attached, body=factories.BodyFactory(data=b"pineapple"))
+        factories.HeaderFactory(part=root, name="Content-Disposition", data="attachment; filename=\"fruit.txt\"")
+
+        with override_settings(SEARCH_BODY_SIZE=15):
+            self.assertEqual(search_utils.index_bodies([email.id, attached.id]), 1)
+            # already indexed
+            self.assertEqual(search_utils.index_bodies([email.id, attached.id]), 0)
+
+            entry = SearchEntry.objects.get(object_id_int=email.id, content_type__model="email")
+            self.assertEqual(tasks.search(self.user.id, "pineapple")["results"], [entry.id])
+            # past SEARCH_BODY_SIZE
+            self.assertEqual(tasks.search(self.user.id, "ripe")["results"], [])
+
+        with override_settings(SEARCH_BODY_SIZE=0):
+            self.assertEqual(tasks.search(self.user.id, "pineapple")["results"], [])
+
+    def test_search_bodies_timeout(self):
+        results = {"results": [], "has_next": False, "has_previous": False}
+        with mock.patch("inboxen.tasks._search_page", side_effect=[OperationalError, results]) as search_mock:
+            self.assertEqual(tasks.search(self.user.id, "pineapple"), results)
+
+        self.assertEqual(search_mock.call_count, 2)
+        self.assertEqual(search_mock.call_args_list[0][1], {"backend_name": "inboxen.search.BodySearchBackend"})
+        self.assertEqual(search_mock.call_args_list[1][1], {})
+
+    def test_index_emails(self):
+        emails = factories.EmailFactory.create_batch(3, inbox__user=self.user)
+        for email in emails:
+            models.EmailSummary.objects.create(email=email, subject="bizz {}".format(email.id))
+        deleted = factories.EmailFactory(inbox__user=self.user, deleted=True)
+        SearchEntry.objects.all().delete()
+
+        for email_id in [email.id for email in emails] + [deleted.id, 0]:
+            models.UnindexedEmail.objects.create(email_id=email_id)
+
+        with mock.patch("inboxen.tasks.index_emails.delay", wraps=tasks.index_emails.delay) as index_mock:
+            tasks.index_emails(batch_size=3)
+        # the first batch was full, so it carried on
+        self.assertEqual(index_mock.call_count, 1)
+
+        entries = SearchEntry.objects.order_by("object_id_int")
+        self.assertEqual([entry.object_id_int for entry in entries], [email.id for email in emails])
+        self.assertEqual([entry.title for entry in entries], ["bizz {}".format(email.id) for email in emails])
+        self.assertEqual(models.UnindexedEmail.objects.count(), 0)
+
+        # indexing again doesn't duplicate entries
+        models.UnindexedEmail.objects.create(email_id=emails[0].id)
+        tasks.index_emails()
+        self.assertEqual(SearchEntry.objects.count(), 3)
+
 
 class DeleteTestCase(InboxenTestCase):
     def setUp(self):
@@ -266,20 +552,88 @@ class DeleteTestCase(InboxenTestCase):
         # test with an empty list
         tasks.delete_inboxen_item.chunks([], 500)()
 
+    def test_delete_emails(self):
+        inbox = factories.InboxFactory(user=self.user)
+        emails = factories.EmailFactory.create_batch(5, inbox=inbox, deleted=True)
+        other_email = factories.EmailFactory(inbox=inbox)
+        for email in emails + [other_email]:
+            root = factories.PartListFactory(email=email)
+            factories.HeaderFactory(part=root)
+            child = factories.PartListFactory(email=email, parent=root)
+            factories.HeaderFactory(part=child)
+            models.EmailSummary.objects.create(email=email)
+        self.assertEqual(SearchEntry.objects.filter(content_type__model="email").count(), 6)
+
+        with mock.patch("inboxen.tasks.log") as log_mock:
+            tasks.delete_emails.delay({"inbox_id": inbox.id, "deleted": True}, batch_size=2)
+
+        # progress is logged after each batch
+        self.assertEqual([call[0][1] for call in log_mock.info.call_args_list], [2, 4, 5, 5])
+
+        self.assertEqual(list(models.Email.objects.all()), [other_email])
+        self.assertEqual(models.PartList.objects.exclude(email=other_email).count(), 0)
+        self.assertEqual(models.Header.objects.exclude(part__email=other_email).count(), 0)
+        self.assertEqual(models.EmailSummary.objects.exclude(email=other_email).count(), 0)
+        self.assertEqual(SearchEntry.objects.filter(content_type__model="email").count(), 1)
+
+        # bodies and header data are left for collect_orphans
+        self.assertEqual(models.Body.objects.filter(partlist__isnull=True).count(), 10)
+        self.assertEqual(models.OrphanCandidate.objects.filter(kind=models.OrphanCandidate.BODY).count(), 10)
+        self.assertEqual(models.OrphanCandidate.objects.filter(kind=models.OrphanCandidate.HEADER_DATA).count(), 10)
+
+    def test_collect_orphans(self):
+        inbox = factories.InboxFactory(user=self.user)
+        shared_body = factories.BodyFactory()
+        deleted_email = factories.EmailFactory(inbox=inbox, deleted=True)
+        kept_email = factories.EmailFactory(inbox=inbox)
+        for email in [deleted_email, kept_email]:
+            factories.HeaderFactory(part=factories.PartListFactory(email=email, body=shared_body), data="shared")
+            factories.HeaderFactory(part=factories.PartListFactory(email=email))
+        # not queued, so left for clean_orphan_models
+        unqueued_body = factories.BodyFactory()
+
+        tasks.delete_emails.delay({"deleted": True})
+        self.assertEqual(models.OrphanCandidate.objects.count(), 4)
+
+        with mock.patch("inboxen.tasks.collect_orphans.apply_async") as apply_mock:
+            tasks.collect_orphans(batch_size=3)
+        self.assertEqual(apply_mock.call_count, 1)
+        self.assertEqual(models.OrphanCandidate.objects.count(), 1)
+
+        tasks.collect_orphans(batch_size=3)
+        self.assertEqual(models.OrphanCandidate.objects.count(), 0)
+
+        # only what was used by deleted_email alone has gone
+        self.assertEqual(models.Body.objects.filter(partlist__isnull=True).get(), unqueued_body)
+        self.assertEqual(models.HeaderData.objects.filter(header__isnull=True).count(), 0)
+        self.assertEqual(models.Body.objects.count(), 3)
+        self.assertEqual(models.HeaderData.objects.count(), 2)
+
     def test_batch_delete_items(self):
         with self.assertRaises(Exception):
             tasks.batch_delete_items("email")
 
-        mock_qs = mock.Mock()
-        mock_qs.filter.return_value.iterator.return_value = []
-        with mock.patch("inboxen.tasks.models.Email.objects.only", return_value=mock_qs):
-            tasks.batch_delete_items("email", args=[12, 14])
-            self.assertTrue(mock_qs.filter.called)
-            self.assertEqual(mock_qs.filter.call_args, ((12, 14), {}))
-
-        mock_qs = mock.Mock()
-        mock_qs.filter.return_value.iterator.return_value = []
-        with mock.patch("inboxen.tasks.models.Email.objects.only", return_value=mock_qs):
-            tasks.batch_delete_items("email", kwargs={"a": "b"})
-            self.assertTrue(mock_qs.filter.called)
-            self.assertEqual(mock_qs.filter.call_args, ((), {"a": "b"}))
+        inbox = factories.InboxFactory(user=self.user)
+        emails = sorted(factories.EmailFactory.create_batch(7, inbox=inbox), key=lambda email: email.id)
+        other_email = factories.EmailFactory(inbox__user=self.user)
+
+        # carry on from after the second email, three at a time
+        with mock.patch("inboxen.tasks.log") as log_mock:
+            tasks.batch_delete_items("email", kwargs={"inbox__id": inbox.id}, batch_number=3, after=emails[1].id)
+        self.assertEqual(log_mock.info.call_count, 2)
+
+        self.assertEqual(list(models.Email.objects.order_by("id")), emails[:2] + [other_email])
+
+    def test_batch_delete_items_in_use(self):
+        bodies = factories.BodyFactory.create_batch(3)
+        used_body = bodies[1]
+        factories.PartListFactory(email=factories.EmailFactory(), body=used_body)
+
+        # pretend that used_body was orphaned when the task started
+        with mock.patch("inboxen.tasks.models.Body.objects.filter", side_effect=[
+            models.Body.objects.filter(id__in=[body.id for body in bodies]),
+            models.Body.objects.filter(id__in=[body.id for body in bodies]),
+        ]):
+            tasks.batch_delete_items("body", kwargs={"partlist__isnull": True})
+
+        self.assertEqual(list(models.Body.objects.all()), [used_body])
@@ -0,0 +1,71 @@
+##
+#    Copyright (C) 2018 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+import hashlib
+import math
+import struct
+
+from django.utils.encoding import smart_bytes
+
+
+class BloomFilter(object):
+    """A compact set of strings that can give false positives, but never false
+    negatives
+
+    Items can't be removed, create a new filter instead.
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        assert capacity > 0, "Capacity must be greater than 0 (zero)"
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.count = 0
+
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(float(self.num_bits) / capacity * math.log(2))))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _indexes(self, item):
+        # double hashing, see Kirsch & Mitzenmacher "Less Hashing, Same Performance"
+        digest = hashlib.sha1(smart_bytes(item)).digest()
+        first, second = struct.unpack(">QQ", digest[:16])
+        for i in range(self.num_hashes):
+            yield (first + i * second) % self.num_bits
+
+    def __contains__(self, item):
+        return all(self._bits[idx // 8] & (1 << (idx % 8)) for idx in self._indexes(item))
+
+    def add(self, item):
+        """Add `item` to the filter, returns False if it was (probably) already
+        there
+        """
+        added = False
+        for idx in self._indexes(item):
+            mask = 1 << (idx % 8)
+            if not self._bits[idx // 8] & mask:
+                self._bits[idx // 8] |= mask
+                added = True
+
+        if added:
+            self.count += 1
+
+        return added
+
+    def is_full(self):
+        """Has the filter had more items added than it was sized for"""
+        return self.count > self.capacity
@@ -0,0 +1,164 @@
+##
+#    Copyright (C) 2018 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+import errno
+import logging
+import os
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.utils.module_loading import import_string
+
+
+log = logging.getLogger(__name__)
+
+# first key of advisory locks taken on body hashes, see lock_body
+BODY_LOCK_NAMESPACE = 0x626f6479
+
+
+def lock_body(hashed, exclusive=False):
+    """Take an advisory lock on `hashed` until the end of the current transaction
+
+    Writers take a shared lock before writing to the store and hold it until
+    their Body row has been committed. Deleters take an exclusive lock before
+    checking that no row uses the data, so they can't remove data that's
+    about to be used.
+    """
+    if exclusive:
+        sql = "SELECT pg_advisory_xact_lock(%s, hashtext(%s))"
+    else:
+        sql = "SELECT pg_advisory_xact_lock_shared(%s, hashtext(%s))"
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [BODY_LOCK_NAMESPACE, hashed])
+
+
+class BaseBodyStore(object):
+    """Interface for body stores
+
+    Stores should override all of these methods.
+    """
+    def __init__(self, path, inline_size):
+        self.inline_size = inline_size
+
+    def should_store(self, size):
+        """Should a body of `size` bytes be kept in this store rather than
+        inline in the database?
+        """
+        raise NotImplementedError
+
+    def path(self, hashed):
+        """Path on the local filesystem, for use with sendfile. None if the
+        store doesn't use the filesystem
+        """
+        raise NotImplementedError
+
+    def save(self, hashed, data):
+        """Write `data`, replacing anything already kept under `hashed`"""
+        raise NotImplementedError
+
+    def open(self, hashed):
+        """Returns a file-like object opened for reading in binary mode"""
+        raise NotImplementedError
+
+    def delete(self, hashed):
+        raise NotImplementedError
+
+
+class DatabaseBodyStore(BaseBodyStore):
+    """Keeps all Body data in the database
+
+    Bodies that were kept in another store can't be read. Run
+    `./manage.py move_bodies --inline` before switching back to this store.
+    """
+    def should_store(self, size):
+        return False
+
+    def path(self, hashed):
+        return None
+
+    def _missing(self, hashed):
+        # the body's data is somewhere this store can't reach
+        return ImproperlyConfigured(
+            "Body %s is kept in the body store, but the [body_store] backend is \"database\". Switch back to the "
+            "previous backend and run `./manage.py move_bodies --inline` first." % hashed
+        )
+
+    def save(self, hashed, data):
+        raise self._missing(hashed)
+
+    def open(self, hashed):
+        raise self._missing(hashed)
+
+    def delete(self, hashed):
+        log.error("Body %s was left in the body store, as the [body_store] backend is \"database\"", hashed)
+
+
+class FileSystemBodyStore(BaseBodyStore):
+    """Keeps large bodies in files named after their hash
+
+    Files are sharded into directories by the first few characters of the
+    hash, e.g. sha256:abcdef... is kept in <path>/sha256/ab/cd/abcdef...
+    """
+    def __init__(self, path, inline_size):
+        super(FileSystemBodyStore, self).__init__(path, inline_size)
+        self.root = path
+
+    def should_store(self, size):
+        return size > self.inline_size
+
+    def path(self, hashed):
+        algo, digest = hashed.split(":", 1)
+        return os.path.join(self.root, algo, digest[:2], digest[2:4], digest)
+
+    def save(self, hashed, data):
+        # always written, even if the file exists, as it might be about to be deleted
+        path = self.path(hashed)
+        try:
+            os.makedirs(os.path.dirname(path), 0o700)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+        tmp_path = "{0}.{1}.tmp".format(path, uuid.uuid4().hex)
+        with open(tmp_path, "wb") as body_file:
+            body_file.write(data)
+            body_file.flush()
+            os.fsync(body_file.fileno())
+
+        os.rename(tmp_path, path)
+
+    def open(self, hashed):
+        return open(self.path(hashed), "rb")
+
+    def delete(self, hashed):
+        try:
+            os.unlink(self.path(hashed))
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            log.warning("Body %s was missing from the store", hashed)
+
+
+def get_body_store():
+    """Returns an instance of BODY_STORE_BACKEND"""
+    backend = import_string(settings.BODY_STORE_BACKEND)
+    return backend(settings.BODY_STORE_PATH, settings.BODY_STORE_INLINE_SIZE)
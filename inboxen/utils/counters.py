@@ -0,0 +1,112 @@
+##
+#    Copyright (C) 2018 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+
+"""Counters of total, unseen and unread emails
+
+Each Inbox counts the emails in it that haven't been deleted, and each
+UserProfile counts the emails in its user's Unified Inbox. Counters are
+updated along with the emails they count, inboxen.tasks.reconcile_counters
+repairs any drift.
+"""
+
+from django.db import transaction
+from django.db.models import F
+
+from inboxen import models
+
+COUNTER_FIELDS = ("total_count", "unseen_count", "unread_count")
+
+# number of emails mark_deleted marks in each transaction
+MARK_DELETED_BATCH_SIZE = 1000
+
+
+def counter_expressions(total, unseen, unread):
+    """Returns keyword arguments for QuerySet.update() that add to counters,
+    use negative numbers to subtract"""
+    return {
+        "total_count": F("total_count") + total,
+        "unseen_count": F("unseen_count") + unseen,
+        "unread_count": F("unread_count") + unread,
+    }
+
+
+def update_counters(counts, sign=1):
+    """Add `counts` to Inbox counters and to the Unified Inbox counters of
+    their owners, subtract them if `sign` is -1
+
+    `counts` is a dictionary of Inbox IDs and (total, unseen, unread) tuples.
+    Should be called inside the same transaction that changed the emails.
+    """
+    if len(counts) == 0:
+        return
+
+    user_counts = {}
+    inboxes = models.Inbox.objects.filter(id__in=counts.keys()).order_by("id")
+    for inbox_id, user_id, excluded in inboxes.values_list("id", "user_id", "exclude_from_unified"):
+        total, unseen, unread = [count * sign for count in counts[inbox_id]]
+        models.Inbox.objects.filter(id=inbox_id).update(**counter_expressions(total, unseen, unread))
+
+        if user_id is None or excluded:
+            continue
+
+        user_total, user_unseen, user_unread = user_counts.get(user_id, (0, 0, 0))
+        user_counts[user_id] = (user_total + total, user_unseen + unseen, user_unread + unread)
+
+    for user_id in sorted(user_counts.keys()):
+        models.UserProfile.objects.filter(user_id=user_id).update(**counter_expressions(*user_counts[user_id]))
+
+
+def mark_deleted(emails, batch_size=MARK_DELETED_BATCH_SIZE):
+    """Mark `emails` as deleted and subtract them from counters, returns a
+    dictionary of Inbox IDs and (total, unseen, unread) tuples
+
+    Emails are marked in windows of `batch_size` by ID, each in its own short
+    transaction. Rows are locked before they're counted, so flags can't
+    change between counting and marking. Emails that are already deleted
+    aren't counted again.
+    """
+    counts = {}
+    last_id = 0
+    while True:
+        window = emails.filter(id__gt=last_id, deleted=False).order_by("id").values_list("id", flat=True)
+        window = list(window[:batch_size])
+        if len(window) == 0:
+            break
+        last_id = window[-1]
+
+        with transaction.atomic():
+            # only lock emails, not any rows `emails` might be joined to
+            locked = models.Email.objects.filter(id__in=window, deleted=False).order_by("id").select_for_update()
+
+            window_counts = {}
+            email_ids = []
+            for email_id, inbox_id, seen, read in locked.values_list("id", "inbox_id", "seen", "read"):
+                total, unseen, unread = window_counts.get(inbox_id, (0, 0, 0))
+                window_counts[inbox_id] = (total + 1, unseen + int(not seen), unread + int(not read))
+                email_ids.append(email_id)
+
+            if len(email_ids) > 0:
+                models.Email.objects.filter(id__in=email_ids).update(deleted=True)
+                update_counters(window_counts, sign=-1)
+
+        for inbox_id, window_count in window_counts.items():
+            counts[inbox_id] = tuple(a + b for a, b in zip(counts.get(inbox_id, (0, 0, 0)), window_count))
+
+    return counts
@@ -0,0 +1,122 @@
+##
+#    Copyright (C) 2018 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+
+"""Delete emails with a handful of queries per batch
+
+Django's deletion collector loads every related row before deleting them,
+which is far too slow for emails: each one has several parts and dozens of
+headers. Instead, emails are deleted in batches with one DELETE per table.
+"""
+
+import logging
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from watson.models import SearchEntry
+
+from inboxen import models
+
+DELETE_BATCH_SIZE = 5000
+
+_log = logging.getLogger(__name__)
+
+
+def _table(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+def _delete_batch(email_ids):
+    """Delete emails and everything that depends on them, returns the number
+    of emails deleted
+
+    Tables are cleared in dependency order. Bodies and header data are shared
+    between emails, so the ones these emails used are queued to be checked
+    by collect_orphans. Header names are left for clean_orphan_models
+    """
+    email_type = ContentType.objects.get_for_model(models.Email)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO {0} (kind, object_id, queued) SELECT DISTINCT %s, body_id, now() FROM {1} "
+            "WHERE email_id = ANY(%s)".format(
+                _table(models.OrphanCandidate),
+                _table(models.PartList),
+            ),
+            [models.OrphanCandidate.BODY, email_ids],
+        )
+        cursor.execute(
+            "INSERT INTO {0} (kind, object_id, queued) SELECT DISTINCT %s, data_id, now() FROM {1} "
+            "WHERE part_id IN (SELECT id FROM {2} WHERE email_id = ANY(%s))".format(
+                _table(models.OrphanCandidate),
+                _table(models.Header),
+                _table(models.PartList),
+            ),
+            [models.OrphanCandidate.HEADER_DATA, email_ids],
+        )
+        # index_emails holds these while it indexes, so wait for it before
+        # deleting search entries
+        cursor.execute("DELETE FROM {} WHERE email_id = ANY(%s)".format(_table(models.UnindexedEmail)), [email_ids])
+        cursor.execute(
+            "DELETE FROM {} WHERE content_type_id = %s AND object_id_int = ANY(%s)".format(_table(SearchEntry)),
+            [email_type.id, email_ids],
+        )
+        cursor.execute(
+            "DELETE FROM {} WHERE part_id IN (SELECT id FROM {} WHERE email_id = ANY(%s))".format(
+                _table(models.Header),
+                _table(models.PartList),
+            ),
+            [email_ids],
+        )
+        cursor.execute("DELETE FROM {} WHERE email_id = ANY(%s)".format(_table(models.PartList)), [email_ids])
+        cursor.execute("DELETE FROM {} WHERE email_id = ANY(%s)".format(_table(models.EmailSummary)), [email_ids])
+        cursor.execute("DELETE FROM {} WHERE id = ANY(%s)".format(_table(models.Email)), [email_ids])
+        return cursor.rowcount
+
+
+def delete_in_batches(emails, batch_size=DELETE_BATCH_SIZE, progress=None):
+    """Delete every email in the QuerySet `emails`, returns the number of
+    emails deleted
+
+    Emails are taken in order of ID and each batch is deleted in its own
+    transaction, so a large delete doesn't hold locks for long and can be
+    picked up again if it's interrupted. `progress`, if given, is called
+    with the running total after each batch.
+
+    Signals aren't sent and counters aren't updated, mark emails as deleted
+    first (see inboxen.utils.counters).
+    """
+    emails = emails.order_by("id").values_list("id", flat=True)
+    last_id = None
+    total = 0
+
+    while True:
+        batch = emails if last_id is None else emails.filter(id__gt=last_id)
+        batch = list(batch[:batch_size])
+        if len(batch) == 0:
+            break
+
+        with transaction.atomic():
+            total += _delete_batch(batch)
+
+        last_id = batch[-1]
+        _log.debug("Deleted %s emails, up to ID %s", total, last_id)
+        if progress is not None:
+            progress(total)
+
+    return total
@@ -23,10 +23,12 @@ It's in "utils" because "domain.py" would get confusing :P """
 
 from __future__ import print_function
 
+import hashlib
 import re
 import logging
 
 from django.contrib import messages
+from django.core.cache import caches
 from django.contrib.staticfiles.storage import staticfiles_storage
 from django.utils import html as html_utils, safestring
 from django.utils.translation import ugettext as _
@@ -47,6 +49,17 @@ HTML_ALLOW_TAGS = ["p", "a", "i", "b", "em", "strong", "ol", "ul", "li", "pre",
                    "code", "img", "div", "span", "table", "tr", "th", "td",
                    "thead", "tbody", "tfooter", "br"]
 
+# cache alias for rendered html parts, see CACHES in inboxen.config
+RENDER_CACHE = "render"
+RENDER_CACHE_PREFIX = "inboxen-render-"
+# rendered parts larger than this (in characters) aren't worth keeping
+RENDER_CACHE_MAX_SIZE = 512 * 1024
+
+# length of the plain text preview kept in EmailSummary
+PREVIEW_LENGTH = 200
+
+WHITESPACE = re.compile(r"\s+", re.UNICODE)
+
 
 _log = logging.getLogger(__name__)
 
@@ -72,11 +85,32 @@ def unicode_damnit(data, charset="utf-8", errors="replace"):
         return six.text_type(six.binary_type(data), "ascii", errors)
 
 
-def _clean_html_body(request, email, body, charset):
+def render_cache_key(hashed, charset, display_images):
+    """Key for a rendered html part
+
+    Everything that changes the output of `_render_html` needs to be part of
+    the key, including the placeholder URL as that changes when static files
+    are updated.
+    """
+    key = u"{}:{}:{}:{}".format(
+        hashed,
+        charset,
+        int(bool(display_images)),
+        staticfiles_storage.url("imgs/placeholder.svg"),
+    )
+    return RENDER_CACHE_PREFIX + hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def _render_html(body, charset, display_images, eid=None):
     """Clean up a html part as best we can
 
+    Returns a dictionary with the cleaned up html as "body", whether or not
+    images were removed as "has_images" and whether or not Premailer failed as
+    "css_failed". There's nothing request specific in it, so it can be cached.
+
     Doesn't catch LXML errors
     """
+    rendered = {"has_images": False, "css_failed": False}
     html_tree = lxml_html.fromstring(body)
 
     # if the HTML doc says its a different encoding, use that
@@ -99,8 +133,8 @@ def _clean_html_body(request, email, body, charset):
             html_tree = InboxenPremailer(html_tree).transform()
     except Exception as exc:
         # Yeah, a pretty wide catch, but Premailer likes to throw up everything and anything
-        messages.info(request, _("Part of this message could not be parsed - it may not display correctly"))
-        _log.warning("Failed to render CSS for %s: %s", email["eid"], exc)
+        rendered["css_failed"] = True
+        _log.warning("Failed to render CSS for %s: %s", eid, exc)
 
     # Mail Pile uses this, give back if you come up with something better
     cleaner = Cleaner(
@@ -115,14 +149,14 @@ def _clean_html_body(request, email, body, charset):
     html_tree = cleaner.clean_html(html_tree)
 
     # filter images if we need to
-    if not email["display_images"]:
+    if not display_images:
         for img in html_tree.xpath("//img"):
             try:
                 # try to delete src first - we don't want to add a src where there wasn't one already
                 del img.attrib["src"]
                 # replace image with 1px png
                 img.attrib["src"] = staticfiles_storage.url("imgs/placeholder.svg")
-                email["has_images"] = True
+                rendered["has_images"] = True
             except KeyError:
                 pass
 
@@ -141,8 +175,46 @@ def _clean_html_body(request, email, body, charset):
         link.attrib["rel"] = "noreferrer"
 
     # finally, export to unicode
-    body = unicode_damnit(etree.tostring(html_tree, method="html"), charset)
-    return safestring.mark_safe(body)
+    rendered["body"] = unicode_damnit(etree.tostring(html_tree, method="html"), charset)
+    return rendered
+
+
+def _apply_rendered(request, email, rendered):
+    """Updates `email` and messages from the output of `_render_html`, returns
+    the body"""
+    if rendered["css_failed"]:
+        messages.info(request, _("Part of this message could not be parsed - it may not display correctly"))
+
+    if rendered["has_images"]:
+        email["has_images"] = True
+
+    return safestring.mark_safe(rendered["body"])
+
+
+def _clean_html_body(request, email, body, charset):
+    """Clean up a html part as best we can
+
+    Doesn't catch LXML errors
+    """
+    rendered = _render_html(body, charset, email["display_images"], email.get("eid"))
+    return _apply_rendered(request, email, rendered)
+
+
+def render_html_part(part, display_images, eid=None):
+    """Render a text/html part, using the render cache if possible
+
+    Bodies never change, so entries are keyed by the body's hash and can be
+    shared between every copy of an email. Doesn't catch LXML errors.
+    """
+    render_cache = caches[RENDER_CACHE]
+    key = render_cache_key(part.body.hashed, part.charset, display_images)
+    rendered = render_cache.get(key)
+    if rendered is None:
+        rendered = _render_html(part.body.get_data(), part.charset, display_images, eid)
+        if len(rendered["body"]) <= RENDER_CACHE_MAX_SIZE:
+            render_cache.set(key, rendered)
+
+    return rendered
 
 
 def render_body(request, email, attachments):
@@ -181,18 +253,19 @@ def render_body(request, email, attachments):
     # finally, set the body to something
     if plain_message:
         if plain is not None:
-            body = unicode_damnit(plain.body.data, plain.charset)
+            body = unicode_damnit(plain.body.get_data(), plain.charset)
         elif len(attachments) == 1:
             # non-MIME email, only "part" must be plain text
-            body = unicode_damnit(attachments[0].body.data, attachments[0].charset)
+            body = unicode_damnit(attachments[0].body.get_data(), attachments[0].charset)
         else:
             body = u""
     else:
         try:
-            body = _clean_html_body(request, email, six.binary_type(html.body.data), html.charset)
+            rendered = render_html_part(html, email["display_images"], email.get("eid"))
+            body = _apply_rendered(request, email, rendered)
         except (etree.LxmlError, ValueError) as exc:
-            if plain is not None and len(plain.body.data) > 0:
-                body = unicode_damnit(plain.body.data, plain.charset)
+            if plain is not None and len(plain.body.get_data()) > 0:
+                body = unicode_damnit(plain.body.get_data(), plain.charset)
             else:
                 body = u""
 
@@ -210,6 +283,52 @@ def render_body(request, email, attachments):
     return body
 
 
+def extract_text(data, content_type, charset):
+    """Get the text of a text/plain or text/html body, with whitespace
+    collapsed"""
+    body = unicode_damnit(data, charset)
+    if content_type == "text/html":
+        try:
+            body = lxml_html.fromstring(body).text_content()
+        except (etree.LxmlError, ValueError):
+            return u""
+
+    return WHITESPACE.sub(u" ", body.replace(u"\x00", u"")).strip()
+
+
+def make_preview(data, content_type, charset):
+    """Make a short, plain text preview of a text/plain or text/html body"""
+    return extract_text(data, content_type, charset)[:PREVIEW_LENGTH]
+
+
+def make_summary(headers, leaves):
+    """Returns a dictionary of fields for EmailSummary
+
+    `headers` is a dictionary of the root part's headers and `leaves` is a list
+    of leaf parts, each with content_type, charset, filename and size
+    attributes and a get_data() method. Only the data of the first text part
+    is read.
+    """
+    summary = {
+        "subject": headers.get("Subject", u""),
+        "sender": headers.get("From", u""),
+        "size": sum(leaf.size or 0 for leaf in leaves),
+        "attachment_count": len([leaf for leaf in leaves if leaf.filename]),
+        "preview": u"",
+    }
+
+    # non-MIME emails have no Content-Type, they're plain text
+    text_parts = [leaf for leaf in leaves
+                  if leaf.content_type in ["", "text/plain", "text/html"] and not leaf.filename]
+    # prefer plain text, it's cheaper
+    text_parts.sort(key=lambda leaf: leaf.content_type == "text/html")
+    if len(text_parts) > 0:
+        summary["preview"] = make_preview(text_parts[0].get_data(), text_parts[0].content_type,
+                                          text_parts[0].charset)
+
+    return summary
+
+
 def is_leaf_text_node(part):
     """Check that a suspected text part is actually a leaf node and is of the
     correct mime type
@@ -0,0 +1,168 @@
+##
+#    Copyright (C) 2018 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""Buffer changes to the seen and read flags of emails in the cache
+
+Changes are written in bulk by inboxen.tasks.flush_flags. Until then, views
+should use apply_buffered_flags so that users see their own changes.
+
+Each user's changes are kept under their own key and users with changes are
+listed in one of FLAG_SHARDS sets, each guarded by a cache based lock. This
+relies on cache.add being atomic, which is why the buffer is only enabled for
+memcached. If a lock can't be had, changes are written straight to the
+database instead.
+"""
+
+from contextlib import contextmanager
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+FLAG_CACHE_PREFIX = "inboxen-flags-"
+FLAG_USERS_PREFIX = FLAG_CACHE_PREFIX + "users-"
+FLAG_LOCK_SUFFIX = "-lock"
+FLAG_SHARDS = 16
+# seconds before a lock is assumed to belong to a dead process
+FLAG_LOCK_TIMEOUT = 10
+FLAG_LOCK_ATTEMPTS = 10
+# buffered changes are lost if they're not flushed within this many seconds
+FLAG_BUFFER_TIMEOUT = 60 * 60
+
+
+def create_flag_cache_key(user_id):
+    return "{}{}".format(FLAG_CACHE_PREFIX, user_id)
+
+
+def _create_users_cache_key(shard):
+    return "{}{}".format(FLAG_USERS_PREFIX, shard)
+
+
+@contextmanager
+def _lock(key, attempts=FLAG_LOCK_ATTEMPTS):
+    """Cache based lock on `key`, yields True if the lock was acquired"""
+    lock_key = key + FLAG_LOCK_SUFFIX
+    for attempt in range(attempts):
+        if cache.add(lock_key, True, FLAG_LOCK_TIMEOUT):
+            locked = True
+            break
+        elif attempt < attempts - 1:
+            time.sleep(0.01)
+    else:
+        locked = False
+
+    try:
+        yield locked
+    finally:
+        if locked:
+            cache.delete(lock_key)
+
+
+def get_buffered_flags(user_id):
+    """Returns a dictionary of "seen" and "read" sets of email IDs that have
+    yet to be written to the database"""
+    return cache.get(create_flag_cache_key(user_id)) or {"seen": set(), "read": set()}
+
+
+def apply_buffered_flags(user_id, emails):
+    """Update flags on `emails` with any changes that haven't been written to
+    the database yet"""
+    flags = get_buffered_flags(user_id)
+    for email in emails:
+        if email.id in flags["read"]:
+            email.read = True
+            email.seen = True
+        elif email.id in flags["seen"]:
+            email.seen = True
+
+
+def _buffer(user_id, seen, read):
+    """Add changes to the buffer, returns False if they couldn't be added"""
+    key = create_flag_cache_key(user_id)
+    with _lock(key) as locked:
+        if not locked:
+            return False
+
+        flags = cache.get(key)
+        if flags is None:
+            # first change since the last flush, list the user so flush_flags finds them
+            users_key = _create_users_cache_key(user_id % FLAG_SHARDS)
+            with _lock(users_key) as users_locked:
+                if not users_locked:
+                    return False
+                users = cache.get(users_key) or set()
+                users.add(user_id)
+                cache.set(users_key, users, FLAG_BUFFER_TIMEOUT)
+            flags = {"seen": set(), "read": set()}
+
+        flags["seen"].update(seen)
+        flags["read"].update(read)
+        cache.set(key, flags, FLAG_BUFFER_TIMEOUT)
+
+    return True
+
+
+def buffer_flags(user_id, seen=None, read=None):
+    """Buffer changes to flags, `seen` and `read` are lists of email IDs
+
+    Emails that have been read are also marked as seen. If the buffer is
+    disabled or busy, a task is sent off to write the changes straight away.
+    """
+    seen = list(seen or [])
+    read = list(read or [])
+
+    if len(seen) == 0 and len(read) == 0:
+        return
+
+    if not settings.FLAG_BUFFER or not _buffer(user_id, seen, read):
+        from inboxen.tasks import write_flags
+        write_flags.delay(user_id, seen, read)
+
+
+def pop_buffered_flags():
+    """Remove buffered changes, returns a dictionary of user IDs and flags
+
+    Users whose changes are locked are left for next time
+    """
+    popped = {}
+    users_keys = [_create_users_cache_key(shard) for shard in range(FLAG_SHARDS)]
+    for users_key in cache.get_many(users_keys).keys():
+        with _lock(users_key, attempts=1) as users_locked:
+            if not users_locked:
+                continue
+
+            remaining = set()
+            for user_id in cache.get(users_key) or set():
+                key = create_flag_cache_key(user_id)
+                with _lock(key, attempts=1) as locked:
+                    if not locked:
+                        remaining.add(user_id)
+                        continue
+                    flags = cache.get(key)
+                    cache.delete(key)
+
+                if flags is not None:
+                    popped[user_id] = flags
+
+            if remaining:
+                cache.set(users_key, remaining, FLAG_BUFFER_TIMEOUT)
+            else:
+                cache.delete(users_key)
+
+    return popped
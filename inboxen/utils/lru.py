@@ -0,0 +1,82 @@
+##
+#    Copyright (C) 2018 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from collections import OrderedDict
+import threading
+
+
+class LRUCache(object):
+    """A process-local cache that holds at most `size` items
+
+    When full, the least recently used item is evicted to make room.
+    """
+    def __init__(self, size):
+        assert size > 0, "Size must be greater than 0 (zero)"
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+
+            self._data[key] = value
+            return value
+
+    def get_many(self, keys):
+        """Returns a dictionary of `keys` that were found in the cache"""
+        with self._lock:
+            found = {}
+            for key in keys:
+                try:
+                    found[key] = self._data.pop(key)
+                except KeyError:
+                    continue
+                self._data[key] = found[key]
+
+            return found
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        with self._lock:
+            for key, value in items.items():
+                self._data.pop(key, None)
+                self._data[key] = value
+
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
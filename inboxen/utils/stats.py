@@ -0,0 +1,106 @@
+##
+#    Copyright (C) 2018 Jessica Tallon & Matt Molyneaux
+#
+#    This file is part of Inboxen.
+#
+#    Inboxen is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Inboxen is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""Cache the statistics shown on the stats page
+
+Statistics only change when inboxen.tasks.statistics runs, which clears the
+cache once the new Statistic has been saved.
+"""
+
+import json
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.text import compress_string
+
+from inboxen import models
+
+STATS_CACHE_KEY = "inboxen-stats"
+# in case the cache isn't shared with Celery
+STATS_CACHE_TIMEOUT = 60 * 60
+# number of statistics charted on the stats page
+STATS_RECENT_COUNT = 90
+
+
+def _recent_payload():
+    objects = reversed(models.Statistic.objects.order_by("-date")[:STATS_RECENT_COUNT])
+    dates = []
+    users = []
+    active_users = []
+    inboxes = []
+    active_inboxes = []
+    emails = []
+    read_emails = []
+
+    for stat in objects:
+        dates.append(stat.date)
+
+        users.append(stat.users.get("count"))
+        active_users.append(stat.users.get("with_inboxes"))
+
+        inboxes.append(stat.inboxes.get("inbox_count__sum"))
+        active_inboxes.append(stat.inboxes.get("with_emails"))
+
+        emails.append(stat.emails.get("email_count__sum"))
+        read_emails.append(stat.emails.get("emails_read"))
+
+    data = {
+        "dates": dates,
+        "users": users,
+        "active_users": active_users,
+        "inboxes": inboxes,
+        "active_inboxes": active_inboxes,
+        "emails": emails,
+        "read_emails": read_emails,
+        "now": timezone.now(),
+    }
+
+    return json.dumps(data, cls=DjangoJSONEncoder).encode("utf-8")
+
+
+def get_stats():
+    """Returns a dictionary with the latest and first Statistic objects (or
+    None if there aren't any) and the encoded payload for stats_recent, both
+    plain and gzipped"""
+    stats = cache.get(STATS_CACHE_KEY)
+    if stats is not None:
+        return stats
+
+    try:
+        latest = models.Statistic.objects.latest("date")
+        first = models.Statistic.objects.earliest("date")
+    except models.Statistic.DoesNotExist:
+        latest = None
+        first = None
+
+    recent = _recent_payload()
+    stats = {
+        "latest": latest,
+        "first": first,
+        "recent": recent,
+        "recent_gzip": compress_string(recent),
+    }
+    cache.set(STATS_CACHE_KEY, stats, STATS_CACHE_TIMEOUT)
+
+    return stats
+
+
+def clear_stats_cache():
+    cache.delete(STATS_CACHE_KEY)
@@ -20,20 +20,70 @@ from __future__ import unicode_literals
 import re
 
 from braces.views import LoginRequiredMixin
-from django.http import Http404, HttpResponse
+from django.conf import settings
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from django.views import generic
+from sendfile import sendfile
 import six
 
 from inboxen import models
+from inboxen.utils.body_store import get_body_store
 
 HEADER_CLEAN = re.compile(r'\s+')
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# sendfile backends that make Django read the file itself
+SENDFILE_IN_PROCESS = ["sendfile.backends.simple", "sendfile.backends.development"]
 
 __all__ = ["AttachmentDownloadView"]
 
 
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header, size):
+    """Parse a Range header, returns a tuple of (start, end) where `end` is
+    exclusive
+
+    Returns None if there's no range or if the range can't be parsed, in which
+    case the whole body should be sent. Multiple ranges aren't supported and
+    are treated the same way. Raises RangeNotSatisfiable if the range lies
+    outside of the body.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        return None
+
+    first, last = match.groups()
+    if first == "" and last == "":
+        return None
+    elif first == "":
+        # suffix range, the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable
+        return max(size - length, 0), size
+
+    first = int(first)
+    if first >= size:
+        raise RangeNotSatisfiable
+    elif last == "":
+        return first, size
+
+    last = int(last)
+    if last < first:
+        return None
+
+    return first, min(last + 1, size)
+
+
 class AttachmentDownloadView(LoginRequiredMixin, generic.detail.BaseDetailView):
     def get_object(self):
-        qs = models.PartList.objects.select_related('body')
+        # body data is fetched in chunks, if at all
+        qs = models.PartList.objects.select_related('body').defer('body__data')
         qs = qs.filter(email__deleted=False, email__inbox__user=self.request.user)
 
         try:
@@ -42,6 +92,15 @@ class AttachmentDownloadView(LoginRequiredMixin, generic.detail.BaseDetailView):
             raise Http404
 
     def render_to_response(self, context):
+        body = self.object.body
+
+        # bodies never change, so their hash makes a strong ETag
+        etag = quote_etag(body.hashed)
+        response = get_conditional_response(self.request, etag=etag)
+        if response is not None:
+            response["ETag"] = etag
+            return response
+
         # build the Content-Disposition header
         disposition = ["attachment"]
 
@@ -61,15 +120,44 @@ class AttachmentDownloadView(LoginRequiredMixin, generic.detail.BaseDetailView):
         else:
             content_type = "application/octet-stream"
 
-        # make header object
-        data = self.object.body.data or ""
-        response = HttpResponse(
-            content=data,
-            status=200,
-        )
+        path = get_body_store().path(body.hashed) if body.in_store else None
+        if path is not None and settings.SENDFILE_BACKEND not in SENDFILE_IN_PROCESS:
+            # let the web server send the file
+            response = sendfile(self.request, path)
+            del response["Content-Encoding"]
+        else:
+            response = self.stream_body(body, etag)
 
-        response["Content-Length"] = self.object.body.size or len(data)
+        response["ETag"] = etag
         response["Content-Disposition"] = disposition
         response["Content-Type"] = HEADER_CLEAN.sub(" ", content_type)
 
         return response
+
+    def stream_body(self, body, etag):
+        size = body.size
+        if size is None:
+            # very old bodies might not have had their size recorded
+            size = len(body.get_data())
+
+        byte_range = None
+        if self.request.META.get("HTTP_IF_RANGE", etag) == etag:
+            try:
+                byte_range = parse_range(self.request.META.get("HTTP_RANGE"), size)
+            except RangeNotSatisfiable:
+                response = HttpResponse(status=416)
+                response["Content-Range"] = "bytes */{0}".format(size)
+                return response
+
+        if byte_range is None:
+            start, end = 0, size
+            response = StreamingHttpResponse(body.chunks(start, end), status=200)
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(body.chunks(start, end), status=206)
+            response["Content-Range"] = "bytes {0}-{1}/{2}".format(start, end - 1, size)
+
+        response["Content-Length"] = end - start
+        response["Accept-Ranges"] = "bytes"
+
+        return response
@@ -19,7 +19,6 @@
 
 import logging
 
-from django.core.cache import cache
 from django.http import HttpResponseRedirect
 from django.views import generic
 
@@ -28,6 +27,7 @@ from watson import search
 
 from inboxen import models
 from inboxen.utils.email import find_bodies, render_body
+from inboxen.utils.flag_buffer import apply_buffered_flags, buffer_flags
 
 
 __all__ = ["EmailView"]
@@ -46,11 +46,16 @@ class EmailView(LoginRequiredMixin, generic.DetailView):
         with search.skip_index_update():
             out = super(EmailView, self).get(*args, **kwargs)
             if "all-headers" in self.request.GET:
-                self.object.view_all_headers = bool(int(self.request.GET["all-headers"]))
-
+                view_all_headers = bool(int(self.request.GET["all-headers"]))
+                if view_all_headers != self.object.view_all_headers:
+                    self.object.view_all_headers = view_all_headers
+                    self.object.save(update_fields=["view_all_headers"])
+
+        apply_buffered_flags(self.request.user.id, [self.object])
+        if not (self.object.read and self.object.seen):
+            buffer_flags(self.request.user.id, read=[self.object.id])
             self.object.read = True
             self.object.seen = True
-            self.object.save(update_fields=["view_all_headers", "read", "seen"])
 
         # pretend to be @csp_replace
         out._csp_replace = {"style-src": ["'self'", "'unsafe-inline'"]}
@@ -70,7 +75,7 @@ class EmailView(LoginRequiredMixin, generic.DetailView):
         queryset = queryset.filter(
             inbox__inbox=self.kwargs["inbox"],
             inbox__domain__domain=self.kwargs["domain"],
-        ).select_related("inbox", "inbox__domain")
+        ).select_related("inbox", "inbox__domain", "summary")
         return queryset
 
     def get_success_url(self):
@@ -88,12 +93,17 @@ class EmailView(LoginRequiredMixin, generic.DetailView):
 
     def get_context_data(self, **kwargs):
         if "all-headers" in self.request.GET:
-            headers = None
             headers_fetch_all = bool(int(self.request.GET["all-headers"]))
         else:
-            headers = cache.get(self.object.id, version="email-header")
             headers_fetch_all = self.object.view_all_headers
 
+        headers = None
+        if not headers_fetch_all:
+            try:
+                headers = {"Subject": self.object.summary.subject, "From": self.object.summary.sender}
+            except models.EmailSummary.DoesNotExist:
+                pass
+
         if headers is None:
             headers = models.Header.objects.filter(part__email=self.object, part__parent=None)
             if headers_fetch_all:
@@ -17,30 +17,98 @@
 #    along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
-from django.core.cache import cache
+from django.core.urlresolvers import reverse
 from django.http import Http404, HttpResponseNotAllowed, HttpResponseRedirect
+from django.utils.dateparse import parse_datetime
+from django.utils.http import urlencode
 from django.utils.translation import ugettext as _
 from django.views import generic
 
 from braces.views import LoginRequiredMixin
+from cursor_pagination import CursorPaginator, InvalidCursor
 from watson import search
 
 from inboxen import models
-from inboxen.tasks import deal_with_flags, delete_inboxen_item
-from inboxen.utils.tasks import task_group_skew
+from inboxen.tasks import delete_emails
+from inboxen.utils.counters import mark_deleted
+from inboxen.utils.flag_buffer import apply_buffered_flags, buffer_flags
 
 __all__ = ["FormInboxView", "UnifiedInboxView", "SingleInboxView"]
 
 
 class InboxView(LoginRequiredMixin, generic.ListView):
-    """Base class for Inbox views"""
+    """Base class for Inbox views
+
+    Pages are fetched with ?after= and ?before= cursors rather than page
+    numbers, so that neither a count nor an offset is needed.
+    """
     model = models.Email
     paginate_by = 100
     template_name = 'inboxen/inbox/inbox.html'
+    cursor_ordering = ("-important", "-received_date", "-id")
+
+    def get(self, *args, **kwargs):
+        if "page" in kwargs:
+            return self.redirect_page(int(kwargs.pop("page")))
+        return super(InboxView, self).get(*args, **kwargs)
+
+    def redirect_page(self, page):
+        """Redirect old page number URLs to the equivalent cursor"""
+        url = self.get_page_url()
+        if page < 1:
+            raise Http404
+        elif page > 1:
+            qs = self.get_queryset().order_by(*self.cursor_ordering)
+            try:
+                last_email = qs[(page - 1) * self.paginate_by - 1]
+            except IndexError:
+                raise Http404
+
+            paginator = CursorPaginator(qs, ordering=self.cursor_ordering)
+            url = "{}?{}".format(url, urlencode({"after": paginator.cursor(last_email)}))
+
+        return HttpResponseRedirect(url)
+
+    def get_page_url(self):
+        raise NotImplementedError
 
     def get_success_url(self):
         return self.request.path
 
+    def get_cursor(self, paginator, name):
+        """Fetch and check a cursor from the query string"""
+        cursor = self.request.GET.get(name, "").strip()
+        if not cursor:
+            return None
+
+        try:
+            important, received_date, email_id = paginator.decode_cursor(cursor)
+            if important not in ("True", "False") or parse_datetime(received_date) is None or not email_id.isdigit():
+                raise ValueError
+        except (InvalidCursor, ValueError):
+            raise Http404
+
+        return cursor
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = CursorPaginator(queryset, ordering=self.cursor_ordering)
+        after = self.get_cursor(paginator, "after")
+        before = self.get_cursor(paginator, "before")
+
+        if before is not None:
+            page = paginator.page(last=page_size, before=before)
+            page.has_next = True
+        else:
+            page = paginator.page(first=page_size, after=after)
+            page.has_previous = after is not None
+
+        if page.has_previous and len(page) > 0:
+            page.previous_cursor = paginator.cursor(page[0])
+        if page.has_next and len(page) > 0:
+            page.next_cursor = paginator.cursor(page[-1])
+
+        return (paginator, page, page.items, page.has_previous or page.has_next)
+
     def get_queryset(self, *args, **kwargs):
         qs = super(InboxView, self).get_queryset(*args, **kwargs)
         qs = qs.viewable(self.request.user)
@@ -51,7 +119,7 @@ class InboxView(LoginRequiredMixin, generic.ListView):
         # but it doesn't strip out annotations
         # q?: does this still apply?
         if self.request.method != "POST":
-            qs = qs.order_by("-important", "-received_date").select_related("inbox", "inbox__domain")
+            qs = qs.order_by("-important", "-received_date").select_related("inbox", "inbox__domain", "summary")
         return qs
 
     @search.skip_index_update()
@@ -66,7 +134,9 @@ class InboxView(LoginRequiredMixin, generic.ListView):
             except (self.model.DoesNotExist, ValueError):
                 raise Http404
 
-            email.delete()
+            mark_deleted(qs.filter(id=email.id))
+            models.Inbox.objects.filter(id=email.inbox_id).update_last_activity()
+            delete_emails.delay({"id": email.id, "deleted": True})
 
             return HttpResponseRedirect(self.get_success_url())
         elif "important-single" in self.request.POST:
@@ -100,11 +170,10 @@ class InboxView(LoginRequiredMixin, generic.ListView):
         elif "important" in self.request.POST:
             qs.update(important=True)
         elif "delete" in self.request.POST:
-            email_ids = [("email", email.id) for email in qs]
-            qs.update(deleted=True)
-            delete_task = delete_inboxen_item.chunks(email_ids, 500).group()
-            task_group_skew(delete_task, step=50)
-            delete_task.apply_async()
+            email_ids = list(qs.values_list("id", flat=True))
+            counts = mark_deleted(qs)
+            models.Inbox.objects.filter(id__in=counts.keys()).update_last_activity()
+            delete_emails.delay({"id__in": email_ids, "deleted": True})
 
         return HttpResponseRedirect(self.get_success_url())
 
@@ -113,32 +182,35 @@ class InboxView(LoginRequiredMixin, generic.ListView):
 
         object_list = []
         object_id_list = []
-        for email in context["page_obj"].object_list:
+        for email in context["page_obj"]:
             object_list.append(email)
             object_id_list.append(email.id)
 
         if len(object_id_list) == 0:
             return context
 
-        headers = cache.get_many(object_id_list, version="email-header")
-
-        missing_list = set(object_id_list) - set(headers.keys())
-        if len(missing_list) > 0:
-            missing_headers = models.Header.objects.filter(part__parent=None, part__email__in=missing_list)
-            missing_headers = missing_headers.get_many("Subject", "From", group_by="part__email_id")
-            headers.update(missing_headers)
-            cache.set_many(missing_headers, version="email-header", timeout=None)
-
+        missing_list = []
         for email in object_list:
-            header_set = headers[email.id]
-            email.subject = header_set.get("Subject")
-            email.sender = header_set["From"]
+            try:
+                email.subject = email.summary.subject
+                email.sender = email.summary.sender
+            except models.EmailSummary.DoesNotExist:
+                missing_list.append(email)
 
-        inbox = getattr(self, 'inbox_obj', None)
-        if inbox is not None:
-            inbox = inbox.id
+        if len(missing_list) > 0:
+            # emails that haven't been summarised yet
+            headers = models.Header.objects.filter(part__parent=None, part__email__in=missing_list)
+            headers = headers.get_many("Subject", "From", group_by="part__email_id")
+            for email in missing_list:
+                header_set = headers.get(email.id, {})
+                email.subject = header_set.get("Subject")
+                email.sender = header_set.get("From")
+
+        # emails on this page are seen from now on, but are displayed as they
+        # were before this page was viewed
+        apply_buffered_flags(self.request.user.id, object_list)
+        buffer_flags(self.request.user.id, seen=[email.id for email in object_list if not email.seen])
 
-        deal_with_flags.delay(object_id_list, self.request.user.id, inbox)
         return context
 
 
@@ -160,6 +232,9 @@ class FormInboxView(InboxView):
 
 class UnifiedInboxView(InboxView):
     """View all inboxes together"""
+    def get_page_url(self):
+        return reverse("unified-inbox")
+
     def get_queryset(self, *args, **kwargs):
         qs = super(UnifiedInboxView, self).get_queryset(*args, **kwargs)
         qs = qs.filter(inbox__exclude_from_unified=False)
@@ -185,6 +260,10 @@ class UnifiedInboxView(InboxView):
 
 class SingleInboxView(InboxView):
     """View a single inbox"""
+    def get_page_url(self):
+        kwargs = {"inbox": self.kwargs["inbox"], "domain": self.kwargs["domain"]}
+        return reverse("single-inbox", kwargs=kwargs)
+
     def get_queryset(self, *args, **kwargs):
         try:
             self.inbox_obj = models.Inbox.objects.viewable(self.request.user)
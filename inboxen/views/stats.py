@@ -15,55 +15,59 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+import calendar
+import re
+
 from csp.decorators import csp_replace
-from django.http import JsonResponse
+from django.http import HttpResponse
 from django.template.response import TemplateResponse
-from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from inboxen.utils.stats import get_stats
 
-from inboxen import models
+ACCEPTS_GZIP = re.compile(r'\bgzip\b')
 
 
 @csp_replace(STYLE_SRC=["'self'", "'unsafe-inline'"])
 def stats(request):
-    try:
-        stat = models.Statistic.objects.latest("date")
-        first_stat = models.Statistic.objects.earliest("date")
-    except models.Statistic.DoesNotExist:
-        stat = None
-        first_stat = None
+    stats = get_stats()
 
-    return TemplateResponse(request, "inboxen/stats.html", {"object": stat, "first_stat": first_stat})
+    return TemplateResponse(request, "inboxen/stats.html", {"object": stats["latest"], "first_stat": stats["first"]})
 
 
 def stats_recent(request):
-    objects = reversed(models.Statistic.objects.order_by("-date")[:90])
-    dates = []
-    users = []
-    active_users = []
-    inboxes = []
-    active_inboxes = []
-    emails = []
-    read_emails = []
+    stats = get_stats()
 
-    for stat in objects:
-        dates.append(stat.date)
+    if ACCEPTS_GZIP.search(request.META.get("HTTP_ACCEPT_ENCODING", "")):
+        content = stats["recent_gzip"]
+        encoding = "gzip"
+    else:
+        content = stats["recent"]
+        encoding = None
 
-        users.append(stat.users.get("count"))
-        active_users.append(stat.users.get("with_inboxes"))
+    # the payload only changes when a new Statistic is saved
+    etag = None
+    last_modified = None
+    if stats["latest"] is not None:
+        date = stats["latest"].date
+        timestamp = calendar.timegm(date.utctimetuple())
+        etag = "{}.{}".format(timestamp, date.microsecond)
+        if encoding is not None:
+            etag = "{}-{}".format(etag, encoding)
+        etag = quote_etag(etag)
+        last_modified = timestamp
 
-        inboxes.append(stat.inboxes.get("inbox_count__sum"))
-        active_inboxes.append(stat.inboxes.get("with_emails"))
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = HttpResponse(content, content_type="application/json")
+        response["Content-Length"] = len(content)
+        if encoding is not None:
+            response["Content-Encoding"] = encoding
 
-        emails.append(stat.emails.get("email_count__sum"))
-        read_emails.append(stat.emails.get("emails_read"))
+    if etag is not None:
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+    patch_vary_headers(response, ["Accept-Encoding"])
 
-    return JsonResponse({
-        "dates": dates,
-        "users": users,
-        "active_users": active_users,
-        "inboxes": inboxes,
-        "active_inboxes": active_inboxes,
-        "emails": emails,
-        "read_emails": read_emails,
-        "now": timezone.now()
-    })
+    return response
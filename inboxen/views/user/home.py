@@ -39,15 +39,7 @@ class UserHomeView(LoginRequiredMixin, generic.ListView):
     def get_queryset(self):
         qs = self.model.objects.viewable(self.request.user)
         qs = qs.select_related("domain")
-
-        # ugly!
-        # see https://code.djangoproject.com/ticket/19513
-        # tl;dr Django uses a subquery when doing an `update` on a queryset,
-        # but it doesn't strip out annotations
-        # q?: does this still apply?
-        if self.request.method != "POST":
-            qs = qs.add_last_activity()
-            qs = qs.order_by("-pinned", "disabled", "-last_activity").select_related("domain")
+        qs = qs.order_by("-pinned", "disabled", "-last_activity")
         return qs
 
     @search.skip_index_update()
@@ -18,8 +18,7 @@
 ##
 
 from braces.views import LoginRequiredMixin
-from celery import exceptions
-from celery.result import AsyncResult
+from celery.utils import uuid
 from django import http
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
@@ -40,7 +39,6 @@ class SearchView(LoginRequiredMixin, generic.ListView):
     paginate_by = None
     template_name = "inboxen/user/search.html"
     filter_limit = 10
-    timeout = 1  # time to wait for results
     model = None  # will be useful later, honest!
 
     context_object_name = "search_results"
@@ -53,25 +51,26 @@ class SearchView(LoginRequiredMixin, generic.ListView):
         return create_search_cache_key(self.request.user.id, self.query, self.first_item, self.last_item)
 
     def get_results(self):
-        """Fetch result from either the cache or the queue
+        """Fetch result from the cache, starting a search if there isn't one
 
-        Raises TimeoutError if results aren't ready by self.timeout
+        Returns None if results aren't ready yet. Results are never fetched
+        from Celery, so web workers aren't kept waiting on a search.
         """
-        result = cache.get(self.get_cache_key())
+        key = self.get_cache_key()
+        result = cache.get(key)
         if result is None or settings.CELERY_TASK_ALWAYS_EAGER:
             if self.last_item:
                 task_kwargs = {"after": self.last_item}
             else:
                 task_kwargs = {"before": self.first_item}
-            search_task = tasks.search.apply_async(args=[self.request.user.id, self.query], kwargs=task_kwargs)
-            result = {"task": search_task.id}
-            cache.set(self.get_cache_key(), result, tasks.SEARCH_TIMEOUT)
-        elif "task" in result:
-            search_task = AsyncResult(result["task"])
-        else:
-            return result
+            # mark the search as pending before the task can finish and store its results
+            task_id = uuid()
+            cache.set(key, {"task": task_id}, tasks.SEARCH_TIMEOUT)
+            tasks.search.apply_async(args=[self.request.user.id, self.query], kwargs=task_kwargs, task_id=task_id)
+            result = cache.get(key)
 
-        result = search_task.get(self.timeout)
+        if result is None or "task" in result:
+            return None
 
         return result
 
@@ -79,9 +78,8 @@ class SearchView(LoginRequiredMixin, generic.ListView):
         if self.query == "":
             return {}
 
-        try:
-            results = self.get_results()
-        except exceptions.TimeoutError:
+        results = self.get_results()
+        if results is None:
             # we're still waiting for results
             return {}
 
@@ -129,29 +127,33 @@ class SearchView(LoginRequiredMixin, generic.ListView):
     def get_query(self, request):
         get_query = request.GET.get("q", "").strip()
         kwarg_query = self.kwargs.get("q", "").strip()
+        after = request.GET.get("after", "").strip() or None
+        # the search task can't do both, so "before" is ignored if there's an "after"
+        before = None if after else request.GET.get("before", "") or None
         return (
             kwarg_query or get_query,
-            request.GET.get("after", "").strip() or None,
-            request.GET.get("before", "") or None,
+            after,
+            before,
         )
 
 
 class SearchApiView(SearchView):
-    """Check to see if a search is running or not"""
+    """Check to see if a search is running or not
+
+    Only looks at the cache, so this returns straight away. Clients should
+    back off between checks. Holding the request open until results arrive
+    (long-polling or server-sent events) would tie up a synchronous worker
+    for as long as the search takes.
+    """
     def get(self, request, *args, **kwargs):
         return self.http_method_not_allowed(request, *args, **kwargs)
 
     def head(self, request, *args, **kwargs):
         self.query, self.last_item, self.first_item = self.get_query(request)
         result = cache.get(self.get_cache_key())
-        if result is not None and "task" in result:
-            search_task = AsyncResult(result["task"])
-            try:
-                search_task.get(self.timeout)
-            except exceptions.TimeoutError:
-                return http.HttpResponse(status=202)  # 202: still waiting for task
-            return http.HttpResponse(status=201)  # 201: search results ready
-        elif result is not None:
-            return http.HttpResponse(status=201)  # 201: search results ready
-        else:
+        if result is None:
             return http.HttpResponseBadRequest()  # 400: no search is being performed
+        elif "task" in result:
+            return http.HttpResponse(status=202)  # 202: still waiting for task
+        else:
+            return http.HttpResponse(status=201)  # 201: search results ready
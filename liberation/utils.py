@@ -24,7 +24,6 @@ import quopri
 import uu
 
 from six import BytesIO
-import six
 
 from inboxen.models import HEADER_PARAMS
 
@@ -96,7 +95,7 @@ def make_message(message):
 
         if part.is_leaf_node():
             cte = msg.get("Content-Transfer-Encoding", "7-bit")
-            data = six.binary_type(part.body.data)
+            data = part.body.get_data()
 
             if cte == "base64":
                 set_base64_payload(msg, data)
@@ -19,50 +19,197 @@
 #
 ##
 
+from functools import partial
 import logging
 
+from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
+from django.utils.functional import cached_property
 from watson import search
 import six
 
-from inboxen.models import Body, Email, Header, PartList
+from inboxen.models import (Body, Email, EmailSummary, Header, HeaderData, HeaderName, Inbox, PartList, UnindexedEmail,
+                            UserProfile, parse_content_headers)
+from inboxen.tasks import prerender_emails
+from inboxen.utils.counters import counter_expressions
+from inboxen.utils.email import make_summary
 
 
 log = logging.getLogger(__name__)
 
 
-@search.update_index()
+class ParsedPart(object):
+    """A MIME part that has been read into memory, but not yet saved to the
+    database
+
+    `lft`, `rght` and `level` are the values MPTT would have given the part had
+    it been inserted as the last child of `parent`
+    """
+    def __init__(self, part, parent=None):
+        self.parent = parent
+        self.children = []
+        self.level = 0 if parent is None else parent.level + 1
+        self.lft = None
+        self.rght = None
+        self.instance = None
+
+        self.data = encode_body(part)
+        self.hashed = Body.objects.hash_it(self.data)
+
+        self.headers = []
+        keys = part.keys()
+        for name in keys:
+            # remove null "bytes"
+            data = part[name].replace("\x00", "")
+            self.headers.append((name, HeaderData.objects.hash_it(data), data, keys.index(name)))
+
+        if parent is not None:
+            parent.children.append(self)
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    def get_data(self):
+        return self.data
+
+    def get_headers(self):
+        """Returns a dictionary of header names and data"""
+        return {name: data for name, _, data, _ in self.headers}
+
+    @cached_property
+    def _content_headers_cache(self):
+        # only call once the whole tree has been parsed
+        return parse_content_headers(self.get_headers(), len(self.children) == 0)
+
+    @property
+    def content_type(self):
+        return self._content_headers_cache.get("content_type")
+
+    @property
+    def filename(self):
+        return self._content_headers_cache.get("filename")
+
+    @property
+    def charset(self):
+        return self._content_headers_cache.get("charset")
+
+    def number_tree(self, left=1):
+        """Assign MPTT values to this part and its children, returns `rght`"""
+        self.lft = left
+        for child in self.children:
+            left = child.number_tree(left + 1)
+        self.rght = left + 1
+
+        return self.rght
+
+
+def parse_message(message):
+    """Read `message` into a list of ParsedPart objects, root part first and
+    then in the same order as `message.walk()`
+    """
+    root = ParsedPart(message.base)
+    parents = {message.base: root}
+    parts = [root]
+
+    for part in message.walk():
+        parsed = ParsedPart(part, parents[part.parent])
+        parents[part] = parsed
+        parts.append(parsed)
+
+    root.number_tree()
+
+    return parts
+
+
+@search.skip_index_update()
 def make_email(message, inbox):
     """Push message to the database.
+
+    The whole MIME tree is parsed before anything is written so that bodies,
+    header names and header data can be fetched and inserted in bulk. The
+    number of queries depends on the depth of the MIME tree rather than the
+    number of parts or headers.
+
+    The email is queued to be indexed by inboxen.tasks.index_emails rather
+    than being indexed here.
     """
-    base = message.base
     received_date = timezone.now()
+    parts = parse_message(message)
 
     email = Email(inbox=inbox, received_date=received_date)
     email.save()
 
-    data = encode_body(base)
-    body, _ = Body.objects.only("id").get_or_create(data=data)
-
-    part = PartList(body=body, email=email)
-    part.save()
-
-    parents = {base: part.id}
-
-    for header in message.keys():
-        ordinal = message.keys().index(header)
-        Header.objects.create(name=header, data=message[header], ordinal=ordinal, part=part)
-
-    for part in message.walk():
-        data = encode_body(part)
-        body, _ = Body.objects.only("id").get_or_create(data=data)
-        part_item = PartList(body=body, email=email, parent_id=parents[part.parent])
-        part_item.save()
-        parents[part] = part_item.id
-
-        for header in part.keys():
-            ordinal = part.keys().index(header)
-            Header.objects.create(name=header, data=part[header], ordinal=ordinal, part=part_item)
+    body_ids = Body.objects.get_or_create_many(
+        "hashed",
+        {part.hashed: {"data": part.data} for part in parts},
+    )
+    name_ids = HeaderName.objects.get_ids(
+        set(name for part in parts for name, _, _, _ in part.headers),
+        create=True,
+    )
+    data_ids = HeaderData.objects.get_or_create_many(
+        "hashed",
+        {hashed: {"data": data} for part in parts for _, hashed, data, _ in part.headers},
+    )
+
+    # each level of the tree is inserted in one go, so that children can be
+    # given the IDs of their parents
+    tree_id = PartList._tree_manager._get_next_tree_id()
+    levels = {}
+    for part in parts:
+        levels.setdefault(part.level, []).append(part)
+
+    for level in sorted(levels.keys()):
+        for part in levels[level]:
+            part.instance = PartList(
+                email=email,
+                body_id=body_ids[part.hashed],
+                parent_id=part.parent.instance.id if part.parent is not None else None,
+                lft=part.lft,
+                rght=part.rght,
+                level=part.level,
+                tree_id=tree_id,
+            )
+        PartList.objects.bulk_create([part.instance for part in levels[level]])
+
+    headers = []
+    for part in parts:
+        for name, hashed, data, ordinal in part.headers:
+            headers.append(Header(name_id=name_ids[name], data_id=data_ids[hashed], part=part.instance,
+                                  ordinal=ordinal))
+    Header.objects.bulk_create(headers)
+
+    summary = make_summary(parts[0].get_headers(), [part for part in parts if len(part.children) == 0])
+    EmailSummary.objects.create(email=email, **summary)
+    UnindexedEmail.objects.create(email_id=email.id)
+
+    if settings.PRERENDER_EMAILS:
+        transaction.on_commit(partial(prerender_emails.delay, [email.id]))
+
+    return email
+
+
+def deliver_message(message, inbox):
+    """Save `message`, mark `inbox` as having new mail and update counters
+
+    `inbox` may have come from the recipient cache (see app.recipients), so
+    flags are set with UPDATE rather than by saving it. Should be called
+    inside a transaction
+    """
+    make_email(message, inbox)
+
+    # new emails are neither seen nor read
+    counters = counter_expressions(1, 1, 1)
+    Inbox.objects.filter(id=inbox.id).update(new=True, last_activity=timezone.now(), **counters)
+
+    if not inbox.exclude_from_unified:
+        updated = UserProfile.objects.filter(user_id=inbox.user_id).update(unified_has_new_messages=True, **counters)
+        if not updated:
+            # profiles are only created when first accessed
+            defaults = {"unified_has_new_messages": True, "total_count": 1, "unseen_count": 1, "unread_count": 1}
+            UserProfile.objects.get_or_create(user_id=inbox.user_id, defaults=defaults)
 
 
 def encode_body(part):
@@ -0,0 +1,124 @@
+##
+#
+# Copyright 2018 Jessica Tallon, Matt Molyneaux
+#
+# This file is part of Inboxen.
+#
+# Inboxen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Inboxen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+#
+##
+
+import json
+import logging
+import os
+import socket
+import time
+
+from salmon.server import LMTPReceiver, SMTPReceiver
+
+
+log = logging.getLogger(__name__)
+
+# set by the router management command, tells the receiver which worker it is
+WORKER_ENV = "INBOXEN_ROUTER_WORKER"
+
+# seconds between writing out counters
+STATS_FLUSH_INTERVAL = 5
+
+
+def stats_path(worker):
+    """Where a worker writes its counters, relative to the router directory"""
+    return os.path.join("run", "router-{}.stats".format(worker))
+
+
+def read_stats(path):
+    """Read counters written by WorkerStats, returns None if there are none"""
+    try:
+        with open(path) as stats_file:
+            return json.load(stats_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class WorkerStats(object):
+    """Counts what happened to each message a worker received
+
+    Counters are written to disk every STATS_FLUSH_INTERVAL seconds so that
+    `./manage.py router --status` can report them.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.last_flush = 0
+        self.counts = {
+            "accepted": 0,
+            "rejected": 0,
+            "deferred": 0,
+        }
+
+    def record(self, result):
+        """Record the result of SMTPReceiver.process_message"""
+        if result is None:
+            self.counts["accepted"] += 1
+        elif result.startswith("4"):
+            self.counts["deferred"] += 1
+        else:
+            self.counts["rejected"] += 1
+
+        if time.time() - self.last_flush >= STATS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        data = dict(self.counts, pid=self.pid, started=self.started, updated=time.time())
+        tmp_path = "{}.tmp".format(self.path)
+        try:
+            with open(tmp_path, "w") as stats_file:
+                json.dump(data, stats_file)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as exc:
+            log.warning("Could not write stats to %s: %s", self.path, exc)
+
+        self.last_flush = time.time()
+
+
+class WorkerSMTPReceiver(SMTPReceiver):
+    """SMTPReceiver that can share its port with other workers"""
+    def __init__(self, stats, *args, **kwargs):
+        self.stats = stats
+        SMTPReceiver.__init__(self, *args, **kwargs)
+
+    def set_reuse_addr(self):
+        SMTPReceiver.set_reuse_addr(self)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    def process_message(self, Peer, From, To, Data):
+        result = SMTPReceiver.process_message(self, Peer, From, To, Data)
+        self.stats.record(result)
+        return result
+
+
+class WorkerLMTPReceiver(LMTPReceiver):
+    """LMTPReceiver that keeps count of messages
+
+    UNIX sockets can't be shared, so there can only be one of these
+    """
+    def __init__(self, stats, *args, **kwargs):
+        self.stats = stats
+        LMTPReceiver.__init__(self, *args, **kwargs)
+
+    def process_message(self, Peer, From, To, Data):
+        result = LMTPReceiver.process_message(self, Peer, From, To, Data)
+        self.stats.record(result)
+        return result
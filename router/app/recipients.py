@@ -0,0 +1,147 @@
+##
+#
+# Copyright 2018 Jessica Tallon, Matt Molyneaux
+#
+# This file is part of Inboxen.
+#
+# Inboxen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Inboxen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+#
+##
+
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from six.moves import urllib
+
+from inboxen.models import Domain, Inbox
+from inboxen.utils.bloom import BloomFilter
+
+
+log = logging.getLogger(__name__)
+
+INBOX_CACHE_PREFIX = "inboxen-router-inbox-"
+INBOX_CACHE_TIMEOUT = 60
+
+# seconds between checking for new inboxes to add to the recipient filter
+FILTER_REFRESH_INTERVAL = 10
+# inbox IDs can be committed out of order, so look back this far each refresh
+FILTER_ID_OVERLAP = 100
+FILTER_MIN_CAPACITY = 10000
+
+
+def create_inbox_cache_key(inbox, domain):
+    return INBOX_CACHE_PREFIX + urllib.parse.quote(u"{}@{}".format(inbox, domain).encode("utf-8"))
+
+
+def inbox_to_cache(inbox):
+    """Just enough of `inbox` to deliver mail to it"""
+    return {
+        "id": inbox.id,
+        "inbox": inbox.inbox,
+        "domain_id": inbox.domain_id,
+        "domain": inbox.domain.domain,
+        "user_id": inbox.user_id,
+        "exclude_from_unified": inbox.exclude_from_unified,
+    }
+
+
+def inbox_from_cache(data):
+    """Build an Inbox from the output of inbox_to_cache
+
+    The Inbox only has the fields needed by deliver_message, don't save it!
+    """
+    inbox = Inbox(
+        id=data["id"],
+        inbox=data["inbox"],
+        user_id=data["user_id"],
+        exclude_from_unified=data["exclude_from_unified"],
+    )
+    inbox.domain = Domain(id=data["domain_id"], domain=data["domain"])
+
+    return inbox
+
+
+def is_receiving(inbox):
+    """Python version of InboxQuerySet.receiving"""
+    return inbox.domain.enabled and inbox.user_id is not None and not (inbox.deleted or inbox.disabled)
+
+
+class RecipientFilter(object):
+    """A Bloom filter of every address that has been given to an Inbox
+
+    Inboxes are never removed from the database (they are disowned instead),
+    so anything that isn't in the filter can be rejected without asking the
+    database. New inboxes are picked up every FILTER_REFRESH_INTERVAL seconds
+    and the filter is rebuilt from scratch once it fills up.
+    """
+    def __init__(self):
+        self.bloom = None
+        self.last_id = 0
+        self.last_refresh = 0
+
+    def refresh(self):
+        if self.bloom is None or self.bloom.is_full():
+            capacity = max(Inbox.objects.count() * 2, FILTER_MIN_CAPACITY)
+            log.info("Building recipient filter with capacity for %s addresses", capacity)
+            self.bloom = BloomFilter(capacity)
+            self.last_id = 0
+
+        inboxes = Inbox.objects.filter(id__gt=self.last_id - FILTER_ID_OVERLAP).order_by("id")
+        for inbox_id, inbox, domain in inboxes.values_list("id", "inbox", "domain__domain").iterator():
+            self.bloom.add(u"{}@{}".format(inbox, domain))
+            self.last_id = max(self.last_id, inbox_id)
+
+        self.last_refresh = time.time()
+
+    def might_exist(self, inbox, domain):
+        if time.time() - self.last_refresh >= FILTER_REFRESH_INTERVAL:
+            self.refresh()
+
+        return u"{}@{}".format(inbox, domain) in self.bloom
+
+
+recipient_filter = RecipientFilter()
+
+
+def lookup_inbox(inbox, domain):
+    """Find the Inbox for inbox@domain, raises Inbox.DoesNotExist if it
+    doesn't exist or can't receive mail
+
+    Answers are cached for INBOX_CACHE_TIMEOUT seconds, see router.signals for
+    how the cache is kept up to date. If ROUTER_RECIPIENT_FILTER is set,
+    addresses that have never existed are rejected without touching the
+    database at all.
+    """
+    key = create_inbox_cache_key(inbox, domain)
+    cached = cache.get(key)
+    if cached is False:
+        raise Inbox.DoesNotExist
+    elif cached is not None:
+        return inbox_from_cache(cached)
+
+    if settings.ROUTER_RECIPIENT_FILTER and not recipient_filter.might_exist(inbox, domain):
+        raise Inbox.DoesNotExist
+
+    try:
+        inbox_obj = Inbox.objects.filter(inbox=inbox, domain__domain=domain)
+        inbox_obj = inbox_obj.select_related("domain").receiving().get()
+    except Inbox.DoesNotExist:
+        cache.set(key, False, INBOX_CACHE_TIMEOUT)
+        raise
+
+    cache.set(key, inbox_to_cache(inbox_obj), INBOX_CACHE_TIMEOUT)
+
+    return inbox_obj
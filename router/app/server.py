@@ -26,10 +26,11 @@ from salmon.server import SMTPError, Relay
 
 from django.conf import settings
 from django.db import DatabaseError, transaction
-from watson import search
 
-from app.helpers import make_email
-from inboxen.models import Inbox
+from app.helpers import deliver_message
+from app.recipients import lookup_inbox
+from app.spool import get_spool
+from inboxen.models import HeaderName, Inbox
 from inboxen.utils import RESERVED_LOCAL_PARTS_REGEX
 
 # we want to match *something*, but not something consumed by forward_to_admins
@@ -58,26 +59,46 @@ def forward_to_admins(message, local=None, domain=None):
 @route(r"(inbox)@(domain)", inbox=INBOX_REGEX, domain=r".+")
 @stateless
 @nolocking
-@transaction.atomic()
 def process_message(message, inbox=None, domain=None):
-    try:
-        inbox = Inbox.objects.filter(inbox=inbox, domain__domain=domain)
-        inbox = inbox.select_related("user", "user__inboxenprofile").receiving()
-        inbox = inbox.get()
-
-        make_email(message, inbox)
+    if settings.ROUTER_USE_SPOOL:
+        spool_message(message, inbox, domain)
+        return
 
-        with search.skip_index_update():
-            inbox.new = True
-            inbox.save(update_fields=["new"])
+    try:
+        # errors raised on commit (e.g. deferred foreign key checks) need to be
+        # caught too, so the transaction is started inside the try block
+        with transaction.atomic():
+            inbox = lookup_inbox(inbox, domain)
+            deliver_message(message, inbox)
+    except DatabaseError as e:
+        log.exception("DB error: %s", e)
+        # a cached HeaderName might have been deleted by clean_orphan_models,
+        # start afresh so the retry has a chance of succeeding
+        HeaderName.objects.clear_cache()
+        raise SMTPError(451, "Error processing message, try again later.")
+    except Inbox.DoesNotExist:
+        raise SMTPError(550, "No such address")
 
-        if not inbox.exclude_from_unified:
-            profile = inbox.user.inboxenprofile
-            profile.unified_has_new_messages = True
-            profile.save(update_fields=["unified_has_new_messages"])
 
+def spool_message(message, inbox, domain):
+    """Write message to the spool for Celery workers to pick up, see
+    router.tasks.drain_spool
+    """
+    try:
+        lookup_inbox(inbox, domain)
     except DatabaseError as e:
         log.exception("DB error: %s", e)
         raise SMTPError(451, "Error processing message, try again later.")
     except Inbox.DoesNotExist:
         raise SMTPError(550, "No such address")
+
+    try:
+        spool = get_spool()
+        if spool.count() >= settings.ROUTER_SPOOL_HIGH_WATER:
+            log.warning("Spool has reached its high-water mark, deferring message")
+            raise SMTPError(451, "Too much mail, try again later.")
+
+        spool.push(message, inbox, domain)
+    except (IOError, OSError) as e:
+        log.exception("Spool error: %s", e)
+        raise SMTPError(451, "Error processing message, try again later.")
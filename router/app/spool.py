@@ -0,0 +1,156 @@
+##
+#
+# Copyright 2018 Jessica Tallon, Matt Molyneaux
+#
+# This file is part of Inboxen.
+#
+# Inboxen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Inboxen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+#
+##
+
+import json
+import logging
+import os
+import time
+import uuid
+
+from django.conf import settings
+from salmon.mail import MailRequest
+import six
+
+
+log = logging.getLogger(__name__)
+
+
+class Spool(object):
+    """A Maildir-like directory of messages waiting to be saved to the database
+
+    Messages are written to "tmp" and then moved to "new" once they're safely
+    on disk. Workers claim messages by moving them to "cur" and remove them
+    once they've been saved. Messages that can't be processed at all are moved
+    to "failed" for an admin to look at.
+
+    Each file starts with a line of JSON holding the SMTP envelope, followed
+    by the message exactly as it was received.
+    """
+    def __init__(self, path):
+        self.path = path
+        for subdir in ["tmp", "new", "cur", "failed"]:
+            try:
+                os.makedirs(os.path.join(path, subdir), 0o700)
+            except OSError:
+                pass
+
+    def _path(self, subdir, key):
+        return os.path.join(self.path, subdir, key)
+
+    def push(self, message, inbox, domain):
+        """Write `message` to disk, returns its key"""
+        data = message.Data
+        is_bytes = isinstance(data, six.binary_type)
+        if not is_bytes:
+            data = data.encode("utf-8", "surrogateescape" if six.PY3 else "strict")
+
+        envelope = {
+            "peer": message.Peer,
+            "from": message.From,
+            "to": message.To,
+            "inbox": inbox,
+            "domain": domain,
+            "bytes": is_bytes,
+        }
+
+        key = "{0}.{1}.{2}".format(int(time.time()), os.getpid(), uuid.uuid4().hex)
+        tmp_path = self._path("tmp", key)
+        with open(tmp_path, "wb") as spool_file:
+            spool_file.write(json.dumps(envelope).encode("utf-8"))
+            spool_file.write(b"\n")
+            spool_file.write(data)
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+
+        os.rename(tmp_path, self._path("new", key))
+
+        return key
+
+    def count(self):
+        """Number of messages that are waiting or being worked on"""
+        return len(os.listdir(os.path.join(self.path, "new"))) + len(os.listdir(os.path.join(self.path, "cur")))
+
+    def claim(self, limit):
+        """Claim up to `limit` messages, returns a list of keys
+
+        Claiming is done by renaming, so two workers can't claim the same
+        message
+        """
+        claimed = []
+        for key in sorted(os.listdir(os.path.join(self.path, "new"))):
+            if len(claimed) >= limit:
+                break
+
+            try:
+                os.rename(self._path("new", key), self._path("cur", key))
+            except OSError:
+                # someone else got there first
+                continue
+
+            # mark the time we claimed it, see release_stale
+            os.utime(self._path("cur", key), None)
+            claimed.append(key)
+
+        return claimed
+
+    def get(self, key):
+        """Returns a tuple of (MailRequest, inbox, domain) for a claimed message"""
+        with open(self._path("cur", key), "rb") as spool_file:
+            envelope = json.loads(spool_file.readline().decode("utf-8"))
+            data = spool_file.read()
+
+        if not envelope["bytes"]:
+            data = data.decode("utf-8", "surrogateescape" if six.PY3 else "strict")
+
+        message = MailRequest(envelope["peer"], envelope["from"], envelope["to"], data)
+
+        return message, envelope["inbox"], envelope["domain"]
+
+    def remove(self, key):
+        try:
+            os.unlink(self._path("cur", key))
+        except OSError:
+            log.warning("Spooled message %s has already been removed", key)
+
+    def fail(self, key):
+        """Move a claimed message out of the way so that it isn't retried"""
+        try:
+            os.rename(self._path("cur", key), self._path("failed", key))
+        except OSError:
+            log.warning("Spooled message %s has already been removed", key)
+
+    def release_stale(self, age):
+        """Put back messages that were claimed more than `age` seconds ago,
+        e.g. by a worker that crashed
+        """
+        cutoff = time.time() - age
+        for key in os.listdir(os.path.join(self.path, "cur")):
+            try:
+                if os.stat(self._path("cur", key)).st_mtime < cutoff:
+                    os.rename(self._path("cur", key), self._path("new", key))
+                    log.warning("Released stale message %s back into spool", key)
+            except OSError:
+                # finished or released by someone else
+                continue
+
+
+def get_spool():
+    return Spool(settings.ROUTER_SPOOL_PATH)
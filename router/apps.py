@@ -0,0 +1,35 @@
+##
+#
+# Copyright 2018 Jessica Tallon, Matt Molyneaux
+#
+# This file is part of Inboxen.
+#
+# Inboxen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Inboxen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+#
+##
+
+from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
+
+
+class RouterConfig(AppConfig):
+    name = "router"
+    verbose_name = "Inboxen Router"
+
+    def ready(self):
+        from inboxen.models import Inbox
+        from router import signals
+
+        post_save.connect(signals.inbox_saved, sender=Inbox, dispatch_uid="router_inbox_saved")
+        post_delete.connect(signals.inbox_deleted, sender=Inbox, dispatch_uid="router_inbox_deleted")
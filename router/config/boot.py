@@ -22,10 +22,12 @@ import logging.config
 import os
 
 from django.conf import settings as dj_settings
+from django.db import DatabaseError
 from salmon import queue
 from salmon.routing import Router
 
 from config import settings
+from inboxen.models import HeaderName
 
 __all__ = ["settings"]
 
@@ -49,3 +51,9 @@ Router.load(['app.server'])
 Router.RELOAD = False
 Router.LOG_EXCEPTIONS = True
 Router.UNDELIVERABLE_QUEUE = queue.Queue("run/undeliverable")
+
+try:
+    HeaderName.objects.preload_cache()
+except DatabaseError as e:
+    # not fatal, the cache will fill up as messages come in
+    logging.getLogger(__name__).warning("Could not preload header names: %s", e)
@@ -10,8 +10,22 @@ from django.conf import settings  # noqa
 import django  # noqa
 django.setup()
 
+from app.receivers import WORKER_ENV, WorkerLMTPReceiver, WorkerSMTPReceiver, WorkerStats, stats_path  # noqa
+
+worker = os.environ.get(WORKER_ENV)
+
 # where to listen for incoming messages
-if settings.SALMON_SERVER["type"] == "lmtp":
+if worker is not None:
+    # started by "./manage.py router", there may be other workers
+    stats = WorkerStats(stats_path(worker))
+    stats.flush()
+
+    if settings.SALMON_SERVER["type"] == "lmtp":
+        receiver = WorkerLMTPReceiver(stats, socket=settings.SALMON_SERVER["path"])
+    elif settings.SALMON_SERVER["type"] == "smtp":
+        receiver = WorkerSMTPReceiver(stats, settings.SALMON_SERVER['host'],
+                                      settings.SALMON_SERVER['port'])
+elif settings.SALMON_SERVER["type"] == "lmtp":
     receiver = LMTPReceiver(socket=settings.SALMON_SERVER["path"])
 elif settings.SALMON_SERVER["type"] == "smtp":
     receiver = SMTPReceiver(settings.SALMON_SERVER['host'],
@@ -0,0 +1,43 @@
+##
+#
+# Copyright 2018 Jessica Tallon, Matt Molyneaux
+#
+# This file is part of Inboxen.
+#
+# Inboxen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Inboxen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+#
+##
+
+from django.core.cache import cache
+from django.db import transaction
+
+from router.app.recipients import INBOX_CACHE_TIMEOUT, create_inbox_cache_key, inbox_to_cache, is_receiving
+
+
+def inbox_saved(sender, instance, created, **kwargs):
+    """Update the router's recipient cache once the change has been committed"""
+    key = create_inbox_cache_key(instance.inbox, instance.domain.domain)
+
+    if created and is_receiving(instance):
+        # new inboxes go straight into the cache, the router's recipient
+        # filter might not know about them yet
+        data = inbox_to_cache(instance)
+        transaction.on_commit(lambda: cache.set(key, data, INBOX_CACHE_TIMEOUT))
+    else:
+        transaction.on_commit(lambda: cache.delete(key))
+
+
+def inbox_deleted(sender, instance, **kwargs):
+    key = create_inbox_cache_key(instance.inbox, instance.domain.domain)
+    transaction.on_commit(lambda: cache.delete(key))
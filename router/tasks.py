@@ -0,0 +1,89 @@
+##
+#
+# Copyright 2018 Jessica Tallon, Matt Molyneaux
+#
+# This file is part of Inboxen.
+#
+# Inboxen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Inboxen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Inboxen.  If not, see <http://www.gnu.org/licenses/>.
+#
+##
+
+import logging
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+
+from inboxen.celery import app
+from inboxen.models import HeaderName, Inbox
+from router.app.helpers import deliver_message
+from router.app.recipients import lookup_inbox
+from router.app.spool import get_spool
+
+
+log = logging.getLogger(__name__)
+
+# messages claimed for longer than this (in seconds) are assumed to belong to
+# a worker that has died
+SPOOL_CLAIM_TIMEOUT = 60 * 10
+
+
+@app.task(ignore_result=True)
+def drain_spool():
+    """Save a batch of spooled messages to the database
+
+    If a full batch was claimed, another task is sent off so that more
+    workers can help clear the backlog.
+    """
+    if not settings.ROUTER_USE_SPOOL:
+        return
+
+    spool = get_spool()
+    spool.release_stale(SPOOL_CLAIM_TIMEOUT)
+
+    keys = spool.claim(settings.ROUTER_SPOOL_BATCH_SIZE)
+    if len(keys) == 0:
+        return
+    elif len(keys) == settings.ROUTER_SPOOL_BATCH_SIZE:
+        drain_spool.delay()
+
+    done = []
+    with transaction.atomic():
+        # check foreign keys as each message is saved, so a bad message fails
+        # its own savepoint rather than the whole batch at commit
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+
+        for key in keys:
+            try:
+                message, inbox, domain = spool.get(key)
+
+                with transaction.atomic():
+                    deliver_message(message, lookup_inbox(inbox, domain))
+            except Inbox.DoesNotExist:
+                log.warning("Dropping spooled message %s, %s@%s can no longer receive mail", key, inbox, domain)
+            except DatabaseError as exc:
+                # leave it claimed, it'll be retried after SPOOL_CLAIM_TIMEOUT
+                log.exception("DB error while saving spooled message %s: %s", key, exc)
+                # a cached HeaderName might have been deleted by clean_orphan_models
+                HeaderName.objects.clear_cache()
+                continue
+            except Exception as exc:
+                log.exception("Error while saving spooled message %s: %s", key, exc)
+                spool.fail(key)
+                continue
+
+            done.append(key)
+
+    for key in done:
+        spool.remove(key)
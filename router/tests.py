@@ -18,20 +18,29 @@
 ##
 
 import mock
+import os
 import shutil
 import sys
+import tempfile
 
 from django.contrib.auth import get_user_model
-from django.db import DatabaseError
+from django.core.cache import cache
+from django.db import DatabaseError, connection
+from django.test.utils import CaptureQueriesContext
 from salmon.mail import MailRequest
 from salmon.routing import Router
 from salmon.server import SMTPError
 import six
+from watson.models import SearchEntry
 
 from inboxen.test import override_settings, InboxenTestCase
 from inboxen import models
+from inboxen.tasks import index_emails
 from inboxen.tests import factories
+from router.app import receivers, recipients
 from router.app.helpers import make_email
+from router.app.spool import Spool
+from router import tasks
 
 
 TEST_MSG = """From: Test <test@localhost>
@@ -83,6 +92,7 @@ BODIES = [
 class RouterTestCase(InboxenTestCase):
     def setUp(self):
         sys.path.append("router")
+        cache.clear()
 
     def tearDown(self):
         sys.path.pop()
@@ -104,19 +114,23 @@ class RouterTestCase(InboxenTestCase):
             process_message(None, None, None)
         self.assertEqual(error.exception.code, 550)
 
+        # the missing inbox is cached, make sure the database is asked again
+        cache.clear()
         with self.assertRaises(SMTPError) as error, \
                 mock.patch.object(models.Inbox.objects, "filter", side_effect=DatabaseError):
             process_message(None, None, None)
         self.assertEqual(error.exception.code, 451)
 
+    @mock.patch("router.signals.transaction.on_commit", lambda func: func())
     def test_flag_setting(self):
         # import here, that way we don't have to fiddle with sys.path in the global scope
         from router.app.server import process_message
 
         user = factories.UserFactory()
         inbox = factories.InboxFactory(user=user)
+        created = inbox.last_activity
 
-        with mock.patch("router.app.server.make_email") as mock_make_email:
+        with mock.patch("app.helpers.make_email") as mock_make_email:
             process_message(None, inbox.inbox, inbox.domain.domain)
         self.assertTrue(mock_make_email.called)
 
@@ -125,7 +139,10 @@ class RouterTestCase(InboxenTestCase):
         inbox = models.Inbox.objects.get(id=inbox.id)
 
         self.assertTrue(inbox.new)
+        self.assertTrue(inbox.last_activity > created)
         self.assertTrue(profile.unified_has_new_messages)
+        self.assertEqual((inbox.total_count, inbox.unseen_count, inbox.unread_count), (1, 1, 1))
+        self.assertEqual((profile.total_count, profile.unseen_count, profile.unread_count), (1, 1, 1))
 
         # reset some bools
         inbox.new = False
@@ -134,7 +151,7 @@ class RouterTestCase(InboxenTestCase):
         profile.unified_has_new_messages = False
         profile.save(update_fields=["unified_has_new_messages"])
 
-        with mock.patch("router.app.server.make_email") as mock_make_email:
+        with mock.patch("app.helpers.make_email") as mock_make_email:
             process_message(None, inbox.inbox, inbox.domain.domain)
         self.assertTrue(mock_make_email.called)
 
@@ -144,6 +161,8 @@ class RouterTestCase(InboxenTestCase):
 
         self.assertTrue(inbox.new)
         self.assertFalse(profile.unified_has_new_messages)
+        self.assertEqual((inbox.total_count, inbox.unseen_count, inbox.unread_count), (2, 2, 2))
+        self.assertEqual((profile.total_count, profile.unseen_count, profile.unread_count), (1, 1, 1))
 
     def test_make_email(self):
         inbox = factories.InboxFactory()
@@ -157,6 +176,86 @@ class RouterTestCase(InboxenTestCase):
                   models.PartList.objects.select_related("body").order_by("level", "lft")]
         self.assertEqual(bodies, BODIES)
 
+        summary = models.EmailSummary.objects.get()
+        self.assertEqual(summary.subject, "This is a subject!")
+        self.assertEqual(summary.sender, "Test <test@localhost>")
+        self.assertEqual(summary.size, sum(len(body) for body in BODIES))
+        self.assertEqual(summary.attachment_count, 0)
+        self.assertEqual(summary.preview, "Hi, This is a plain text message!")
+
+    def test_make_email_index(self):
+        inbox = factories.InboxFactory()
+        message = MailRequest("locahost", "test@localhost", str(inbox), TEST_MSG)
+
+        # the inbox has an entry of its own
+        entries = SearchEntry.objects.filter(content_type__model="email")
+
+        email = make_email(message, inbox)
+        self.assertEqual(entries.count(), 0)
+        self.assertEqual(models.UnindexedEmail.objects.get().email_id, email.id)
+
+        index_emails()
+        entry = entries.get()
+        self.assertEqual(entry.object_id_int, email.id)
+        self.assertEqual(entry.title, "This is a subject!")
+        self.assertEqual(entry.description, "Test <test@localhost>")
+        self.assertEqual(entry.meta, {"inbox": inbox.inbox, "domain": inbox.domain.domain})
+        self.assertEqual(models.UnindexedEmail.objects.count(), 0)
+
+    @mock.patch("router.app.helpers.transaction.on_commit", lambda func: func())
+    def test_make_email_prerender(self):
+        inbox = factories.InboxFactory()
+        message = MailRequest("locahost", "test@localhost", str(inbox), TEST_MSG)
+
+        with mock.patch("router.app.helpers.prerender_emails") as task_mock:
+            make_email(message, inbox)
+            self.assertEqual(task_mock.delay.call_count, 0)
+
+            with override_settings(PRERENDER_EMAILS=True):
+                email = make_email(message, inbox)
+            self.assertEqual(task_mock.delay.call_count, 1)
+            self.assertEqual(task_mock.delay.call_args[0][0], [email.id])
+
+    def test_make_email_tree(self):
+        inbox = factories.InboxFactory()
+        message = MailRequest("locahost", "test@localhost", str(inbox), TEST_MSG)
+
+        email = make_email(message, inbox)
+        parts = models.PartList.objects.filter(email=email).select_related("body").order_by("lft")
+
+        self.assertEqual(len(set(part.tree_id for part in parts)), 1)
+        self.assertEqual(
+            [(part.lft, part.rght, part.level, six.binary_type(part.body.data)) for part in parts],
+            [
+                (1, 12, 0, BODIES[0]),
+                (2, 3, 1, BODIES[1]),
+                (4, 9, 1, BODIES[2]),
+                (5, 6, 2, BODIES[4]),
+                (7, 8, 2, BODIES[5]),
+                (10, 11, 1, BODIES[3]),
+            ],
+        )
+
+        root = email.get_parts()
+        self.assertEqual(len(root.get_children()), 3)
+        self.assertEqual(len(root.get_children()[1].get_children()), 2)
+
+        headers = models.Header.objects.filter(part=root).order_by("ordinal").values_list("name__name", "data__data")
+        self.assertEqual(list(headers), [(name, message[name]) for name in message.keys()])
+
+    def test_make_email_query_count(self):
+        inbox = factories.InboxFactory()
+
+        def count_queries(prefix, header_count):
+            msg = "".join("X-{}-{}: {}\n".format(prefix, i, i) for i in range(header_count))
+            msg = msg + TEST_MSG.replace("Last part!", "Last part of {}!".format(prefix))
+            message = MailRequest("locahost", "test@localhost", str(inbox), msg)
+            with CaptureQueriesContext(connection) as queries:
+                make_email(message, inbox)
+            return len(queries)
+
+        self.assertEqual(count_queries("few", 1), count_queries("many", 50))
+
     @override_settings(ADMINS=(("admin", "root@localhost"),))
     def test_forwarding(self):
         from router.app.server import forward_to_admins
@@ -182,10 +281,12 @@ class RouterTestCase(InboxenTestCase):
         user = factories.UserFactory()
         inbox = factories.InboxFactory(user=user)
         Router.load(['app.server'])
+        # other tests import handlers as router.app.server, which registers
+        # them a second time
+        Router.reload()
 
-        with mock.patch("router.app.server.Relay") as relay_mock, \
-                mock.patch("router.app.server.make_email") as mock_make_email, \
-                mock.patch("salmon.server.smtplib.SMTP") as smtp_mock:
+        with mock.patch("app.server.Relay") as relay_mock, \
+                mock.patch("app.helpers.make_email") as mock_make_email:
 
             deliver_mock = mock.Mock()
             relay_mock.return_value.deliver = deliver_mock
@@ -223,7 +324,7 @@ class RouterTestCase(InboxenTestCase):
             mock_make_email.reset_mock()
             relay_mock.reset_mock()
             deliver_mock.reset_mock()
-            smtp_mock.return_value.sendmail.side_effect = Exception()
+            deliver_mock.side_effect = Exception()
             message = MailRequest("locahost", "test@localhost", "root@localhost", TEST_MSG)
             with self.assertRaises(SMTPError) as excp:
                 Router.deliver(message)
@@ -231,5 +332,220 @@ class RouterTestCase(InboxenTestCase):
             self.assertEqual(excp.exception.message, "Error while forwarding admin message %s" % id(message))
 
             self.assertEqual(mock_make_email.call_count, 0)
-            self.assertEqual(relay_mock.call_count, 0)
-            self.assertEqual(deliver_mock.call_count, 0)
+            self.assertEqual(relay_mock.call_count, 1)
+            self.assertEqual(deliver_mock.call_count, 1)
+
+
+class SpoolTestCase(InboxenTestCase):
+    def setUp(self):
+        sys.path.append("router")
+        cache.clear()
+        self.spool_path = tempfile.mkdtemp()
+        self.spool = Spool(self.spool_path)
+
+    def tearDown(self):
+        sys.path.pop()
+        shutil.rmtree(self.spool_path, ignore_errors=True)
+
+    def test_push_and_get(self):
+        message = MailRequest("localhost", "test@localhost", "hello@example.com", TEST_MSG)
+        key = self.spool.push(message, "hello", "example.com")
+
+        self.assertEqual(self.spool.count(), 1)
+        self.assertEqual(os.listdir(os.path.join(self.spool_path, "tmp")), [])
+
+        self.assertEqual(self.spool.claim(10), [key])
+        self.assertEqual(self.spool.claim(10), [])
+        self.assertEqual(self.spool.count(), 1)
+
+        spooled_message, inbox, domain = self.spool.get(key)
+        self.assertEqual((inbox, domain), ("hello", "example.com"))
+        self.assertEqual(spooled_message.Data, message.Data)
+        self.assertEqual(spooled_message.To, message.To)
+        self.assertEqual(spooled_message.From, message.From)
+
+        self.spool.remove(key)
+        self.assertEqual(self.spool.count(), 0)
+
+    def test_claim_limit(self):
+        message = MailRequest("localhost", "test@localhost", "hello@example.com", TEST_MSG)
+        for i in range(5):
+            self.spool.push(message, "hello", "example.com")
+
+        self.assertEqual(len(self.spool.claim(3)), 3)
+        self.assertEqual(len(self.spool.claim(3)), 2)
+
+    def test_release_stale(self):
+        message = MailRequest("localhost", "test@localhost", "hello@example.com", TEST_MSG)
+        key = self.spool.push(message, "hello", "example.com")
+        self.spool.claim(1)
+
+        self.spool.release_stale(60)
+        self.assertEqual(self.spool.claim(1), [])
+
+        self.spool.release_stale(-1)
+        self.assertEqual(self.spool.claim(1), [key])
+
+    def test_process_message(self):
+        from router.app.server import process_message
+
+        inbox = factories.InboxFactory(user=factories.UserFactory())
+        message = MailRequest("localhost", "test@localhost", str(inbox), TEST_MSG)
+
+        with override_settings(ROUTER_USE_SPOOL=True, ROUTER_SPOOL_PATH=self.spool_path):
+            process_message(message, inbox.inbox, inbox.domain.domain)
+
+            self.assertEqual(self.spool.count(), 1)
+            self.assertEqual(models.Email.objects.count(), 0)
+
+            with self.assertRaises(SMTPError) as error:
+                process_message(message, "nope", inbox.domain.domain)
+            self.assertEqual(error.exception.code, 550)
+
+            with override_settings(ROUTER_SPOOL_HIGH_WATER=1), self.assertRaises(SMTPError) as error:
+                process_message(message, inbox.inbox, inbox.domain.domain)
+            self.assertEqual(error.exception.code, 451)
+            self.assertEqual(self.spool.count(), 1)
+
+            tasks.drain_spool.delay()
+
+        self.assertEqual(self.spool.count(), 0)
+        self.assertEqual(models.Email.objects.filter(inbox=inbox).count(), 1)
+        self.assertEqual(models.PartList.objects.count(), 6)
+        self.assertTrue(models.Inbox.objects.get(id=inbox.id).new)
+
+    def test_drain_spool(self):
+        inbox = factories.InboxFactory(user=factories.UserFactory())
+        deleted_inbox = factories.InboxFactory(user=factories.UserFactory(), deleted=True)
+
+        for i in range(3):
+            message = MailRequest("localhost", "test@localhost", str(inbox), TEST_MSG)
+            self.spool.push(message, inbox.inbox, inbox.domain.domain)
+
+        message = MailRequest("localhost", "test@localhost", str(deleted_inbox), TEST_MSG)
+        self.spool.push(message, deleted_inbox.inbox, deleted_inbox.domain.domain)
+
+        with override_settings(ROUTER_USE_SPOOL=True, ROUTER_SPOOL_PATH=self.spool_path, ROUTER_SPOOL_BATCH_SIZE=2):
+            tasks.drain_spool.delay()
+
+        self.assertEqual(self.spool.count(), 0)
+        self.assertEqual(models.Email.objects.filter(inbox=inbox).count(), 3)
+        self.assertEqual(models.Email.objects.filter(inbox=deleted_inbox).count(), 0)
+
+    def test_drain_spool_failure(self):
+        inbox = factories.InboxFactory(user=factories.UserFactory())
+        message = MailRequest("localhost", "test@localhost", str(inbox), TEST_MSG)
+        key = self.spool.push(message, inbox.inbox, inbox.domain.domain)
+
+        with override_settings(ROUTER_USE_SPOOL=True, ROUTER_SPOOL_PATH=self.spool_path), \
+                mock.patch("router.tasks.deliver_message", side_effect=DatabaseError), \
+                mock.patch("router.tasks.HeaderName.objects.clear_cache") as clear_mock:
+            tasks.drain_spool.delay()
+
+        # still claimed, will be retried later, with a fresh header name cache
+        self.assertEqual(clear_mock.call_count, 1)
+        self.assertEqual(self.spool.count(), 1)
+        self.assertEqual(os.listdir(os.path.join(self.spool_path, "cur")), [key])
+
+        self.spool.release_stale(-1)
+        with override_settings(ROUTER_USE_SPOOL=True, ROUTER_SPOOL_PATH=self.spool_path), \
+                mock.patch("router.tasks.deliver_message", side_effect=Exception):
+            tasks.drain_spool.delay()
+
+        self.assertEqual(self.spool.count(), 0)
+        self.assertEqual(os.listdir(os.path.join(self.spool_path, "failed")), [key])
+
+
+class RecipientTestCase(InboxenTestCase):
+    def setUp(self):
+        cache.clear()
+        self.inbox = factories.InboxFactory(user=factories.UserFactory())
+
+    def test_lookup_cached(self):
+        with self.assertNumQueries(1):
+            inbox = recipients.lookup_inbox(self.inbox.inbox, self.inbox.domain.domain)
+        self.assertEqual(inbox, self.inbox)
+
+        with self.assertNumQueries(0):
+            inbox = recipients.lookup_inbox(self.inbox.inbox, self.inbox.domain.domain)
+        self.assertEqual(inbox, self.inbox)
+        self.assertEqual(inbox.domain.domain, self.inbox.domain.domain)
+        self.assertEqual(inbox.user_id, self.inbox.user_id)
+
+        # a cached inbox is good enough to deliver to
+        make_email(MailRequest("", "", "", TEST_MSG), inbox)
+        self.assertEqual(models.Email.objects.get().inbox_id, self.inbox.id)
+
+    def test_lookup_not_receiving(self):
+        with self.assertNumQueries(1), self.assertRaises(models.Inbox.DoesNotExist):
+            recipients.lookup_inbox("nope", self.inbox.domain.domain)
+
+        with self.assertNumQueries(0), self.assertRaises(models.Inbox.DoesNotExist):
+            recipients.lookup_inbox("nope", self.inbox.domain.domain)
+
+    @mock.patch("router.signals.transaction.on_commit", lambda func: func())
+    def test_signals(self):
+        recipients.lookup_inbox(self.inbox.inbox, self.inbox.domain.domain)
+
+        self.inbox.disabled = True
+        self.inbox.save()
+        with self.assertRaises(models.Inbox.DoesNotExist):
+            recipients.lookup_inbox(self.inbox.inbox, self.inbox.domain.domain)
+
+        self.inbox.disabled = False
+        self.inbox.save()
+        self.assertEqual(recipients.lookup_inbox(self.inbox.inbox, self.inbox.domain.domain), self.inbox)
+
+        self.inbox.delete()
+        with self.assertRaises(models.Inbox.DoesNotExist):
+            recipients.lookup_inbox(self.inbox.inbox, self.inbox.domain.domain)
+
+        # new inboxes are cached straight away
+        new_inbox = factories.InboxFactory(user=factories.UserFactory())
+        with self.assertNumQueries(0):
+            self.assertEqual(recipients.lookup_inbox(new_inbox.inbox, new_inbox.domain.domain), new_inbox)
+
+    def test_recipient_filter(self):
+        with override_settings(ROUTER_RECIPIENT_FILTER=True), \
+                mock.patch.object(recipients, "recipient_filter", recipients.RecipientFilter()):
+            with self.assertRaises(models.Inbox.DoesNotExist):
+                recipients.lookup_inbox("nope", self.inbox.domain.domain)
+
+            # filter is built, unknown addresses don't touch the database
+            with self.assertNumQueries(0), self.assertRaises(models.Inbox.DoesNotExist):
+                recipients.lookup_inbox("still-nope", self.inbox.domain.domain)
+
+            self.assertEqual(recipients.lookup_inbox(self.inbox.inbox, self.inbox.domain.domain), self.inbox)
+
+            # refresh picks up new inboxes
+            new_inbox = factories.InboxFactory(user=factories.UserFactory())
+            recipients.recipient_filter.last_refresh = 0
+            self.assertEqual(recipients.lookup_inbox(new_inbox.inbox, new_inbox.domain.domain), new_inbox)
+
+
+class WorkerStatsTestCase(InboxenTestCase):
+    def setUp(self):
+        self.stats_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.stats_dir, "router-1.stats")
+
+    def tearDown(self):
+        shutil.rmtree(self.stats_dir, ignore_errors=True)
+
+    def test_record(self):
+        stats = receivers.WorkerStats(self.path)
+        self.assertEqual(receivers.read_stats(self.path), None)
+
+        stats.record(None)
+        stats.record("550 No such address")
+        stats.record("451 Error processing message, try again later.")
+        stats.record(None)
+
+        # only the first message causes a flush
+        self.assertEqual(receivers.read_stats(self.path)["accepted"], 1)
+
+        stats.flush()
+        data = receivers.read_stats(self.path)
+        self.assertEqual(data["pid"], os.getpid())
+        self.assertEqual(data["accepted"], 2)
+        self.assertEqual(data["rejected"], 1)
+        self.assertEqual(data["deferred"], 1)